@@ -7,6 +7,7 @@ import auth.api.schemas as sh
 import auth.db.connection as con
 import auth.db.models as md
 import auth.db.query as dq
+import auth.profiles as pr
 import auth.security as sec
 
 user_identification_router = fs.APIRouter(tags=['user_identification'])
@@ -18,7 +19,9 @@ async def signup(
     db_session: con.AsyncSession = fs.Depends(con.get_db_session)
 ) -> md.User:
     b.validate_new_password(registration_data)
-    return await b.create_new_user(registration_data, db_session)
+    user = await b.create_new_user(registration_data, db_session)
+    await pr.mirror_user(user)
+    return user
 
 
 @user_identification_router.post('/signin', response_model=sh.Token)
@@ -34,6 +37,7 @@ async def signin(
                         sh.LoginAttemptResult.SUCCESS, user)
     session = b.add_login_session(user, db_session)
     await db_session.commit()
+    await pr.mirror_user(user)  # type: ignore
     return b.create_session_token(session)
 
 
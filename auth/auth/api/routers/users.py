@@ -8,6 +8,7 @@ import auth.api.schemas as sh
 import auth.db.connection as con
 import auth.db.models as md
 import auth.db.query as dq
+import auth.profiles as pr
 import auth.security as sec
 
 users_router = fs.APIRouter(prefix='/users', tags=['user'])
@@ -132,6 +133,7 @@ async def update_user_data(
     changed = True
     if changed:
         await b.commit_if_not_exists(db_session)
+        await pr.mirror_user(user)
 
 
 @users_router.delete('/{id}', status_code=fs.status.HTTP_204_NO_CONTENT)
@@ -145,3 +147,4 @@ async def delete_user(
     if deleted_id is None:
         raise exc.DataNotFound([id, ])
     await db_session.commit()
+    await pr.remove_user(id)
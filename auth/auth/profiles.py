@@ -0,0 +1,32 @@
+import json
+
+from redis.asyncio.client import Redis
+from redis.exceptions import RedisError
+
+import auth.db.models as md
+from auth.settings import settings
+
+redis = Redis.from_url(settings.redis.url, decode_responses=True)
+
+
+def profile_key(id: int) -> str:
+    # chat looks users up in batches by this key
+    return f'user:{id}'
+
+
+async def mirror_user(user: md.User) -> None:
+    """
+    copies the public profile of the user to redis, a failed write is
+    repeated on the next signin, until then chat shows the user without a name
+    """
+    try:
+        await redis.set(profile_key(user.id), json.dumps({'id': user.id, 'name': user.login}))  # type: ignore
+    except (RedisError, OSError):
+        pass
+
+
+async def remove_user(id: int) -> None:
+    try:
+        await redis.delete(profile_key(id))
+    except (RedisError, OSError):
+        pass
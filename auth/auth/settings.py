@@ -19,9 +19,15 @@ class _SettingsSecurity(BaseSettings):
     password_hash_schemas: list[str] = ['bcrypt']
 
 
+class _SettingsRedis(BaseSettings):
+    # the first chat redis node, chat reads user profiles from it
+    url: str = 'redis://redis:6379'
+
+
 class _Settings(BaseSettings):
     sql: _SettingsSQL = _SettingsSQL()
     security: _SettingsSecurity = _SettingsSecurity()
+    redis: _SettingsRedis = _SettingsRedis()
 
 
 settings = _Settings()
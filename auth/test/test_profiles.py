@@ -0,0 +1,33 @@
+import json
+
+import pytest
+from fakeredis import aioredis
+
+import auth.profiles as pr
+from auth.api.routers.user_identification import signup
+from auth.api.schemas import Login
+from auth.db.models import User
+
+
+@pytest.fixture
+def redis(mocker):
+    redis = aioredis.FakeRedis(decode_responses=True)
+    mocker.patch('auth.profiles.redis', redis)
+    return redis
+
+
+@pytest.mark.asyncio
+async def test_signup_mirrors_profile(redis, mocker):
+    mocker.patch('auth.api.base.create_new_user', return_value=User(id=5, login='user_login'))
+    await signup(Login(login='user_login', password='Pretty_password1'), None)  # type: ignore
+    assert json.loads(await redis.get(pr.profile_key(5))) == {'id': 5, 'name': 'user_login'}
+    await pr.mirror_user(User(id=5, login='new_login'))
+    assert json.loads(await redis.get('user:5'))['name'] == 'new_login'
+    await pr.remove_user(5)
+    assert await redis.get('user:5') is None
+
+
+@pytest.mark.asyncio
+async def test_mirror_failure_ignored(mocker):
+    mocker.patch.object(pr.redis, 'set', side_effect=ConnectionError)
+    await pr.mirror_user(User(id=5, login='user_login'))
@@ -0,0 +1,446 @@
+"""
+chat load benchmark, serves the app in process against redis urls or an in-memory fake
+and drives thousands of websocket clients spread over rooms of a fixed size
+
+    python bench.py --clients 2000 --room-size 50 --rate 5 --duration 30
+    python bench.py --redis redis://localhost:6379/15 --encoding msgpack --batch
+
+real redis databases are written to, use a scratch one
+"""
+import argparse
+import asyncio
+import json
+import random
+import resource
+import socket
+import sys
+import timeit
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta, timezone
+from math import ceil
+from pathlib import Path
+from time import perf_counter, perf_counter_ns
+from typing import Any, Iterator
+from uuid import UUID, uuid4
+
+import msgpack
+import websockets
+from redis.asyncio.connection import Connection
+
+# service modules are imported flat, the same way the container runs them
+sys.path.insert(0, str(Path(__file__).parent.parent / 'chat'))
+
+TEXT_PREFIX = 'bench:'
+
+
+@dataclass
+class BenchConfig:
+    clients: int = 200
+    room_size: int = 20
+    # new messages per room per second
+    rate: float = 2
+    # seconds
+    duration: float = 5
+    # share of received messages acknowledged as READ, the rest as DELIVERED
+    read_ratio: float = 0.5
+    # share of received messages acknowledged at all
+    receipt_ratio: float = 1
+    encoding: str = 'json'
+    batch: bool = False
+    compression: bool = True
+    # empty runs against an in-memory fake with this many shards
+    redis: list[str] = field(default_factory=list)
+    fake_shards: int = 1
+    connect_concurrency: int = 100
+
+
+@dataclass
+class BenchReport:
+    clients: int
+    rooms: int
+    sent: int
+    delivered: int
+    expected: int
+    messages_per_second: float
+    deliveries_per_second: float
+    latency_ms: dict[str, float]
+    connect_seconds: float
+    memory_per_connection_kb: float
+    redis_commands_per_message: float
+    redis_round_trips_per_message: float
+    redis_top_commands_per_message: dict[str, float]
+    # auto pipelined commands minus their flushes
+    redis_round_trips_saved_per_message: float
+    # before permessage-deflate
+    payload_bytes_per_delivery: float
+    # written to the socket, after permessage-deflate and framing
+    wire_bytes_per_delivery: float
+    frames_per_delivery: float
+    decode_ns: dict[str, float]
+
+
+class RedisOps:
+    """
+    counts commands by name and round trips of every redis client in the process,
+    pipelines pack each command but send once, idle stream polls are left out since
+    an in-memory fake returns them at once instead of blocking
+    """
+    polls = frozenset(('XREADGROUP', 'XAUTOCLAIM'))
+
+    def __init__(self) -> None:
+        self.commands: Counter[str] = Counter()
+        self.round_trips: int = 0
+
+    @contextmanager
+    def installed(self) -> Iterator['RedisOps']:
+        pack_command, send_packed_command = Connection.pack_command, Connection.send_packed_command
+        ops = self
+
+        def counted_pack_command(self: Connection, *args: Any) -> Any:
+            name = str(args[0]).upper()
+            ops.commands[name] += 1
+            self._bench_last_command = name  # type: ignore
+            return pack_command(self, *args)
+
+        async def counted_send_packed_command(self: Connection, *args: Any, **kwargs: Any) -> None:
+            if getattr(self, '_bench_last_command', None) not in ops.polls:
+                ops.round_trips += 1
+            return await send_packed_command(self, *args, **kwargs)
+
+        Connection.pack_command = counted_pack_command  # type: ignore
+        Connection.send_packed_command = counted_send_packed_command  # type: ignore
+        try:
+            yield self
+        finally:
+            Connection.pack_command = pack_command  # type: ignore
+            Connection.send_packed_command = send_packed_command  # type: ignore
+
+    def snapshot(self) -> tuple[Counter[str], int]:
+        return Counter(self.commands), self.round_trips
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return dict()
+    values = sorted(values)
+    return dict((name, values[min(len(values) - 1, int(len(values) * q))])
+                for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1)))
+
+
+def rss_kb() -> int:
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def configure_redis(config: BenchConfig) -> None:
+    """
+    must run before the service modules create their clients
+    """
+    from settings import settings
+    if config.redis:
+        settings.redis.urls = config.redis
+        return
+    settings.redis.urls = [f'redis://fake{i}' for i in range(config.fake_shards)]
+    import fakeredis
+    import fakeredis.aioredis
+    import connections
+    for url in connections.shards.clients:
+        server = fakeredis.FakeServer()
+        connections.shards.clients[url] = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+        connections.shards.binary_clients[url] = fakeredis.aioredis.FakeRedis(server=server)
+    connections.redis = connections.shards.clients[connections.shards.primary]
+
+
+def decode_costs() -> dict[str, float]:
+    """
+    ns per frame of the hot decodes: client frames on receive and chat messages on fan-out
+    """
+    from codec import codecs, Encoding
+    from schemas import Message, MessageStatus, NewMessage, UpdateMessage, User
+    frames = {
+        'new_message': (NewMessage(receiver=uuid4(), text='x' * 64), (NewMessage, UpdateMessage)),
+        'update_message': (UpdateMessage(status=MessageStatus.READ, uuid=uuid4()), (NewMessage, UpdateMessage)),
+        'message': (Message(receiver=uuid4(), status=MessageStatus.SENT, sender=User(id=1, name='user'),
+                            text='x' * 64, uuid=uuid4(), seq=1), (Message, UpdateMessage)),
+    }
+    costs = dict()
+    for encoding in Encoding:
+        codec = codecs[encoding]
+        for name, (frame, classes) in frames.items():
+            data = codec.encode(frame)
+            number = 20000
+            seconds = timeit.timeit(lambda: codec.decode(data, classes), number=number)
+            costs[f'{encoding}.{name}'] = round(seconds / number * 1e9, 1)
+    return costs
+
+
+class Client:
+
+    def __init__(self, user_id: int, chat: UUID, token: str, config: BenchConfig) -> None:
+        self.user_id: int = user_id
+        self.chat: UUID = chat
+        self.token: str = token
+        self.config: BenchConfig = config
+        self.socket: Any = None
+        self.latencies: list[float] = []
+        self.delivered: int = 0
+        self._reader: asyncio.Task | None = None
+
+    async def connect(self, url: str) -> None:
+        from codec import MSGPACK_SUBPROTOCOL
+        self.socket = await websockets.connect(  # type: ignore
+            url + ('?batch=1' if self.config.batch else ''),
+            extra_headers={'Authorization': f'Bearer {self.token}'},
+            subprotocols=[MSGPACK_SUBPROTOCOL] if self.config.encoding == 'msgpack' else None,
+            compression='deflate' if self.config.compression else None,
+            max_queue=None)
+        self._reader = asyncio.create_task(self.read())
+
+    def _frames(self, data: str | bytes) -> list[Any]:
+        if isinstance(data, bytes):
+            frame = msgpack.unpackb(data, strict_map_key=False)
+            return frame if frame and isinstance(frame[0], list) else [frame]
+        frame = json.loads(data)
+        return frame if isinstance(frame, list) else [frame]
+
+    def _message(self, frame: Any) -> tuple[str, str] | None:
+        """
+        text and uuid of a chat message frame
+        """
+        if isinstance(frame, dict):
+            if frame.get('type') == 'message':
+                return frame['text'], frame['uuid']
+        elif frame[0] == 1:  # FrameType.MESSAGE
+            return frame[4], str(UUID(bytes=frame[5]))
+        return None
+
+    async def read(self) -> None:
+        async for data in self.socket:
+            received = perf_counter_ns()
+            for frame in self._frames(data):
+                message = self._message(frame)
+                if message is None:
+                    continue
+                text, uuid = message
+                self.delivered += 1
+                if text.startswith(TEXT_PREFIX):
+                    self.latencies.append((received - int(text[len(TEXT_PREFIX):])) / 1e6)
+                if random.random() < self.config.receipt_ratio:
+                    status = 'READ' if random.random() < self.config.read_ratio else 'DELIVERED'
+                    await self.send({'type': 'update_message', 'status': status, 'uuid': uuid})
+
+    async def send(self, frame: dict[str, Any]) -> None:
+        if self.config.encoding == 'msgpack':
+            if frame['type'] == 'new_message':
+                await self.socket.send(msgpack.packb([2, UUID(frame['receiver']).bytes, frame['text']]))
+            else:
+                from schemas import MessageStatus
+                await self.socket.send(msgpack.packb([3, MessageStatus(frame['status']).rank,
+                                                      UUID(frame['uuid']).bytes]))
+        else:
+            await self.socket.send(json.dumps(frame))
+
+    async def send_message(self) -> None:
+        await self.send({'type': 'new_message', 'receiver': str(self.chat),
+                         'text': f'{TEXT_PREFIX}{perf_counter_ns()}'})
+
+    async def close(self) -> None:
+        if self._reader:
+            self._reader.cancel()
+        await self.socket.close()
+
+
+async def seed(config: BenchConfig, rooms: list[UUID]) -> list[str]:
+    """
+    memberships, permissions and tokens of every bench user
+    """
+    from jose import jwt
+    from authentication import ALGORITHM, KEY, RoleManager, user_uuid
+    from connections import redis
+    from schemas import Chat, Permission, User
+    from users import UserDirectory
+    tokens = []
+    expires = datetime.now(timezone.utc) + timedelta(hours=1)
+    async with redis.pipeline(transaction=False) as pipe:
+        for user_id in range(1, config.clients + 1):
+            chat = rooms[(user_id - 1) // config.room_size]
+            pipe.set(f'Role:{user_id}:{chat}', 'writer')
+            pipe.sadd(RoleManager.members_key(chat), user_id)
+            pipe.sadd(RoleManager.chats_key(user_id), str(chat))
+            pipe.set(Permission(user_uuid=user_uuid(user_id), resource_type=Chat, resource_uuid=chat).key,
+                     'writer')
+            pipe.set(UserDirectory.key(user_id), User(id=user_id, name=f'user{user_id}').json())
+            tokens.append(jwt.encode({'sub': user_id, 'pms': ['chat_access'], 'exp': expires}, KEY, ALGORITHM))
+        await pipe.execute()
+    return tokens
+
+
+async def drive(clients: list[Client], rooms: dict[UUID, list[Client]], config: BenchConfig) -> int:
+    sent = 0
+
+    async def room_sender(members: list[Client]) -> None:
+        nonlocal sent
+        interval = 1 / config.rate
+        deadline = perf_counter() + config.duration
+        # rooms start out of phase
+        await asyncio.sleep(random.random() * interval)
+        while perf_counter() < deadline:
+            await random.choice(members).send_message()
+            sent += 1
+            await asyncio.sleep(interval)
+
+    await asyncio.gather(*(room_sender(members) for members in rooms.values()))
+    return sent
+
+
+async def run(config: BenchConfig) -> BenchReport:
+    import uvicorn
+    configure_redis(config)
+    from autopipeline import auto_pipeline_flushes, auto_pipelined
+    from codec import bytes_sent
+    from compression import ChatWebSocketProtocol, wire_bytes
+    from main import app
+    from send_queue import frames_sent, messages_sent
+    from settings import settings
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app,
+                                           host='127.0.0.1',
+                                           port=port,
+                                           ws=ChatWebSocketProtocol,  # type: ignore
+                                           ws_per_message_deflate=settings.compression.enabled,
+                                           log_level='warning',
+                                           lifespan='on'))
+    server.install_signal_handlers = lambda: None  # type: ignore
+    serving = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+
+    rooms = [uuid4() for _ in range(ceil(config.clients / config.room_size))]
+    tokens = await seed(config, rooms)
+    clients = [Client(user_id, rooms[(user_id - 1) // config.room_size], tokens[user_id - 1], config)
+               for user_id in range(1, config.clients + 1)]
+    members: dict[UUID, list[Client]] = dict()
+    for client in clients:
+        members.setdefault(client.chat, []).append(client)
+
+    ops = RedisOps()
+    with ops.installed():
+        rss = rss_kb()
+        connect_started = perf_counter()
+        limit = asyncio.Semaphore(config.connect_concurrency)
+
+        async def connect(client: Client) -> None:
+            async with limit:
+                await client.connect(f'ws://127.0.0.1:{port}/')
+
+        await asyncio.gather(*(connect(client) for client in clients))
+        connect_seconds = perf_counter() - connect_started
+        # the unread counts frame and inbox catch-up come first
+        await asyncio.sleep(0.5)
+        memory = (rss_kb() - rss) / config.clients
+
+        commands, round_trips = ops.snapshot()
+        payload, frames, delivered_frames = bytes_sent.value(), frames_sent.value(), messages_sent.value()
+        wire = wire_bytes.value()
+        saved = auto_pipelined.value() - auto_pipeline_flushes.value()
+        started = perf_counter()
+        sent = await drive(clients, members, config)
+        # in-flight fan-out
+        await asyncio.sleep(1)
+        elapsed = perf_counter() - started
+        commands, round_trips = ops.commands - commands, ops.round_trips - round_trips
+        for poll in ops.polls:
+            commands.pop(poll, None)
+        payload, frames = bytes_sent.value() - payload, frames_sent.value() - frames
+        wire = wire_bytes.value() - wire
+        delivered_frames = messages_sent.value() - delivered_frames
+        saved = auto_pipelined.value() - auto_pipeline_flushes.value() - saved
+
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+    server.should_exit = True
+    await serving
+
+    delivered = sum(client.delivered for client in clients)
+    latencies = [latency for client in clients for latency in client.latencies]
+    return BenchReport(clients=config.clients,
+                       rooms=len(rooms),
+                       sent=sent,
+                       delivered=delivered,
+                       expected=sent * config.room_size,
+                       messages_per_second=round(sent / config.duration, 1),
+                       deliveries_per_second=round(delivered / elapsed, 1),
+                       latency_ms=dict((name, round(value, 2)) for name, value in percentiles(latencies).items()),
+                       connect_seconds=round(connect_seconds, 2),
+                       memory_per_connection_kb=round(memory, 1),
+                       redis_commands_per_message=round(commands.total() / max(sent, 1), 1),
+                       redis_round_trips_per_message=round(round_trips / max(sent, 1), 1),
+                       redis_top_commands_per_message=dict((name, round(count / max(sent, 1), 1))
+                                                           for name, count in commands.most_common(8)),
+                       redis_round_trips_saved_per_message=round(saved / max(sent, 1), 1),
+                       payload_bytes_per_delivery=round(payload / max(delivered_frames, 1), 1),
+                       wire_bytes_per_delivery=round(wire / max(delivered_frames, 1), 1),
+                       frames_per_delivery=round(frames / max(delivered_frames, 1), 3),
+                       decode_ns=decode_costs())
+
+
+def parse_args(argv: list[str] | None = None) -> tuple[BenchConfig, bool]:
+    defaults = BenchConfig()
+    parser = argparse.ArgumentParser(description='chat websocket load benchmark')
+    parser.add_argument('--clients', type=int, default=defaults.clients)
+    parser.add_argument('--room-size', type=int, default=defaults.room_size)
+    parser.add_argument('--rate', type=float, default=defaults.rate, help='messages per room per second')
+    parser.add_argument('--duration', type=float, default=defaults.duration, help='seconds')
+    parser.add_argument('--read-ratio', type=float, default=defaults.read_ratio)
+    parser.add_argument('--receipt-ratio', type=float, default=defaults.receipt_ratio)
+    parser.add_argument('--encoding', choices=('json', 'msgpack'), default=defaults.encoding)
+    parser.add_argument('--batch', action='store_true')
+    parser.add_argument('--no-compression', action='store_true')
+    parser.add_argument('--redis', action='append', default=[], help='redis url, repeat for shards')
+    parser.add_argument('--fake-shards', type=int, default=defaults.fake_shards)
+    parser.add_argument('--connect-concurrency', type=int, default=defaults.connect_concurrency)
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args(argv)
+    return BenchConfig(clients=args.clients,
+                       room_size=args.room_size,
+                       rate=args.rate,
+                       duration=args.duration,
+                       read_ratio=args.read_ratio,
+                       receipt_ratio=args.receipt_ratio,
+                       encoding=args.encoding,
+                       batch=args.batch,
+                       compression=not args.no_compression,
+                       redis=args.redis,
+                       fake_shards=args.fake_shards,
+                       connect_concurrency=args.connect_concurrency), args.json
+
+
+def main(argv: list[str] | None = None) -> None:
+    config, as_json = parse_args(argv)
+    # thousands of sockets in one process
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, config.clients * 4 + 256)), hard))
+    report = asdict(asyncio.run(run(config)))
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return
+    for name, value in report.items():
+        print(f'{name:36} {value}')
+
+
+if __name__ == '__main__':
+    main()
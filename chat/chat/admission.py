@@ -0,0 +1,65 @@
+import asyncio
+from time import monotonic
+
+from metrics import registry
+from ratelimit import TokenBucket
+
+admission_waiting = registry.gauge('chat_admission_waiting',
+                                   'Sockets queued for a connect token or handshake slot')
+admission_handshakes = registry.gauge('chat_admission_handshakes',
+                                      'Handshakes running on the node')
+admission_rejected = registry.counter('chat_admission_rejected_total',
+                                      'Sockets turned away by reason')
+admission_wait = registry.histogram('chat_admission_wait_seconds',
+                                    'Time admitted sockets waited before their handshake')
+
+
+class AdmissionController:
+    """
+    connects of the node pass a token bucket one at a time in arrival order, then
+    take one of max_handshakes slots, a reconnect storm waits in line for up to
+    timeout seconds instead of running every handshake against redis at once
+    """
+
+    def __init__(self, rate: float, burst: float, max_handshakes: int, max_waiting: int, timeout: float) -> None:
+        self.bucket = TokenBucket(rate, burst)
+        self.max_waiting: int = max_waiting
+        self.timeout: float = timeout  # seconds
+        self.waiting: int = 0
+        self.handshakes: int = 0
+        self._slots = asyncio.Semaphore(max_handshakes)
+        self._line = asyncio.Lock()
+
+    async def _acquire(self) -> None:
+        async with self._line:
+            while not self.bucket.take():
+                await asyncio.sleep(self.bucket.wait_time())
+        await self._slots.acquire()
+
+    async def acquire(self) -> bool:
+        """
+        false when the line is full or the wait ran out, release after the handshake otherwise
+        """
+        if self.waiting >= self.max_waiting:
+            admission_rejected.inc(reason='queue_full')
+            return False
+        started = monotonic()
+        self.waiting += 1
+        admission_waiting.set(self.waiting)
+        try:
+            await asyncio.wait_for(self._acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            admission_rejected.inc(reason='timeout')
+            return False
+        finally:
+            self.waiting -= 1
+            admission_waiting.set(self.waiting)
+        admission_wait.observe(monotonic() - started)
+        self.handshakes += 1
+        admission_handshakes.set(self.handshakes)
+        return True
+
+    def release(self) -> None:
+        self.handshakes -= 1
+        admission_handshakes.set(self.handshakes)
+        self._slots.release()
@@ -1,23 +1,42 @@
 
 from datetime import datetime, timezone
 from typing import Any
-from uuid import uuid4
+from uuid import UUID, uuid4, uuid5
 
 from jose import jwt
 from jose.exceptions import JWTError
 from pydantic.error_wrappers import ValidationError
 from redis.asyncio.client import Redis
-from schemas import AccessTokenData, Chat, HasUUID, Role, RoleLevel, User
+
+from autopipeline import AutoPipeline
+from metrics import registry
+from schemas import (AccessTokenData, Chat, HasUUID, Permission,
+                     PermissionDelta, Role, RoleLevel, User)
 from starlette.authentication import (AuthCredentials, AuthenticationBackend,
                                       AuthenticationError, BaseUser)
 from starlette.datastructures import Headers
 from starlette.requests import HTTPConnection
+from users import TTLCache, UserDirectory
+from utils import type_key
 
 # from auth
 TOKEN_NAME = 'Bearer'
 KEY = b'4354534534'
 ALGORITHM = 'HS256'
 
+NOT_MEMBER_LEVELS = (RoleLevel.UNSET, RoleLevel.BANNED)
+USER_NAMESPACE = UUID('5c0a6c0e-2f0b-4d1e-9a43-3f0d2c7a9b11')
+
+auth_failures = registry.counter('chat_auth_failures_total',
+                                 'Rejected connections by reason')
+token_cache = registry.counter('chat_token_cache_total',
+                               'Verified token cache lookups by result')
+
+
+def _failure(reason: str, detail: str) -> AuthenticationError:
+    auth_failures.inc(reason=reason)
+    return AuthenticationError(detail)
+
 
 # from auth
 def verify_token(
@@ -36,7 +55,14 @@ def verify_token(
     return expected_type(**jwt.decode(token, secret, [algorithm, ], options=options))
 
 
-class AuthUser(BaseUser):
+def user_uuid(user_id: int) -> UUID:
+    """
+    uuid permissions of the user are keyed by
+    """
+    return uuid5(USER_NAMESPACE, str(user_id))
+
+
+class AuthenticatedUser(BaseUser):
 
     def __init__(
         self,
@@ -46,6 +72,7 @@ class AuthUser(BaseUser):
         super().__init__()
         self._identity: AccessTokenData = auth_data
         self._user = user
+        self._uuid = user_uuid(user.id)
 
     @property
     def is_authenticated(self) -> bool:
@@ -63,49 +90,111 @@ class AuthUser(BaseUser):
     def identity(self) -> AccessTokenData:
         return self._identity
 
+    @property
+    def user(self) -> User:
+        return self._user
+
+    @property
+    def uuid(self) -> UUID:
+        return self._uuid
+
 
 class AuthenticationManager(AuthenticationBackend):
+    """
+    verified tokens are cached until they expire or for token_ttl seconds,
+    users come from the batched profile directory
+    """
+
+    def __init__(self, users: UserDirectory, token_cache_size: int, token_ttl: float) -> None:
+        self.users: UserDirectory = users
+        self.tokens = TTLCache(token_cache_size, token_ttl)
+
     def _get_credentials(self, headers: Headers) -> str:
         authorization = headers.get('Authorization')
         if authorization:
             return authorization
-        raise AuthenticationError('Authorization requeued')
+        raise _failure('missing', 'Authorization requeued')
 
     def _get_token(self, credentials: str) -> str:
-        scheme, token = credentials.split()
-        if scheme == TOKEN_NAME:
+        scheme, _, token = credentials.partition(' ')
+        if scheme == TOKEN_NAME and token:
             return token
-        raise AuthenticationError('Invalid authorization scheme')
+        raise _failure('scheme', 'Invalid authorization scheme')
 
     def _decrypt_token_data(self, token: str) -> AccessTokenData:
+        token_data = self.tokens.get(token)
+        if token_data is not None:
+            token_cache.inc(result='hit')
+            return token_data
+        token_cache.inc(result='miss')
         try:
-            return verify_token(token, AccessTokenData, KEY, ALGORITHM)
+            token_data = verify_token(token, AccessTokenData, KEY, ALGORITHM)
         except (JWTError, ValidationError):
-            raise AuthenticationError('Token decode error')
+            raise _failure('decode', 'Token decode error')
+        self.tokens.set(token, token_data, (token_data.exp - datetime.now(timezone.utc)).total_seconds())
+        return token_data
 
     def _validate_token_data(self, token_data: AccessTokenData) -> None:
         if token_data.exp < datetime.now(timezone.utc):
-            raise AuthenticationError('Token expired')
+            raise _failure('expired', 'Token expired')
         if 'chat_access' not in token_data.pms:
-            raise AuthenticationError('Permission denied')
+            raise _failure('permission', 'Permission denied')
 
     async def authenticate(
         self, connection: HTTPConnection
-    ) -> tuple[AuthCredentials, AuthUser] | None:
+    ) -> tuple[AuthCredentials, AuthenticatedUser] | None:
         token_data = self._decrypt_token_data(
             self._get_token(self._get_credentials(connection.headers)))
         self._validate_token_data(token_data)
-        user = User(id=1, name='test_user')  # TODO: get user
-        return (AuthCredentials(['authenticated'].append(*token_data.pms)),
-                AuthUser(token_data, user))
+        user = await self.users.get(token_data.sub)
+        return (AuthCredentials(['authenticated', *token_data.pms]),
+                AuthenticatedUser(token_data, user))
+
+
+class SecurityManager:
+    """
+    permission checks go through the auto pipeline when there is one, checks of every
+    local socket for one channel message then share a round trip
+    """
+
+    def __init__(self, redis: Redis, pipelined: AutoPipeline | None = None) -> None:
+        self.redis: Redis = redis
+        self.pipelined: AutoPipeline | None = pipelined
+
+    async def is_permitted(self, permission: Permission) -> bool:
+        return bool(await (self.pipelined or self.redis).exists(permission.key))
+
+    async def load_channels_from_permissions(self,
+                                             user: User,
+                                             resource_type: type,
+                                             channels: set[str]) -> tuple[set[str], set[str]]:
+        """
+        channels to add and to revoke, the user chats come from the membership index in one call
+        """
+        prefix = f'{type_key(resource_type)}:'
+        permitted = set(f'{prefix}{chat}' for chat in await self.redis.smembers(RoleManager.chats_key(user.id)))
+        current = set(channel for channel in channels if channel.startswith(prefix))
+        return permitted - current, current - permitted
 
 
 class RoleManager:
+    """
+    roles are cached as Role:<user>:<chat> keys, members:<chat> and chats:<user>
+    sets index them in both directions and change in the same transaction
+    """
 
     def __init__(self, redis: Redis, user: User) -> None:
         self.redis: Redis = redis
         self.user: User = user
 
+    @staticmethod
+    def members_key(resource_uuid: UUID) -> str:
+        return f'members:{resource_uuid}'
+
+    @staticmethod
+    def chats_key(user_id: int) -> str:
+        return f'chats:{user_id}'
+
     async def reload_cache(self) -> tuple[Role, ...]:
         roles = (Role(resource=Chat(uuid=uuid4(), name='chat1', owner=10), user=self.user.id, level=RoleLevel.MODERATOR),  # TODO: load roles
                  Role(resource=Chat(uuid=uuid4(), name='chat2', owner=10), user=self.user.id, level=RoleLevel.MODERATOR))
@@ -113,14 +202,23 @@ class RoleManager:
         async with self.redis.pipeline() as pipe:
             for role in roles:
                 pipe.set(name=role.redis_key, value=role.level)
+                if role.level not in NOT_MEMBER_LEVELS:
+                    pipe.sadd(self.members_key(role.resource.uuid), self.user.id)
+                    pipe.sadd(self.chats_key(self.user.id), str(role.resource.uuid))
             await pipe.execute()
         return roles
 
     async def clear_cache(self) -> int:
         keys = await self.redis.keys(f'{Role.key_prefix}:{self.user.id}:*')
-        if keys:
-            return await self.redis.delete(*keys)
-        return 0
+        chats = await self.redis.smembers(self.chats_key(self.user.id))
+        async with self.redis.pipeline() as pipe:
+            if keys:
+                pipe.delete(*keys)
+            for chat in chats:
+                pipe.srem(self.members_key(chat), self.user.id)
+            pipe.delete(self.chats_key(self.user.id))
+            results = await pipe.execute()
+        return results[0] if keys else 0
 
     async def role(self, resource: HasUUID) -> RoleLevel:
         role = await self.redis.get(f'{Role.key_prefix}:{self.user.id}:{resource.uuid}')
@@ -129,5 +227,41 @@ class RoleManager:
         return RoleLevel[role.upper()]
 
     async def update(self, resource: HasUUID, role: RoleLevel) -> RoleLevel:
-        # TODO: implement
+        key = f'{Role.key_prefix}:{self.user.id}:{resource.uuid}'
+        async with self.redis.pipeline() as pipe:
+            if role == RoleLevel.UNSET:
+                pipe.delete(key)
+            else:
+                pipe.set(name=key, value=role)
+            if role in NOT_MEMBER_LEVELS:
+                pipe.srem(self.members_key(resource.uuid), self.user.id)
+                pipe.srem(self.chats_key(self.user.id), str(resource.uuid))
+            else:
+                pipe.sadd(self.members_key(resource.uuid), self.user.id)
+                pipe.sadd(self.chats_key(self.user.id), str(resource.uuid))
+            # open sockets of the user apply the change without reloading the rest
+            delta = PermissionDelta(resource_type=type_key(resource.__class__),
+                                    granted=[] if role in NOT_MEMBER_LEVELS else [resource.uuid],
+                                    revoked=[resource.uuid] if role in NOT_MEMBER_LEVELS else [])
+            pipe.publish(Permission.update_channel(user_uuid(self.user.id)), delta.json())
+            await pipe.execute()
         return role
+
+    @staticmethod
+    async def members(redis: Redis, resource_uuid: UUID) -> set[int]:
+        return set(int(user_id) for user_id in await redis.smembers(RoleManager.members_key(resource_uuid)))
+
+    @staticmethod
+    async def members_page(redis: Redis, resource_uuid: UUID, cursor: int, count: int) -> tuple[int, list[int]]:
+        """
+        SSCAN page, cursor 0 starts and ends the iteration, count is a hint
+        """
+        cursor, members = await redis.sscan(RoleManager.members_key(resource_uuid), cursor, count=count)
+        return cursor, [int(user_id) for user_id in members]
+
+    @staticmethod
+    async def are_members(redis: Redis, resource_uuid: UUID, user_ids: list[int]) -> dict[int, bool]:
+        if not user_ids:
+            return dict()
+        flags = await redis.smismember(RoleManager.members_key(resource_uuid), user_ids)
+        return dict((user_id, bool(flag)) for user_id, flag in zip(user_ids, flags))
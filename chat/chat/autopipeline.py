@@ -0,0 +1,81 @@
+import asyncio
+from typing import Any
+
+from redis.asyncio.client import Redis
+
+from metrics import registry
+
+auto_pipelined = registry.counter('chat_redis_auto_pipelined_total',
+                                  'Commands sent through auto pipelines')
+auto_pipeline_flushes = registry.counter('chat_redis_auto_pipeline_flushes_total',
+                                         'Round trips of auto pipelines, pipelined minus flushes were saved')
+
+
+class AutoPipeline:
+    """
+    commands issued by any coroutine during one event loop tick are sent together in
+    one non transactional pipeline of up to max_batch commands, every caller gets its
+    own reply or error
+    """
+
+    def __init__(self, client: Redis, max_batch: int) -> None:
+        self.client: Redis = client
+        self.max_batch: int = max_batch
+        self._pending: list[tuple[tuple[Any, ...], asyncio.Future]] = []
+        self._flushes: set[asyncio.Task] = set()
+
+    def execute_command(self, *args: Any) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not self._pending:
+            loop.call_soon(self._flush)
+        self._pending.append((args, future))
+        return future
+
+    def _flush(self) -> None:
+        pending, self._pending = self._pending, []
+        for i in range(0, len(pending), self.max_batch):
+            task = asyncio.create_task(self._send(pending[i:i + self.max_batch]), name='auto_pipeline_task')
+            self._flushes.add(task)
+            task.add_done_callback(self._flushes.discard)
+
+    async def _send(self, commands: list[tuple[tuple[Any, ...], asyncio.Future]]) -> None:
+        try:
+            async with self.client.pipeline(transaction=False) as pipe:
+                for args, _ in commands:
+                    pipe.execute_command(*args)
+                results = await pipe.execute(raise_on_error=False)
+        except Exception as error:
+            for _, future in commands:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        auto_pipelined.inc(len(commands))
+        auto_pipeline_flushes.inc()
+        for (_, future), result in zip(commands, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def exists(self, *names: str) -> int:
+        return await self.execute_command('EXISTS', *names)
+
+    async def get(self, name: str) -> Any:
+        return await self.execute_command('GET', name)
+
+    async def set(self, name: str, value: Any, ex: int | None = None, nx: bool = False) -> Any:
+        args: list[Any] = ['SET', name, value]
+        if ex is not None:
+            args.extend(('EX', ex))
+        if nx:
+            args.append('NX')
+        return await self.execute_command(*args)
+
+    async def delete(self, *names: str) -> int:
+        return await self.execute_command('DEL', *names)
+
+    async def publish(self, channel: str, message: Any) -> int:
+        return await self.execute_command('PUBLISH', channel, message)
@@ -0,0 +1,217 @@
+import asyncio
+import os
+import re
+from pathlib import Path
+from typing import AsyncIterator, BinaryIO
+from urllib.parse import quote
+from uuid import UUID, uuid4
+
+from pydantic import BaseModel
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from metrics import registry
+from schemas import Attachment
+
+attachment_bytes = registry.counter('chat_attachment_bytes_total',
+                                    'Attachment bytes by direction, upload or download')
+
+_CONTENT_RANGE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+_RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+
+
+class BlobError(Exception):
+    pass
+
+
+class StoredBlob(BaseModel):
+    uuid: UUID
+    chat: UUID
+    owner: int  # user id of the uploader
+    name: str
+    content_type: str
+    size: int  # declared when the upload starts
+    received: int = 0
+
+    @property
+    def complete(self) -> bool:
+        return self.received == self.size
+
+    def attachment(self) -> Attachment:
+        return Attachment(uuid=self.uuid, name=self.name, content_type=self.content_type, size=self.size)
+
+
+class FileBlobStore:
+    """
+    attachments as files under root with a json sidecar, uploads are appended in
+    chunks and can resume at the received offset after a broken connection,
+    file io runs in threads off the event loop
+    """
+
+    def __init__(self, root: str, max_size: int) -> None:
+        self.root: Path = Path(root)
+        self.max_size: int = max_size  # bytes
+        self._uploading: set[UUID] = set()
+
+    def path(self, blob_uuid: UUID) -> Path:
+        return self.root / blob_uuid.hex[:2] / blob_uuid.hex
+
+    def _meta_path(self, blob_uuid: UUID) -> Path:
+        return self.path(blob_uuid).with_suffix('.json')
+
+    def _save(self, blob: StoredBlob) -> None:
+        path = self._meta_path(blob.uuid)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_suffix('.tmp')
+        partial.write_text(blob.json())
+        partial.replace(path)
+
+    def _load(self, blob_uuid: UUID) -> StoredBlob | None:
+        try:
+            return StoredBlob.parse_raw(self._meta_path(blob_uuid).read_text())
+        except (OSError, ValueError):
+            return None
+
+    async def create(self, chat: UUID, owner: int, name: str, content_type: str, size: int) -> StoredBlob:
+        if not 0 < size <= self.max_size:
+            raise BlobError(f'size must be between 1 and {self.max_size} bytes')
+        blob = StoredBlob(uuid=uuid4(), chat=chat, owner=owner, name=name, content_type=content_type, size=size)
+        await asyncio.to_thread(self._save, blob)
+        return blob
+
+    async def get(self, blob_uuid: UUID) -> StoredBlob | None:
+        return await asyncio.to_thread(self._load, blob_uuid)
+
+    async def attachments(self, blob_uuids: list[UUID], chat: UUID, owner: int) -> list[Attachment] | None:
+        """
+        references of a new message, None unless every blob is a complete upload of the sender to the chat
+        """
+        blobs = await asyncio.gather(*(self.get(blob_uuid) for blob_uuid in blob_uuids))
+        if not all(blob and blob.complete and blob.chat == chat and blob.owner == owner for blob in blobs):
+            return None
+        return [blob.attachment() for blob in blobs]  # type: ignore
+
+    async def write(self, blob: StoredBlob, offset: int, chunks: AsyncIterator[bytes]) -> StoredBlob:
+        """
+        appends chunks at offset, which must be the received size, what arrived
+        before a broken stream is kept
+        """
+        if blob.uuid in self._uploading:
+            raise BlobError('upload already running')
+        self._uploading.add(blob.uuid)
+        try:
+            current = await self.get(blob.uuid) or blob
+            if offset != current.received:
+                raise BlobError(f'upload continues at {current.received}')
+            file: BinaryIO = await asyncio.to_thread(self._open, current.uuid, offset)
+            try:
+                async for chunk in chunks:
+                    if current.received + len(chunk) > current.size:
+                        raise BlobError(f'upload is larger than {current.size} bytes')
+                    await asyncio.to_thread(file.write, chunk)
+                    current.received += len(chunk)
+                    attachment_bytes.inc(len(chunk), direction='upload')
+            finally:
+                await asyncio.to_thread(file.close)
+                await asyncio.to_thread(self._save, current)
+            return current
+        finally:
+            self._uploading.discard(blob.uuid)
+
+    def _open(self, blob_uuid: UUID, offset: int) -> BinaryIO:
+        path = self.path(blob_uuid)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        file = open(path, 'r+b' if path.exists() else 'wb')
+        file.truncate(offset)
+        file.seek(offset)
+        return file
+
+
+def content_range_start(header: str | None) -> int:
+    """
+    first byte of a chunk from Content-Range: bytes <first>-<last>/<size>, 0 without one
+    """
+    if not header:
+        return 0
+    match = _CONTENT_RANGE.fullmatch(header.strip())
+    if match is None or int(match[2]) < int(match[1]):
+        raise BlobError('Content-Range must be bytes <first>-<last>/<size>')
+    return int(match[1])
+
+
+def byte_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    first byte and length of a single Range request, None for the whole blob
+    """
+    if not header:
+        return None
+    match = _RANGE.fullmatch(header.strip())
+    if match is None or not (match[1] or match[2]):
+        # multiple ranges are answered with the whole blob
+        return None
+    if not match[1]:
+        length = min(int(match[2]), size)
+        if not length:
+            raise BlobError('range not satisfiable')
+        return size - length, length
+    first = int(match[1])
+    last = min(int(match[2]), size - 1) if match[2] else size - 1
+    if first >= size or last < first:
+        raise BlobError('range not satisfiable')
+    return first, last - first + 1
+
+
+class BlobResponse(Response):
+    """
+    blob bytes with range support, sent zero copy where the server offers
+    the zerocopysend extension and in chunks read off the event loop otherwise
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: Path, blob: StoredBlob, range_header: str | None = None) -> None:
+        self.path: Path = path
+        self.offset, self.length = 0, blob.size
+        status_code = 200
+        headers = {'accept-ranges': 'bytes',
+                   'content-disposition': f"attachment; filename*=utf-8''{quote(blob.name)}"}
+        try:
+            requested = byte_range(range_header, blob.size)
+        except BlobError:
+            super().__init__(status_code=416, headers={'content-range': f'bytes */{blob.size}'})
+            self.length = 0
+            return
+        if requested is not None:
+            self.offset, self.length = requested
+            status_code = 206
+            headers['content-range'] = f'bytes {self.offset}-{self.offset + self.length - 1}/{blob.size}'
+        super().__init__(status_code=status_code, headers=headers, media_type=blob.content_type)
+        self.headers['content-length'] = str(self.length)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if not self.length or scope.get('method') == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+        file = await asyncio.to_thread(open, self.path, 'rb')
+        try:
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({'type': 'http.response.zerocopysend',
+                            'file': file,
+                            'offset': self.offset,
+                            'count': self.length,
+                            'more_body': False})
+                attachment_bytes.inc(self.length, direction='download')
+                return
+            offset, end = self.offset, self.offset + self.length
+            while offset < end:
+                size = min(self.chunk_size, end - offset)
+                chunk = await asyncio.to_thread(os.pread, file.fileno(), size, offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                attachment_bytes.inc(len(chunk), direction='download')
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': offset < end})
+            if offset < end:
+                await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await asyncio.to_thread(file.close)
@@ -0,0 +1,298 @@
+import json
+from enum import IntEnum, StrEnum, auto
+from typing import Any, Callable, Iterable
+from uuid import UUID
+
+import msgpack
+from pydantic import BaseModel
+from starlette.websockets import WebSocket
+
+from metrics import registry
+from schemas import (Attachment, ChatEvent, EventBatch, EventKind, Message, MessageAck,
+                     MessageStatus, MessageStatusBatch, NewMessage, PermissionDelta,
+                     PresenceBatch, Reconnect,
+                     UnreadCounts, UpdateMessage, User, UserStatus)
+
+MSGPACK_SUBPROTOCOL = 'chat.msgpack.v1'
+
+bytes_sent = registry.counter('chat_ws_payload_bytes_total',
+                              'Encoded websocket payload bytes before compression')
+
+
+class Encoding(StrEnum):
+    JSON = auto()
+    MSGPACK = auto()
+
+
+class FrameType(IntEnum):
+    MESSAGE = 1
+    NEW_MESSAGE = 2
+    UPDATE_MESSAGE = 3
+    MESSAGE_STATUS_BATCH = 4
+    PRESENCE_BATCH = 5
+    UNREAD_COUNTS = 6
+    CHAT_EVENT = 7
+    EVENT_BATCH = 8
+    RECONNECT = 9
+    MESSAGE_ACK = 10
+
+
+_USER_STATUSES = tuple(UserStatus)
+_EVENT_KINDS = tuple(EventKind)
+
+
+def _new_message(data: dict[str, Any]) -> NewMessage:
+    text, attachments, client_id = data['text'], data.get('attachments', []), data.get('client_id')
+    if not isinstance(text, str) or not isinstance(attachments, list):
+        raise TypeError('malformed new message')
+    return NewMessage.construct(receiver=UUID(data['receiver']),
+                                text=text,
+                                attachments=[UUID(attachment) for attachment in attachments],
+                                client_id=None if client_id is None else UUID(client_id))
+
+
+def _update_message(data: dict[str, Any]) -> UpdateMessage:
+    return UpdateMessage.construct(status=MessageStatus(data['status']), uuid=UUID(data['uuid']))
+
+
+def _attachment(data: dict[str, Any]) -> Attachment:
+    name, content_type, size = data['name'], data['content_type'], data['size']
+    if not isinstance(name, str) or not isinstance(content_type, str) or not isinstance(size, int):
+        raise TypeError('malformed attachment')
+    return Attachment.construct(uuid=UUID(data['uuid']), name=name, content_type=content_type, size=size)
+
+
+def _message(data: dict[str, Any]) -> Message:
+    sender, text, seq, sent_at = data['sender'], data['text'], data.get('seq', 0), data.get('sent_at', 0)
+    attachments = data.get('attachments', [])
+    if (not isinstance(text, str) or not isinstance(seq, int) or not isinstance(sent_at, (int, float))
+            or not isinstance(sender['name'], str) or not isinstance(attachments, list)):
+        raise TypeError('malformed message')
+    return Message.construct(receiver=UUID(data['receiver']),
+                             status=MessageStatus(data['status']),
+                             sender=User.construct(id=int(sender['id']), name=sender['name']),
+                             text=text,
+                             uuid=UUID(data['uuid']),
+                             seq=seq,
+                             sent_at=sent_at,
+                             attachments=[_attachment(attachment) for attachment in attachments])
+
+
+# type discriminator: frame class
+FRAME_CLASSES: dict[str, type[BaseModel]] = dict(
+    (frame_class.__fields__['type'].default, frame_class)
+    for frame_class in (Message, NewMessage, UpdateMessage, MessageStatusBatch, PresenceBatch, UnreadCounts,
+                        ChatEvent, EventBatch, Reconnect, PermissionDelta, MessageAck))
+
+# hot frames skip model validation, fields are checked by hand
+_FAST_PATHS: dict[type[BaseModel], Callable[[dict[str, Any]], BaseModel]] = {
+    NewMessage: _new_message,
+    UpdateMessage: _update_message,
+    Message: _message,
+}
+
+
+def _uuid(value: bytes | str) -> UUID:
+    # Lua scripts pack uuids as strings
+    if isinstance(value, bytes):
+        return UUID(bytes=value)
+    return UUID(value)
+
+
+def _msgpack_attachment(frame: list) -> Attachment:
+    name, content_type, size = frame[1], frame[2], frame[3]
+    if not isinstance(name, str) or not isinstance(content_type, str) or not isinstance(size, int):
+        raise TypeError('malformed attachment')
+    return Attachment.construct(uuid=_uuid(frame[0]), name=name, content_type=content_type, size=size)
+
+
+def _msgpack_message(frame: list) -> Message:
+    sender, text, seq = frame[3], frame[4], frame[6]
+    sent_at = frame[7] if len(frame) > 7 else 0
+    attachments = frame[8] if len(frame) > 8 else []
+    if (not isinstance(sender, int) or not isinstance(text, str) or not isinstance(seq, int)
+            or not isinstance(sent_at, (int, float)) or not isinstance(attachments, list)):
+        raise TypeError('malformed message')
+    return Message.construct(receiver=_uuid(frame[1]),
+                             status=MessageStatus.from_rank(frame[2]),
+                             sender=User.construct(id=sender, name=''),
+                             text=text,
+                             uuid=_uuid(frame[5]),
+                             seq=seq,
+                             sent_at=sent_at,
+                             attachments=[_msgpack_attachment(attachment) for attachment in attachments])
+
+
+def _msgpack_new_message(frame: list) -> NewMessage:
+    text = frame[2]
+    attachments = frame[3] if len(frame) > 3 else []
+    client_id = frame[4] if len(frame) > 4 else None
+    if not isinstance(text, str) or not isinstance(attachments, list):
+        raise TypeError('malformed new message')
+    return NewMessage.construct(receiver=_uuid(frame[1]),
+                                text=text,
+                                attachments=[_uuid(uuid) for uuid in attachments],
+                                client_id=_uuid(client_id) if client_id else None)
+
+
+def _msgpack_update_message(frame: list) -> UpdateMessage:
+    return UpdateMessage.construct(status=MessageStatus.from_rank(frame[1]), uuid=_uuid(frame[2]))
+
+
+# hot frames skip model validation, fields are checked by hand
+_MSGPACK_FAST_PATHS: dict[int, tuple[type[BaseModel], Callable[[list], BaseModel]]] = {
+    FrameType.MESSAGE: (Message, _msgpack_message),
+    FrameType.NEW_MESSAGE: (NewMessage, _msgpack_new_message),
+    FrameType.UPDATE_MESSAGE: (UpdateMessage, _msgpack_update_message),
+}
+
+
+class JsonCodec:
+    subprotocol: str | None = None
+    binary: bool = False
+
+    def encode(self, frame: BaseModel) -> str:
+        return frame.json()
+
+    def encode_batch(self, frames: list[BaseModel]) -> str:
+        return '[' + ','.join(frame.json() for frame in frames) + ']'
+
+    def decode(self, data: Any, classes: Iterable[type]) -> Any:
+        """
+        one json parse and one lookup on the type discriminator per frame
+        """
+        try:
+            if isinstance(data, (str, bytes)):
+                data = json.loads(data)
+            frame_class = FRAME_CLASSES[data['type']]
+            if frame_class not in classes:
+                return None
+            fast_path = _FAST_PATHS.get(frame_class)
+            if fast_path:
+                return fast_path(data)
+            return frame_class.parse_obj(data)
+        except (ValueError, TypeError, KeyError, AttributeError):  # pydantic ValidationError is ValueError
+            return None
+
+    async def send(self, websocket: WebSocket, frame: BaseModel) -> None:
+        data = self.encode(frame)
+        bytes_sent.inc(len(data.encode()))
+        await websocket.send_text(data)
+
+    async def send_batch(self, websocket: WebSocket, frames: list[BaseModel]) -> None:
+        data = self.encode_batch(frames)
+        bytes_sent.inc(len(data.encode()))
+        await websocket.send_text(data)
+
+
+class MsgpackCodec:
+    """
+    frames are arrays led by FrameType: uuids as 16 bytes, statuses as
+    MessageStatus.rank or UserStatus position, sender as user id only
+    """
+    subprotocol: str | None = MSGPACK_SUBPROTOCOL
+    binary: bool = True
+
+    def encode(self, frame: BaseModel) -> bytes:
+        return msgpack.packb(self._to_frame(frame))
+
+    def encode_batch(self, frames: list[BaseModel]) -> bytes:
+        """
+        batch is an array of frames, frame is an array led by FrameType
+        """
+        return msgpack.packb([self._to_frame(frame) for frame in frames])
+
+    @staticmethod
+    def _to_frame(frame: BaseModel) -> list:
+        match frame:
+            case Message():
+                return [FrameType.MESSAGE, frame.receiver.bytes, frame.status.rank,
+                        frame.sender.id, frame.text, frame.uuid.bytes, frame.seq, frame.sent_at,
+                        [[attachment.uuid.bytes, attachment.name, attachment.content_type, attachment.size]
+                         for attachment in frame.attachments]]
+            case NewMessage():
+                return [FrameType.NEW_MESSAGE, frame.receiver.bytes, frame.text,
+                        [attachment.bytes for attachment in frame.attachments],
+                        frame.client_id.bytes if frame.client_id else None]
+            case UpdateMessage():
+                return [FrameType.UPDATE_MESSAGE, frame.status.rank, frame.uuid.bytes]
+            case MessageStatusBatch():
+                return [FrameType.MESSAGE_STATUS_BATCH, frame.receiver.bytes,
+                        dict((UUID(uuid).bytes, status.rank)
+                             for uuid, status in frame.updates.items())]
+            case PresenceBatch():
+                return [FrameType.PRESENCE_BATCH, frame.receiver.bytes,
+                        dict((user_id, _USER_STATUSES.index(status))
+                             for user_id, status in frame.users.items())]
+            case UnreadCounts():
+                return [FrameType.UNREAD_COUNTS,
+                        dict((UUID(chat).bytes, count) for chat, count in frame.counts.items()),
+                        dict((UUID(chat).bytes, seq) for chat, seq in frame.cursors.items())]
+            case ChatEvent():
+                return [FrameType.CHAT_EVENT, frame.receiver.bytes, _EVENT_KINDS.index(frame.kind)]
+            case EventBatch():
+                return [FrameType.EVENT_BATCH, frame.receiver.bytes,
+                        dict((user_id, _EVENT_KINDS.index(kind)) for user_id, kind in frame.users.items())]
+            case Reconnect():
+                return [FrameType.RECONNECT, frame.delay]
+            case MessageAck():
+                return [FrameType.MESSAGE_ACK, frame.receiver.bytes, frame.client_id.bytes, frame.uuid.bytes]
+        raise TypeError(f'Unsupported frame type {frame.__class__.__name__}')
+
+    def decode(self, data: Any, classes: Iterable[type]) -> Any:
+        try:
+            frame = msgpack.unpackb(data, strict_map_key=False)
+            return self._from_frame(frame, tuple(classes))
+        except (ValueError, TypeError, IndexError, AttributeError, msgpack.UnpackException):
+            return None
+
+    @staticmethod
+    def _from_frame(frame: list, classes: tuple[type, ...]) -> Any:
+        fast_path = _MSGPACK_FAST_PATHS.get(frame[0])
+        if fast_path:
+            frame_class, decode = fast_path
+            return decode(frame) if frame_class in classes else None
+        match frame[0]:
+            case FrameType.MESSAGE_STATUS_BATCH if MessageStatusBatch in classes:
+                return MessageStatusBatch(receiver=_uuid(frame[1]),
+                                          updates=dict((str(_uuid(uuid)), MessageStatus.from_rank(rank))
+                                                       for uuid, rank in frame[2].items()))
+            case FrameType.PRESENCE_BATCH if PresenceBatch in classes:
+                return PresenceBatch(receiver=_uuid(frame[1]),
+                                     users=dict((user_id, _USER_STATUSES[status])
+                                                for user_id, status in frame[2].items()))
+            case FrameType.UNREAD_COUNTS if UnreadCounts in classes:
+                return UnreadCounts(counts=dict((str(_uuid(chat)), count) for chat, count in frame[1].items()),
+                                    cursors=dict((str(_uuid(chat)), seq) for chat, seq in frame[2].items()))
+            case FrameType.CHAT_EVENT if ChatEvent in classes:
+                return ChatEvent(receiver=_uuid(frame[1]), kind=_EVENT_KINDS[frame[2]])
+            case FrameType.EVENT_BATCH if EventBatch in classes:
+                return EventBatch(receiver=_uuid(frame[1]),
+                                  users=dict((user_id, _EVENT_KINDS[kind]) for user_id, kind in frame[2].items()))
+            case FrameType.RECONNECT if Reconnect in classes:
+                return Reconnect(delay=frame[1])
+            case FrameType.MESSAGE_ACK if MessageAck in classes:
+                return MessageAck(receiver=_uuid(frame[1]), client_id=_uuid(frame[2]), uuid=_uuid(frame[3]))
+        return None
+
+    async def send(self, websocket: WebSocket, frame: BaseModel) -> None:
+        data = self.encode(frame)
+        bytes_sent.inc(len(data))
+        await websocket.send_bytes(data)
+
+    async def send_batch(self, websocket: WebSocket, frames: list[BaseModel]) -> None:
+        data = self.encode_batch(frames)
+        bytes_sent.inc(len(data))
+        await websocket.send_bytes(data)
+
+
+codecs: dict[Encoding, JsonCodec | MsgpackCodec] = {
+    Encoding.JSON: JsonCodec(),
+    Encoding.MSGPACK: MsgpackCodec(),
+}
+
+
+def negotiate(subprotocols: Iterable[str]) -> JsonCodec | MsgpackCodec:
+    if MSGPACK_SUBPROTOCOL in subprotocols:
+        return codecs[Encoding.MSGPACK]
+    return codecs[Encoding.JSON]
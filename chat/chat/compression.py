@@ -0,0 +1,80 @@
+from typing import Any, Sequence
+
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets import frames
+from websockets.extensions.base import Extension
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate, ServerPerMessageDeflateFactory)
+from websockets.typing import ExtensionParameter
+
+from metrics import registry
+from settings import settings
+
+wire_bytes = registry.counter('chat_ws_wire_bytes_total',
+                              'Websocket data frame bytes written to sockets, after compression and framing')
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """
+    sends messages shorter than min_size uncompressed,
+    permessage-deflate allows it for every message
+    """
+
+    def __init__(self, *args: Any, min_size: int, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.min_size: int = min_size
+        self.encode_cont_data: bool = False
+
+    def encode(self, frame: frames.Frame) -> frames.Frame:
+        if frame.opcode in frames.CTRL_OPCODES:
+            return frame
+        if frame.opcode is not frames.OP_CONT:
+            self.encode_cont_data = len(frame.data) >= self.min_size
+        if not self.encode_cont_data:
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+
+    def __init__(self, *args: Any, min_size: int, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.min_size: int = min_size
+
+    def process_request_params(
+        self,
+        params: Sequence[ExtensionParameter],
+        accepted_extensions: Sequence[Extension],
+    ) -> tuple[list[ExtensionParameter], PerMessageDeflate]:
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(extension.remote_no_context_takeover,
+                                                           extension.local_no_context_takeover,
+                                                           extension.remote_max_window_bits,
+                                                           extension.local_max_window_bits,
+                                                           extension.compress_settings,
+                                                           min_size=self.min_size)
+
+
+class ChatWebSocketProtocol(WebSocketProtocol):
+    """
+    uvicorn websockets protocol with configurable permessage-deflate
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate:
+            self.available_extensions = [ThresholdPerMessageDeflateFactory(
+                server_max_window_bits=settings.compression.max_window_bits,
+                compress_settings={'level': settings.compression.level,
+                                   'memLevel': settings.compression.mem_level},
+                min_size=settings.compression.min_size)]
+
+    def write_frame_sync(self, fin: bool, opcode: int, data: bytes) -> None:
+        """
+        data frames are counted as written, chat_ws_payload_bytes_total counts them before deflate
+        """
+        frame = frames.Frame(frames.Opcode(opcode), data, fin)
+        serialized = frame.serialize(mask=self.is_client, extensions=self.extensions)
+        if frame.opcode not in frames.CTRL_OPCODES:
+            wire_bytes.inc(len(serialized))
+        self.transport.write(serialized)
@@ -1,10 +1,16 @@
-from redis import asyncio as aioredis
+from settings import settings
+from sharding import ShardedRedis
 
-redis = aioredis.from_url(
-    "redis://redis:6379",
-    encoding="utf-8",
-    decode_responses=True,
+shards = ShardedRedis(
+    settings.redis.urls,
+    settings.redis.virtual_nodes,
+    settings.redis.max_connections,
+    settings.redis.pool_timeout,
+    settings.redis.auto_pipeline_max,
     health_check_interval=1000,
     socket_connect_timeout=5,
     retry_on_timeout=True,
     socket_keepalive=True)
+
+# roles, permissions and presence are not sharded
+redis = shards.clients[shards.primary]
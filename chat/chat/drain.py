@@ -0,0 +1,62 @@
+import asyncio
+from math import ceil
+from random import shuffle, uniform
+from time import monotonic
+from typing import Awaitable, Callable
+
+from metrics import registry
+
+# reconnect delay in seconds: sends the control frame and closes the socket
+HandOff = Callable[[float], Awaitable[None]]
+
+draining_gauge = registry.gauge('chat_draining',
+                                '1 while the node hands its sockets off before a restart')
+handoffs = registry.counter('chat_handoffs_total',
+                            'Sockets asked to reconnect elsewhere while draining')
+
+
+class DrainController:
+    """
+    a draining node refuses new sockets and asks the local ones to reconnect in
+    waves, every client waits a random delay first, so the other nodes see a
+    spread out trickle instead of every socket at once
+    """
+
+    def __init__(self, waves: int, wave_interval: float, max_delay: float, timeout: float) -> None:
+        self.waves: int = waves
+        self.wave_interval: float = wave_interval  # seconds
+        self.max_delay: float = max_delay  # seconds
+        self.timeout: float = timeout  # seconds
+        self.draining: bool = False
+        self.connections: dict[str, HandOff] = dict()  # connection id: hand off
+        self._drain_task: asyncio.Task | None = None
+
+    def register(self, connection_id: str, hand_off: HandOff) -> None:
+        self.connections[connection_id] = hand_off
+
+    def unregister(self, connection_id: str) -> None:
+        self.connections.pop(connection_id, None)
+
+    def start(self) -> asyncio.Task:
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(self.drain(), name='drain_task')
+        return self._drain_task
+
+    async def drain(self) -> None:
+        self.draining = True
+        draining_gauge.set(1)
+        connections = list(self.connections.values())
+        shuffle(connections)
+        wave_size = max(1, ceil(len(connections) / self.waves))
+        hand_offs: list[asyncio.Task] = []
+        for i in range(0, len(connections), wave_size):
+            if i:
+                await asyncio.sleep(self.wave_interval)
+            hand_offs.extend(asyncio.create_task(hand_off(uniform(0, self.max_delay)))
+                             for hand_off in connections[i:i + wave_size])
+            handoffs.inc(len(connections[i:i + wave_size]))
+        await asyncio.gather(*hand_offs, return_exceptions=True)
+        # the last sockets leave on their own, subscriptions go with them
+        deadline = monotonic() + self.timeout
+        while self.connections and monotonic() < deadline:
+            await asyncio.sleep(0.1)
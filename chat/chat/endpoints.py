@@ -1,59 +1,98 @@
 import asyncio
 import json
-from dataclasses import asdict
 from functools import partial
+from time import time
 from typing import Any, Callable
 from uuid import UUID, uuid4
 
 from pydantic.json import pydantic_encoder
-from redis.asyncio.client import PubSub, Redis
+from redis.asyncio.client import Redis
 from starlette.authentication import requires
 from starlette.endpoints import WebSocketEndpoint
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.types import Message as StarletteMessage
 from starlette.types import Receive, Scope, Send
 from starlette.websockets import WebSocket
 
-from authentication import SecurityManager, AuthenticatedUser
+from admission import AdmissionController
+from authentication import RoleManager, SecurityManager, user_uuid
+from blobs import BlobError, BlobResponse, FileBlobStore, content_range_start
+from codec import Encoding, JsonCodec, MsgpackCodec, codecs, negotiate
 from connections import redis as global_redis
-from schemas import (CachedMessage, Chat, HasUUID, Message, MessageStatus,
-                     NewMessage, Permission, UpdateMessage, UserStatus)
-from utils import convert_json, to_type_object, type_key
+from connections import shards
+from drain import DrainController
+from events import EphemeralEvents
+from hub import PubSubHub, Subscriber
+from inbox import OfflineInbox
+from metrics import registry
+from presence import PresenceService
+from receipts import ReceiptAggregator
+from schemas import (CachedMessage, Chat, ChatEvent, EventBatch, HasUUID,
+                     Message, MessageAck, MessageStatus, MessageStatusBatch, NewMessage,
+                     Permission, PermissionDelta, PresenceBatch, Reconnect,
+                     UnreadCounts, UpdateMessage)
+from scripts import CLAIM_SEND, STATUS_TRANSITION
+from search import STREAM, SearchIndex
+from send_queue import SendQueue
+from settings import settings
+from sharding import ShardedRedis
+from tracing import Tracer
+from unread import UnreadCounters
+from users import UserDirectory
+from utils import convert_json, type_key
 
 CACHE_EXPIRE_TIME = 18000  # 5h
+MEMBERS_PAGE_SIZE = 500
+CLOSE_SERVICE_RESTART = 1012
+CLOSE_TRY_AGAIN_LATER = 1013
+
+active_connections = registry.gauge('chat_connections',
+                                    'Open chat websockets')
+delivery_latency = registry.histogram('chat_delivery_latency_seconds',
+                                      'Message accept to local send queue time, server clocks')
+duplicate_sends = registry.counter('chat_duplicate_sends_total',
+                                   'Retried new messages acknowledged without publishing them again')
+messages_rejected = registry.counter('chat_messages_rejected_total',
+                                     'New messages dropped by reason, too_long, too_many_attachments or attachments')
 
 
 class RedisChatEndpoint:
 
-    def __init__(self, redis: Redis) -> None:
+    def __init__(self,
+                 redis: Redis,
+                 shards: ShardedRedis,
+                 channel_codec: JsonCodec | MsgpackCodec = codecs[Encoding.JSON],
+                 hub: PubSubHub | None = None) -> None:
         self.redis: Redis = redis
-        self.pubsub: PubSub = self.redis.pubsub()
-        self.pubsub_listener: asyncio.Task | None = None
+        # chat channels and cached messages are sharded
+        self.shards: ShardedRedis = shards
+        self.channel_codec: JsonCodec | MsgpackCodec = channel_codec
+        self.hub: PubSubHub | None = hub
+        self.subscriptions: dict[str, Subscriber] = dict()
+        self.status_transitions = dict((shard, client.register_script(STATUS_TRANSITION))
+                                       for shard, client in self.shards.clients.items())
+        self.claim_sends = dict((shard, client.register_script(CLAIM_SEND))
+                                for shard, client in self.shards.clients.items())
 
-    async def listen(self) -> None:
-        async for data in self.pubsub.listen():  # type: ignore
-            print('unexpected data in listener', data)
+    async def subscribe(self, subscriptions: dict[str, Subscriber]) -> None:
+        self.subscriptions.update(subscriptions)
+        await self.hub.subscribe(subscriptions)  # type: ignore
 
-    def start_listener(self) -> None:
-        self.pubsub_listener = asyncio.create_task(
-            self.listen(), name=f'pubsub_listener_task_{self.pubsub}')
+    async def unsubscribe(self, *channels: str) -> None:
+        await self.hub.unsubscribe(dict((channel, self.subscriptions.pop(channel))  # type: ignore
+                                        for channel in channels
+                                        if channel in self.subscriptions))
 
-    def stop_listener(self) -> None:
-        if self.pubsub_listener:
-            self.pubsub_listener.cancel()
+    async def close(self) -> None:
+        await self.unsubscribe(*self.subscriptions)
 
-    async def subscribe(self, subscriptions: dict[str, Callable]) -> None:
-        await self.pubsub.subscribe(**subscriptions)
+    @property
+    def channels(self) -> set[str]:
+        return set(self.subscriptions)
 
     async def publish(self, channel: str, data: str) -> None:
-        await self.redis.publish(channel, data)
-
-    async def set_key(self, key: str, value: str, expr_delay: float | None = None) -> None:
-        await self.redis.set(name=key, value=value, ex=expr_delay)
-
-    async def get_key(self, key: str) -> Any:
-        return await self.redis.get(key)
-
-    async def delete_key(self, key: str) -> int:
-        return await self.redis.delete(key)
+        await self.shards.channel_client(channel).publish(channel, data)
 
     async def reset_channels(self,
                              add: set[str],
@@ -63,55 +102,223 @@ class RedisChatEndpoint:
         if add:
             tasks.add(self.subscribe(dict((x, callback) for x in add)))
         if revoke:
-            tasks.add(self.pubsub.unsubscribe(*revoke))
+            tasks.add(self.unsubscribe(*revoke))
         await asyncio.gather(*tasks)
 
     async def set_message(self, message: CachedMessage, expr_time: float) -> None:
-        await self.redis.set(
-            name=self.as_key(message),
-            value=json.dumps(message, default=pydantic_encoder),
-            ex=expr_time)
+        key = self.as_key(message)
+        # rides with the publish of the message, both live on the chat shard
+        await self.shards.pipelined(self.shards.shard(key)).set(key,
+                                                                json.dumps(message, default=pydantic_encoder),
+                                                                int(expr_time))
 
-    async def get_message(self, message_uuid: UUID, class_name: type = CachedMessage) -> CachedMessage | None:
-        cached_data = await self.redis.get(f'{type_key(class_name)}:{message_uuid}')
+    @staticmethod
+    def _parse_cached(cached_data: str | None) -> CachedMessage | None:
         if cached_data:
             json_data = convert_json(cached_data)
             if json_data:
                 try:
                     return CachedMessage(**json_data)
-                except TypeError as exception:
+                except (TypeError, ValueError) as exception:
                     return None
         return None
 
-    async def publish_message(self, message: Message, channel_type: type = Chat) -> int:
-        return await self.redis.publish(
-            channel=f'{type_key(channel_type)}:{message.receiver}',
-            message=json.dumps(message, default=pydantic_encoder))
+    async def get_message(self, message_uuid: UUID, class_name: type = CachedMessage) -> CachedMessage | None:
+        key = f'{type_key(class_name)}:{message_uuid}'
+        # fan-out of one status update looks the same message up from every local socket
+        return self._parse_cached(await self.shards.pipelined(self.shards.shard(key)).get(key))
+
+    async def get_messages(self,
+                           message_uuids: list[UUID],
+                           class_name: type = CachedMessage) -> list[CachedMessage | None]:
+        """
+        one MGET per shard
+        """
+        keys = [f'{type_key(class_name)}:{message_uuid}' for message_uuid in message_uuids]
+        groups = self.shards.group(keys)
+        results = await asyncio.gather(*(self.shards.clients[shard].mget(shard_keys)
+                                         for shard, shard_keys in groups.items()))
+        cached_data = dict()
+        for shard_keys, shard_data in zip(groups.values(), results):
+            cached_data.update(zip(shard_keys, shard_data))
+        return [self._parse_cached(cached_data[key]) for key in keys]
 
-    async def publish_message_update(self, message: UpdateMessage, receiver: UUID, channel_type: type = Chat) -> int:
-        return await self.redis.publish(
-            channel=f'{type_key(channel_type)}:{receiver}',
-            message=json.dumps(message, default=pydantic_encoder))
+    async def publish_message(self, message: Message, channel_type: type = Chat) -> int:
+        channel = f'{type_key(channel_type)}:{message.receiver}'
+        return await self.shards.pipelined(self.shards.channel_shard(channel)).publish(
+            channel, self.channel_codec.encode(message))
 
     async def cache_message(self, message: Message, expr_time: float) -> None:
         await asyncio.gather(self.set_message(CachedMessage(receiver=message.receiver,
                                                             status=message.status,
                                                             sender=message.sender,
-                                                            uuid=message.uuid),
+                                                            uuid=message.uuid,
+                                                            seq=message.seq),
                                               expr_time),
                              self.publish_message(message))
 
-    async def cache_message_update(self, message: CachedMessage, expr_time: float) -> None:
-        await asyncio.gather(self.set_message(message, expr_time),
-                             self.publish_message_update(UpdateMessage(status=message.status,
-                                                                       uuid=message.uuid),
-                                                         message.receiver))
+    async def transition_statuses(self,
+                                  updates: dict[UUID, MessageStatus],
+                                  expr_time: float,
+                                  class_name: type = CachedMessage,
+                                  channel_type: type = Chat) -> list[UUID]:
+        """
+        move cached messages forward and publish one status batch per chat in one server-side step,
+        message uuids are minted on the shard of their chat so one script call per shard is enough
+        """
+        statuses = dict((f'{type_key(class_name)}:{message_uuid}', status)
+                        for message_uuid, status in updates.items())
+        results = await asyncio.gather(*(
+            self.status_transitions[shard](
+                keys=keys,
+                args=[expr_time, type_key(channel_type), self.encoding,
+                      STREAM if settings.persistence.enabled else '', settings.search.stream_max_len,
+                      *(statuses[key].value for key in keys)])
+            for shard, keys in self.shards.group(list(statuses)).items()))
+        return [UUID(message_uuid) for updated in results for message_uuid in updated]
+
+    @staticmethod
+    def sent_key(user_id: int, client_id: UUID, chat: UUID) -> str:
+        # chat uuid goes last, the claim lives on the shard of the chat seq and cached messages
+        return f'sentmessage:{user_id}:{client_id}:{chat}'
+
+    async def claim_send(self, key: str, chat: UUID, message_uuid: UUID, window: int,
+                         class_name: type = CachedMessage) -> tuple[int | None, UUID | None]:
+        """
+        remembers the uuid of a new message under its client id and takes its seq,
+        a client id sent within the window gives no seq and the uuid of the earlier
+        message once it was cached, or no uuid while that send is still running
+        """
+        claimed, value = await self.claim_sends[self.shards.shard(key)](
+            keys=[key, f'chatseq:{chat}'],
+            args=[str(message_uuid), window, type_key(class_name)])
+        if claimed:
+            return int(value), None
+        return None, UUID(value) if value else None
+
+    async def release_send(self, key: str) -> None:
+        await self.shards.pipelined(self.shards.shard(key)).delete(key)
+
+    async def next_seq(self, chat: UUID) -> int:
+        key = f'chatseq:{chat}'
+        return await self.shards.client(key).incr(key)
+
+    def subscribed(self, channel_type: type = Chat) -> set[UUID]:
+        prefix = f'{type_key(channel_type)}:'
+        return set(UUID(channel[len(prefix):]) for channel in self.subscriptions
+                   if channel.startswith(prefix))
+
+    @property
+    def encoding(self) -> Encoding:
+        return Encoding.MSGPACK if self.channel_codec.binary else Encoding.JSON
 
     @staticmethod
     def as_key(object: HasUUID) -> str:
         return f'{type_key(object.__class__)}:{object.uuid}'
 
 
+CHANNEL_FRAMES = (Message, UpdateMessage, MessageStatusBatch, PresenceBatch, EventBatch)
+
+
+async def message_permitted(security: SecurityManager, message: Message) -> bool:
+    return await security.is_permitted(Permission(user_uuid=user_uuid(message.sender.id),
+                                                  resource_type=Chat,
+                                                  resource_uuid=message.receiver))
+
+
+async def update_permitted(security: SecurityManager, redis: RedisChatEndpoint, update: UpdateMessage) -> bool:
+    cached = await redis.get_message(update.uuid)
+    return cached is not None and await security.is_permitted(Permission(user_uuid=user_uuid(cached.sender.id),
+                                                                         resource_type=Chat,
+                                                                         resource_uuid=cached.receiver))
+
+
+channel_codec = codecs[settings.protocol.channel_encoding]
+room_redis = RedisChatEndpoint(global_redis, shards, channel_codec)
+room_security = SecurityManager(global_redis, shards.pipelined(shards.primary))
+
+
+async def prepare_room_message(channel_data: dict[str, Any]) -> None:
+    """
+    decodes a channel message of a large room once and runs the checks that don't
+    depend on the receiving socket, every socket of the room reuses the results
+    """
+    data = channel_data.get('data')
+    if not data:
+        return
+    obj = channel_codec.decode(data, CHANNEL_FRAMES)
+    match obj:
+        case Message():
+            channel_data['permitted'] = await message_permitted(room_security, obj)
+        case UpdateMessage():
+            channel_data['permitted'] = await update_permitted(room_security, room_redis, obj)
+    channel_data['decoded'] = obj
+
+
+hub = PubSubHub(shards,
+                channel_codec.binary,
+                settings.redis.max_pending,
+                settings.fanout.threshold,
+                prepare_room_message)
+
+unread = UnreadCounters(shards)
+
+receipts = ReceiptAggregator(RedisChatEndpoint(global_redis, shards, channel_codec),
+                             SecurityManager(global_redis, shards.pipelined(shards.primary)),
+                             settings.receipts.flush_interval,
+                             CACHE_EXPIRE_TIME,
+                             unread)
+
+presence = PresenceService(global_redis,
+                           shards,
+                           settings.server.node_id,
+                           settings.presence.ttl,
+                           settings.presence.interval,
+                           channel_codec)
+
+events = EphemeralEvents(shards,
+                         settings.events.interval,
+                         settings.events.rate,
+                         settings.events.burst,
+                         channel_codec)
+
+inbox = OfflineInbox(shards,
+                     presence,
+                     channel_codec,
+                     settings.inbox.max_size,
+                     settings.inbox.ttl,
+                     settings.inbox.page_size)
+
+search_index = SearchIndex(shards,
+                           settings.server.node_id,
+                           settings.search.group,
+                           settings.search.stream_max_len,
+                           settings.search.batch_size,
+                           settings.search.block,
+                           settings.search.claim_idle,
+                           settings.search.max_prefix_terms)
+
+tracer = Tracer(settings.tracing.sample_rate)
+
+admission = AdmissionController(settings.admission.rate,
+                                settings.admission.burst,
+                                settings.admission.max_handshakes,
+                                settings.admission.max_waiting,
+                                settings.admission.timeout)
+
+drain_controller = DrainController(settings.drain.waves,
+                                   settings.drain.wave_interval,
+                                   settings.drain.max_delay,
+                                   settings.drain.timeout)
+
+blobs = FileBlobStore(settings.attachments.root, settings.attachments.max_size)
+
+users = UserDirectory(global_redis,
+                      settings.auth.user_cache_size,
+                      settings.auth.user_ttl,
+                      settings.auth.user_lookup_window)
+
+
 class ChatEndpoint(WebSocketEndpoint):
     encoding = 'json'
 
@@ -121,82 +328,401 @@ class ChatEndpoint(WebSocketEndpoint):
                  send: Send,
                  redis: Redis = global_redis) -> None:
         super().__init__(scope, receive, send)
-        self.security = SecurityManager(redis)
-        self.redis = RedisChatEndpoint(redis)
+        self.security = SecurityManager(redis, shards.pipelined(shards.primary))
+        self.redis = RedisChatEndpoint(redis, shards, channel_codec, hub)
+        self.connection_id: str = uuid4().hex
+        self.codec: JsonCodec | MsgpackCodec = codecs[Encoding.JSON]
+        self.outbox: SendQueue | None = None
+        # live message uuids seen until the offline inbox is drained,
+        # recorded from the first subscribe on
+        self.live_uuids: set[UUID] | None = set()
+        self.inbox_uuids: set[UUID] = set()
+        self.connected: bool = False
+        # set once presence counts this socket, refused sockets never leave
+        self.present: bool = False
+
+    async def decode(self, websocket: WebSocket, message: StarletteMessage) -> Any:
+        if self.codec.binary:
+            return message.get('bytes') or message.get('text')
+        return await super().decode(websocket, message)
 
     @requires('authenticated')
     async def on_connect(self, websocket: WebSocket) -> None:
-        on_message_callback = partial(self.on_channel_message,
-                                      websocket=websocket)
+        if drain_controller.draining:
+            # refused before the handshake, the load balancer picks another node
+            await self.refuse(websocket, CLOSE_SERVICE_RESTART)
+            return
+        # a reconnect storm is delayed here instead of timing out redis calls
+        if not await admission.acquire():
+            await self.refuse(websocket, CLOSE_TRY_AGAIN_LATER)
+            return
+        try:
+            await self.handshake(websocket)
+        except Exception:
+            # starlette skips on_disconnect when on_connect raises
+            await self.leave(websocket)
+            raise
+        finally:
+            admission.release()
 
+    async def refuse(self, websocket: WebSocket, code: int) -> None:
+        """
+        a close before accept is answered with http 403, the client only sees the
+        close code on an accepted socket
+        """
+        await websocket.accept(subprotocol=negotiate(websocket.scope.get('subprotocols', [])).subprotocol)
+        await websocket.close(code)
+
+    async def handshake(self, websocket: WebSocket) -> None:
+        self.codec = negotiate(websocket.scope.get('subprotocols', []))
+        batching = settings.batching.enabled and websocket.query_params.get('batch') == '1'
+        self.outbox = SendQueue(partial(self.codec.send, websocket),
+                                websocket.close,
+                                settings.send_queue.max_size,
+                                settings.send_queue.overflow_policy,
+                                settings.send_queue.close_code,
+                                self.connection_id,
+                                partial(self.codec.send_batch, websocket) if batching else None,
+                                settings.batching.window,
+                                settings.batching.max_frames)
+        # permission changes arriving from here on are applied as deltas
         await asyncio.gather(
-            websocket.accept(),
+            websocket.accept(subprotocol=self.codec.subprotocol),
             self.redis.subscribe({Permission.update_channel(websocket.user.uuid):
-                                  partial(self.redis.reset_channels,
-                                          *await self.security.load_channels_from_permissions(websocket.user.user,
-                                                                                              Chat,
-                                                                                              self.redis.pubsub.channels),
-                                          callback=on_message_callback)}),
-            # will silently fail second subscribe job
-            # self.redis.reset_channels(*await self.security.load_channels_from_permissions(websocket.user.user,
-            #                                                                               Chat,
-            #                                                                               self.redis.pubsub.channels),
-            #                           callback=on_message_callback),
-            self.redis.set_key(key=RedisChatEndpoint.as_key(websocket.user.user),
-                               value=json.dumps(UserStatus.ONLINE, default=pydantic_encoder)))
+                                  partial(self.on_permission_update, websocket=websocket)}),
+        )
         await self.redis.reset_channels(*await self.security.load_channels_from_permissions(websocket.user.user,
                                                                                             Chat,
-                                                                                            self.redis.pubsub.channels),
-                                        callback=on_message_callback)
-        self.redis.start_listener()
-
-    async def on_receive(self, websocket: WebSocket, data: dict[str, Any]) -> None:
-        obj = to_type_object(data, (NewMessage, UpdateMessage))
-        match obj:
-            case NewMessage():
-                if await self.security.is_permitted(Permission(user_uuid=websocket.user.uuid,
-                                                               resource_type=Chat,
-                                                               resource_uuid=obj.receiver)):
-                    await self.redis.cache_message(Message(receiver=obj.receiver,
-                                                           status=MessageStatus.SENT,
-                                                           sender=websocket.user.user,
-                                                           text=obj.text,
-                                                           uuid=uuid4()),
-                                                   CACHE_EXPIRE_TIME)
-            case UpdateMessage():
-                cached = await self.redis.get_message(obj.uuid)
-                if cached and await self.security.is_permitted(Permission(user_uuid=cached.sender.uuid,
-                                                                          resource_type=Chat,
-                                                                          resource_uuid=cached.receiver)):
-                    await self.redis.cache_message_update(CachedMessage(receiver=cached.receiver,
-                                                                        status=obj.status,
-                                                                        sender=cached.sender,
-                                                                        uuid=cached.uuid),
-                                                          CACHE_EXPIRE_TIME)
-            case _:
-                pass
+                                                                                            self.redis.channels),
+                                        callback=partial(self.on_channel_message, websocket=websocket))
+        # live frames wait in the outbox until the inbox is drained
+        await presence.connect(websocket.user.user.id, self.redis.subscribed())
+        self.present = True
+        counts, cursors = await unread.counts(websocket.user.user.id)
+        unread_counts = UnreadCounts(counts=counts, cursors=cursors)
+        if batching:
+            await self.codec.send_batch(websocket, [unread_counts])
+        else:
+            await self.codec.send(websocket, unread_counts)
+        await self.catch_up(websocket, batching)
+        self.live_uuids = None
+        self.outbox.start()
+        self.connected = True
+        active_connections.inc()
+        drain_controller.register(self.connection_id, partial(self.hand_off, websocket))
+
+    async def hand_off(self, websocket: WebSocket, delay: float) -> None:
+        self.outbox.put(Reconnect(delay=delay))  # type: ignore
+        await asyncio.sleep(settings.drain.close_grace)
+        await websocket.close(CLOSE_SERVICE_RESTART)
+
+    async def catch_up(self, websocket: WebSocket, batching: bool) -> None:
+        chats = self.redis.subscribed()
+
+        async def deliver(messages: list[Message]) -> None:
+            page = [message for message in messages
+                    if message.receiver in chats
+                    and message.uuid not in self.live_uuids  # type: ignore
+                    and message.uuid not in self.inbox_uuids]
+            self.inbox_uuids.update(message.uuid for message in page)
+            if batching:
+                for i in range(0, len(page), settings.batching.max_frames):
+                    await self.codec.send_batch(websocket, page[i:i + settings.batching.max_frames])
+            else:
+                for message in page:
+                    await self.codec.send(websocket, message)
+
+        await inbox.drain(websocket.user.user.id, deliver)
+
+    async def on_receive(self, websocket: WebSocket, data: Any) -> None:
+        with tracer.span('on_receive'):
+            with tracer.span('on_receive.decode'):
+                obj = self.codec.decode(data, (NewMessage, UpdateMessage, ChatEvent))
+            match obj:
+                case NewMessage():
+                    # one huge text would be copied to every subscriber and socket of the chat
+                    if len(obj.text) > settings.limits.max_text_length:
+                        messages_rejected.inc(reason='too_long')
+                        return
+                    if len(obj.attachments) > settings.limits.max_attachments:
+                        messages_rejected.inc(reason='too_many_attachments')
+                        return
+                    with tracer.span('on_receive.permission'):
+                        permitted = await self.security.is_permitted(Permission(user_uuid=websocket.user.uuid,
+                                                                                resource_type=Chat,
+                                                                                resource_uuid=obj.receiver))
+                    attachments = []
+                    if permitted and obj.attachments:
+                        attachments = await blobs.attachments(obj.attachments, obj.receiver, websocket.user.user.id)
+                        if attachments is None:
+                            messages_rejected.inc(reason='attachments')
+                            return
+                    if permitted:
+                        message_uuid = shards.mint_uuid(obj.receiver)
+                        if obj.client_id is not None:
+                            sent_key = self.redis.sent_key(websocket.user.user.id, obj.client_id, obj.receiver)
+                            with tracer.span('on_receive.dedup'):
+                                seq, original = await self.redis.claim_send(sent_key, obj.receiver, message_uuid,
+                                                                            settings.dedup.window)
+                            if seq is None:
+                                # a retry of a send still running is acked once it is retried again
+                                if original is not None:
+                                    duplicate_sends.inc()
+                                    self.outbox.put(MessageAck(receiver=obj.receiver,  # type: ignore
+                                                               client_id=obj.client_id,
+                                                               uuid=original))
+                                return
+                        else:
+                            with tracer.span('on_receive.seq'):
+                                seq = await self.redis.next_seq(obj.receiver)
+                        try:
+                            message = Message(receiver=obj.receiver,
+                                              status=MessageStatus.SENT,
+                                              sender=websocket.user.user,
+                                              text=obj.text,
+                                              uuid=message_uuid,
+                                              seq=seq,
+                                              sent_at=time(),
+                                              attachments=attachments)
+                            with tracer.span('on_receive.publish'):
+                                await asyncio.gather(self.redis.cache_message(message, CACHE_EXPIRE_TIME),
+                                                     self.track_members(message),
+                                                     search_index.append(message))
+                        except Exception:
+                            # a retry of a failed send must be published
+                            if obj.client_id is not None:
+                                await self.redis.release_send(sent_key)
+                            raise
+                        if obj.client_id is not None:
+                            self.outbox.put(MessageAck(receiver=obj.receiver,  # type: ignore
+                                                       client_id=obj.client_id,
+                                                       uuid=message.uuid))
+                case UpdateMessage():
+                    receipts.add(websocket.user.uuid, obj, websocket.user.user.id)
+                case ChatEvent():
+                    # subscribed chats are the permitted ones, no lookup per keystroke
+                    events.add(websocket.user.user.id, obj, self.redis.subscriptions)
+                case _:
+                    pass
+
+    async def track_members(self, message: Message) -> None:
+        members = await RoleManager.members(self.redis.redis, message.receiver)
+        members.discard(message.sender.id)
+        await asyncio.gather(inbox.store(members, message),
+                             unread.increment(members, message.receiver, message.seq))
 
     async def on_disconnect(self, websocket: WebSocket, close_code: int):
-        if isinstance(websocket.user, AuthenticatedUser):
-            await self.redis.delete_key(RedisChatEndpoint.as_key(websocket.user.user))
-        self.redis.stop_listener()
+        await self.leave(websocket)
+
+    async def leave(self, websocket: WebSocket) -> None:
+        """
+        undoes as much of the handshake as had run
+        """
+        if self.present:
+            self.present = False
+            presence.disconnect(websocket.user.user.id)
+        await self.redis.close()
+        if self.outbox:
+            self.outbox.stop()
+        if self.connected:
+            active_connections.dec()
+            drain_controller.unregister(self.connection_id)
+
+    async def on_permission_update(self, channel_data: dict[str, Any], websocket: WebSocket) -> None:
+        """
+        a delta subscribes to granted chats and drops revoked ones, the hub only sends
+        SUBSCRIBE for chats no other local socket has, anything else reloads the whole set
+        """
+        callback = partial(self.on_channel_message, websocket=websocket)
+        delta = codecs[Encoding.JSON].decode(channel_data.get('data') or b'', (PermissionDelta,))
+        if delta is None:
+            await self.redis.reset_channels(*await self.security.load_channels_from_permissions(websocket.user.user,
+                                                                                                Chat,
+                                                                                                self.redis.channels),
+                                            callback=callback)
+            return
+        if delta.resource_type != type_key(Chat):
+            return
+        channels = self.redis.channels
+        granted = set(f'{type_key(Chat)}:{chat}' for chat in delta.granted)
+        revoked = set(f'{type_key(Chat)}:{chat}' for chat in delta.revoked)
+        await self.redis.reset_channels(granted - revoked - channels, revoked & channels, callback=callback)
 
     async def on_channel_message(self, channel_data: dict[str, Any], websocket: WebSocket) -> None:
         data = channel_data.get('data')
-        if data:
-            obj = to_type_object(convert_json(str(data)),
-                                 (Message, UpdateMessage))
+        if not data:
+            return
+        with tracer.span('on_channel_message'):
+            # large rooms come decoded and checked once for every local socket
+            if 'decoded' in channel_data:
+                obj = channel_data['decoded']
+            else:
+                with tracer.span('on_channel_message.decode'):
+                    obj = self.redis.channel_codec.decode(data, CHANNEL_FRAMES)
+            permitted = channel_data.get('permitted')
             match obj:
                 case Message():
-                    if await self.security.is_permitted(Permission(user_uuid=obj.sender.uuid,
-                                                                   resource_type=Chat,
-                                                                   resource_uuid=obj.receiver)):
-                        await websocket.send_json(asdict(obj))
+                    if obj.uuid in self.inbox_uuids:
+                        return
+                    if self.live_uuids is not None:
+                        self.live_uuids.add(obj.uuid)
+                    if permitted is None:
+                        with tracer.span('on_channel_message.permission'):
+                            permitted = await message_permitted(self.security, obj)
+                    if permitted:
+                        if obj.sent_at:
+                            delivery_latency.observe(time() - obj.sent_at)
+                        self.outbox.put(obj)  # type: ignore
                 case UpdateMessage():
-                    cached = await self.redis.get_message(obj.uuid)
-                    if cached and await self.security.is_permitted(Permission(user_uuid=cached.sender.uuid,
-                                                                              resource_type=Chat,
-                                                                              resource_uuid=cached.receiver)):
-                        await websocket.send_json(asdict(obj))
+                    if permitted is None:
+                        with tracer.span('on_channel_message.permission'):
+                            permitted = await update_permitted(self.security, self.redis, obj)
+                    if permitted:
+                        self.outbox.put(obj,  # type: ignore
+                                        coalesce_key=(UpdateMessage, obj.uuid))
+                case MessageStatusBatch() | PresenceBatch():
+                    with tracer.span('on_channel_message.permission'):
+                        permitted = await self.security.is_permitted(Permission(user_uuid=websocket.user.uuid,
+                                                                                resource_type=Chat,
+                                                                                resource_uuid=obj.receiver))
+                    if permitted:
+                        self.outbox.put(obj)  # type: ignore
+                case EventBatch():
+                    # the batch may be shared with the other sockets of the node
+                    users = dict((user_id, kind) for user_id, kind in obj.users.items()
+                                 if user_id != websocket.user.user.id)
+                    if users:
+                        # a newer batch replaces a queued one, they are dropped first under pressure
+                        self.outbox.put(EventBatch(receiver=obj.receiver, users=users),  # type: ignore
+                                        coalesce_key=(EventBatch, obj.receiver))
                 case _:
                     pass
+
+
+async def metrics(request: Request) -> PlainTextResponse:
+    return PlainTextResponse(registry.collect())
+
+
+async def readiness(request: Request) -> PlainTextResponse:
+    if drain_controller.draining:
+        return PlainTextResponse('draining', status_code=503)
+    return PlainTextResponse('ready')
+
+
+async def start_drain(request: Request) -> PlainTextResponse:
+    # for a pre-stop hook on the same host
+    if request.client is None or request.client.host not in ('127.0.0.1', '::1'):
+        return PlainTextResponse('forbidden', status_code=403)
+    drain_controller.start()
+    return PlainTextResponse('draining', status_code=202)
+
+
+@requires('authenticated')
+async def presence_statuses(request: Request) -> JSONResponse:
+    try:
+        user_ids = [int(user_id) for user_id in request.query_params.get('users', '').split(',') if user_id]
+    except ValueError:
+        return JSONResponse({'detail': 'users must be comma separated user ids'}, status_code=400)
+    if len(user_ids) > MEMBERS_PAGE_SIZE:
+        return JSONResponse({'detail': f'at most {MEMBERS_PAGE_SIZE} users per request'}, status_code=400)
+    statuses = await presence.statuses(user_ids)
+    return JSONResponse(dict((user_id, status.value) for user_id, status in statuses.items()))
+
+
+@requires('authenticated')
+async def unread_counts(request: Request) -> Response:
+    counts, cursors = await unread.counts(request.user.user.id)
+    return Response(UnreadCounts(counts=counts, cursors=cursors).json(), media_type='application/json')
+
+
+@requires('authenticated')
+async def chat_members(request: Request) -> JSONResponse:
+    chat: UUID = request.path_params['chat']
+    try:
+        cursor = int(request.query_params.get('cursor', 0))
+        count = min(int(request.query_params.get('count', MEMBERS_PAGE_SIZE)), MEMBERS_PAGE_SIZE)
+    except ValueError:
+        return JSONResponse({'detail': 'cursor and count must be integers'}, status_code=400)
+    if not (await RoleManager.are_members(global_redis, chat, [request.user.user.id]))[request.user.user.id]:
+        return JSONResponse({'detail': 'Permission denied'}, status_code=403)
+    cursor, members = await RoleManager.members_page(global_redis, chat, cursor, count)
+    return JSONResponse({'cursor': cursor, 'members': members})
+
+
+@requires('authenticated')
+async def chat_members_check(request: Request) -> JSONResponse:
+    chat: UUID = request.path_params['chat']
+    try:
+        user_ids = [int(user_id) for user_id in request.query_params.get('users', '').split(',') if user_id]
+    except ValueError:
+        return JSONResponse({'detail': 'users must be comma separated user ids'}, status_code=400)
+    if len(user_ids) > MEMBERS_PAGE_SIZE:
+        return JSONResponse({'detail': f'at most {MEMBERS_PAGE_SIZE} users per request'}, status_code=400)
+    # requester is checked in the same SMISMEMBER call
+    flags = await RoleManager.are_members(global_redis, chat, [request.user.user.id, *user_ids])
+    if not flags[request.user.user.id]:
+        return JSONResponse({'detail': 'Permission denied'}, status_code=403)
+    return JSONResponse(dict((user_id, flags[user_id]) for user_id in user_ids))
+
+
+@requires('authenticated')
+async def search_messages(request: Request) -> Response:
+    chat: UUID = request.path_params['chat']
+    try:
+        before = int(request.query_params['before']) if 'before' in request.query_params else None
+        limit = min(int(request.query_params.get('limit', settings.search.page_size)), settings.search.page_size)
+    except ValueError:
+        return JSONResponse({'detail': 'before and limit must be integers'}, status_code=400)
+    if not (await RoleManager.are_members(global_redis, chat, [request.user.user.id]))[request.user.user.id]:
+        return JSONResponse({'detail': 'Permission denied'}, status_code=403)
+    messages, cursor = await search_index.search(chat, request.query_params.get('q', ''), limit, before)
+    return Response(json.dumps({'messages': messages, 'cursor': cursor}, default=pydantic_encoder),
+                    media_type='application/json')
+
+
+@requires('authenticated')
+async def create_attachment(request: Request) -> JSONResponse:
+    """
+    starts an upload, the bytes follow in one or more PUT requests
+    """
+    chat: UUID = request.path_params['chat']
+    try:
+        data = await request.json()
+        name, content_type, size = str(data['name']), str(data['content_type']), int(data['size'])
+    except (ValueError, TypeError, KeyError):
+        return JSONResponse({'detail': 'name, content_type and size are required'}, status_code=400)
+    if not (await RoleManager.are_members(global_redis, chat, [request.user.user.id]))[request.user.user.id]:
+        return JSONResponse({'detail': 'Permission denied'}, status_code=403)
+    try:
+        blob = await blobs.create(chat, request.user.user.id, name, content_type, size)
+    except BlobError as error:
+        return JSONResponse({'detail': str(error)}, status_code=413)
+    return JSONResponse({'uuid': str(blob.uuid), 'received': blob.received}, status_code=201)
+
+
+@requires('authenticated')
+async def upload_attachment(request: Request) -> JSONResponse:
+    """
+    appends the request body at the first byte of Content-Range, a broken
+    upload resumes at the received offset
+    """
+    blob = await blobs.get(request.path_params['attachment'])
+    if blob is None or blob.owner != request.user.user.id:
+        return JSONResponse({'detail': 'Not found'}, status_code=404)
+    try:
+        blob = await blobs.write(blob, content_range_start(request.headers.get('content-range')), request.stream())
+    except BlobError as error:
+        current = await blobs.get(blob.uuid)
+        return JSONResponse({'detail': str(error), 'received': current.received if current else 0},
+                            status_code=409)
+    return JSONResponse({'uuid': str(blob.uuid), 'received': blob.received, 'complete': blob.complete})
+
+
+@requires('authenticated')
+async def download_attachment(request: Request) -> Response:
+    blob = await blobs.get(request.path_params['attachment'])
+    if blob is None or not blob.complete:
+        return JSONResponse({'detail': 'Not found'}, status_code=404)
+    if not (await RoleManager.are_members(global_redis, blob.chat, [request.user.user.id]))[request.user.user.id]:
+        return JSONResponse({'detail': 'Permission denied'}, status_code=403)
+    return BlobResponse(blobs.path(blob.uuid), blob, request.headers.get('range'))
@@ -0,0 +1,93 @@
+import asyncio
+from time import monotonic
+from typing import Any, Container
+from uuid import UUID
+
+from redis.exceptions import RedisError
+
+from codec import JsonCodec, MsgpackCodec
+from metrics import registry
+from ratelimit import TokenBucket
+from schemas import Chat, ChatEvent, EventBatch, EventKind
+from sharding import ShardedRedis
+from utils import type_key
+
+events_limited = registry.counter('chat_events_limited_total',
+                                  'Ephemeral events over the per user and chat rate')
+events_published = registry.counter('chat_event_batches_total',
+                                    'Ephemeral event batches published, at most one per chat and tick')
+
+
+class EphemeralEvents:
+    """
+    typing and activity events of local users limited per user and chat by a token
+    bucket, the latest event of every user is kept per chat and published once per
+    tick on the chat channel, nothing is cached or stored
+    """
+
+    def __init__(self,
+                 shards: ShardedRedis,
+                 interval: float,
+                 rate: float,
+                 burst: float,
+                 channel_codec: JsonCodec | MsgpackCodec) -> None:
+        self.shards: ShardedRedis = shards
+        self.interval: float = interval
+        self.rate: float = rate
+        self.burst: float = burst
+        self.channel_codec: JsonCodec | MsgpackCodec = channel_codec
+        self.pending: dict[UUID, dict[int, EventKind]] = dict()  # chat: user id: event
+        self.buckets: dict[tuple[int, UUID], TokenBucket] = dict()  # (user id, chat): bucket
+        self._ticker: asyncio.Task | None = None
+
+    def add(self, user_id: int, event: ChatEvent, channels: Container[str] | None = None) -> bool:
+        """
+        an event over the rate or for a chat outside channels, if given, is dropped
+        """
+        bucket = self.buckets.get((user_id, event.receiver))
+        if bucket is None:
+            bucket = self.buckets[(user_id, event.receiver)] = TokenBucket(self.rate, self.burst)
+        if not bucket.take():
+            events_limited.inc()
+            return False
+        if channels is not None and f'{type_key(Chat)}:{event.receiver}' not in channels:
+            return False
+        self.pending.setdefault(event.receiver, dict())[user_id] = event.kind
+        if self._ticker is None:
+            self._ticker = asyncio.create_task(self._run(), name='events_ticker_task')
+        return True
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except RedisError:
+                # events are ephemeral, a lost tick is not retried
+                pass
+
+    async def tick(self) -> None:
+        pending, self.pending = self.pending, dict()
+        now = monotonic()
+        # buckets back to full behave like new ones
+        for key in [key for key, bucket in self.buckets.items() if bucket.full(now)]:
+            del self.buckets[key]
+        if not pending:
+            return
+        frames = dict((f'{type_key(Chat)}:{chat}',
+                       self.channel_codec.encode(EventBatch(receiver=chat, users=users)))
+                      for chat, users in pending.items())
+        await asyncio.gather(*(self._publish(shard, dict((channel, frames[channel]) for channel in channels))
+                               for shard, channels in self.shards.group_channels(list(frames)).items()))
+        events_published.inc(len(frames))
+
+    async def _publish(self, shard: str, frames: dict[str, Any]) -> None:
+        async with self.shards.clients[shard].pipeline(transaction=False) as pipe:
+            for channel, frame in frames.items():
+                pipe.publish(channel, frame)
+            await pipe.execute()
+
+    def stop(self) -> None:
+        if self._ticker:
+            self._ticker.cancel()
+            self._ticker = None
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+from collections import deque
+from functools import partial
+from typing import Any, Awaitable, Callable
+
+from redis.asyncio.client import PubSub
+from redis.exceptions import RedisError
+
+from metrics import registry
+from sharding import ShardedRedis
+
+Subscriber = Callable[[dict[str, Any]], Awaitable[None]]
+# runs once per channel message of a large room, before any subscriber sees it
+Prepare = Callable[[dict[str, Any]], Awaitable[None]]
+
+hub_dropped = registry.counter('chat_hub_dropped_total',
+                               'Channel messages dropped for subscribers that fell behind')
+subscribed_channels = registry.gauge('chat_subscribed_channels',
+                                     'Channels the process is subscribed to')
+large_rooms = registry.gauge('chat_large_rooms',
+                             'Channels delivered through a room worker of this process')
+room_fan_outs = registry.counter('chat_room_fan_outs_total',
+                                 'Channel messages prepared once for all local subscribers of a large room')
+listener_errors = registry.counter('chat_hub_listener_errors_total',
+                                  'Shard pub/sub connections lost by the listener')
+
+logger = logging.getLogger(__name__)
+
+# seconds a shard listener waits before reading again, doubled per failure in a row
+LISTEN_BACKOFF = 0.1
+LISTEN_BACKOFF_MAX = 5.0
+
+
+class _Mailbox:
+    """
+    bounded queue of one subscriber drained by its own task,
+    the oldest message goes when a slow subscriber falls max_size behind
+    """
+
+    def __init__(self, subscriber: Subscriber, max_size: int) -> None:
+        self.subscriber: Subscriber = subscriber
+        self.max_size: int = max_size
+        self.channels: int = 0
+        self._items: deque[dict[str, Any]] = deque()
+        self._ready = asyncio.Event()
+        self._worker = asyncio.create_task(self._drain(), name='pubsub_subscriber_task')
+
+    def put(self, message: dict[str, Any]) -> None:
+        if len(self._items) >= self.max_size:
+            self._items.popleft()
+            hub_dropped.inc()
+        self._items.append(message)
+        self._ready.set()
+
+    async def _drain(self) -> None:
+        while True:
+            await self._ready.wait()
+            while self._items:
+                try:
+                    await self.subscriber(self._items.popleft())
+                except Exception:
+                    # a failing subscriber must not stop its mailbox
+                    pass
+            self._ready.clear()
+
+    def close(self) -> None:
+        self._worker.cancel()
+
+
+class PubSubHub:
+    """
+    one pub/sub connection per redis shard shared by all sockets of the process,
+    a channel is subscribed while at least one local subscriber needs it,
+    the shard listener only hands messages over to subscriber mailboxes,
+    a channel with fan_out_threshold local subscribers becomes a large room, its
+    messages go through one room worker that prepares them once for all subscribers
+    """
+
+    def __init__(self,
+                 shards: ShardedRedis,
+                 binary: bool,
+                 max_pending: int,
+                 fan_out_threshold: int = 0,
+                 prepare: Prepare | None = None) -> None:
+        self.shards: ShardedRedis = shards
+        self.binary: bool = binary
+        self.max_pending: int = max_pending
+        self.fan_out_threshold: int = fan_out_threshold
+        self.prepare: Prepare | None = prepare
+        self.pubsubs: dict[str, PubSub] = dict()  # shard: pubsub
+        self.listeners: dict[str, asyncio.Task] = dict()  # shard: listener
+        self.subscribers: dict[str, set[Subscriber]] = dict()  # channel: subscribers
+        self.mailboxes: dict[Subscriber, _Mailbox] = dict()
+        self.rooms: dict[str, _Mailbox] = dict()  # channel: room worker
+
+    def _pubsub(self, shard: str) -> PubSub:
+        pubsub = self.pubsubs.get(shard)
+        if pubsub is None:
+            clients = self.shards.binary_clients if self.binary else self.shards.clients
+            pubsub = clients[shard].pubsub()
+            self.pubsubs[shard] = pubsub
+        return pubsub
+
+    def _start_listener(self, shard: str) -> None:
+        listener = self.listeners.get(shard)
+        if listener is None or listener.done():
+            self.listeners[shard] = asyncio.create_task(self.listen(shard),
+                                                        name=f'pubsub_listener_task_{shard}')
+
+    async def listen(self, shard: str) -> None:
+        """
+        reads until nothing is subscribed, the pubsub connects again on the next read
+        after a lost connection and subscribes to all of its channels again
+        """
+        backoff = LISTEN_BACKOFF
+        while True:
+            try:
+                async for message in self.pubsubs[shard].listen():  # type: ignore
+                    backoff = LISTEN_BACKOFF
+                    if message['type'] == 'message':
+                        self.dispatch(message)
+                return
+            except (RedisError, OSError) as error:
+                listener_errors.inc()
+                # shard urls may carry a password
+                logger.warning('pub/sub listener of %s failed, reading again in %gs: %r',
+                               shard.rsplit('@', 1)[-1], backoff, error)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, LISTEN_BACKOFF_MAX)
+
+    def dispatch(self, message: dict[str, Any]) -> None:
+        channel = message['channel']
+        if isinstance(channel, bytes):
+            channel = channel.decode()
+        room = self.rooms.get(channel)
+        if room is None and self._is_large(channel):
+            # stays a room until the last local subscriber leaves, so messages keep their order
+            room = self.rooms[channel] = _Mailbox(partial(self._fan_out, channel), self.max_pending)
+            large_rooms.set(len(self.rooms))
+        if room is not None:
+            room.put(message)
+            return
+        self._deliver(channel, message)
+
+    def _is_large(self, channel: str) -> bool:
+        return (self.prepare is not None
+                and 0 < self.fan_out_threshold <= len(self.subscribers.get(channel, ())))
+
+    def _deliver(self, channel: str, message: dict[str, Any]) -> None:
+        for subscriber in self.subscribers.get(channel, ()):
+            self.mailboxes[subscriber].put(message)
+
+    async def _fan_out(self, channel: str, message: dict[str, Any]) -> None:
+        try:
+            await self.prepare(message)  # type: ignore
+            room_fan_outs.inc()
+        except Exception:
+            # subscribers do the work themselves for what was not prepared
+            pass
+        self._deliver(channel, message)
+
+    async def subscribe(self, subscriptions: dict[str, Subscriber]) -> None:
+        new_channels: list[str] = []
+        for channel, subscriber in subscriptions.items():
+            subscribers = self.subscribers.setdefault(channel, set())
+            if subscriber in subscribers:
+                continue
+            if not subscribers:
+                new_channels.append(channel)
+            subscribers.add(subscriber)
+            mailbox = self.mailboxes.get(subscriber)
+            if mailbox is None:
+                mailbox = self.mailboxes[subscriber] = _Mailbox(subscriber, self.max_pending)
+            mailbox.channels += 1
+        groups = self.shards.group_channels(new_channels)
+        await asyncio.gather(*(self._pubsub(shard).subscribe(*channels)
+                               for shard, channels in groups.items()))
+        for shard in groups:
+            self._start_listener(shard)
+        subscribed_channels.set(len(self.subscribers))
+
+    async def unsubscribe(self, subscriptions: dict[str, Subscriber]) -> None:
+        unused_channels: list[str] = []
+        for channel, subscriber in subscriptions.items():
+            subscribers = self.subscribers.get(channel)
+            if subscribers is None or subscriber not in subscribers:
+                continue
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[channel]
+                unused_channels.append(channel)
+                room = self.rooms.pop(channel, None)
+                if room is not None:
+                    room.close()
+            mailbox = self.mailboxes[subscriber]
+            mailbox.channels -= 1
+            if not mailbox.channels:
+                mailbox.close()
+                del self.mailboxes[subscriber]
+        subscribed_channels.set(len(self.subscribers))
+        large_rooms.set(len(self.rooms))
+        await asyncio.gather(*(self._pubsub(shard).unsubscribe(*channels)
+                               for shard, channels in self.shards.group_channels(unused_channels).items()))
+
+    async def close(self) -> None:
+        for listener in self.listeners.values():
+            listener.cancel()
+        for mailbox in [*self.mailboxes.values(), *self.rooms.values()]:
+            mailbox.close()
+        await asyncio.gather(*(pubsub.close() for pubsub in self.pubsubs.values()))
+        self.listeners.clear()
+        self.pubsubs.clear()
+        self.subscribers.clear()
+        self.mailboxes.clear()
+        self.rooms.clear()
+        subscribed_channels.set(0)
+        large_rooms.set(0)
@@ -0,0 +1,94 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+from uuid import uuid4
+
+from redis.asyncio.client import Redis
+from redis.exceptions import ResponseError
+
+from codec import JsonCodec, MsgpackCodec
+from metrics import registry
+from presence import PresenceService
+from schemas import Message, UserStatus
+from sharding import ShardedRedis
+
+inbox_stored = registry.counter('chat_inbox_stored_total',
+                                'Messages queued for members without a live connection')
+inbox_drained = registry.counter('chat_inbox_drained_total',
+                                 'Queued messages delivered on reconnect')
+
+
+class OfflineInbox:
+    """
+    capped list per user of channel frames published while the user had no live
+    connection, newest at the head, taken whole by the first connection of the user
+    """
+
+    def __init__(self,
+                 shards: ShardedRedis,
+                 presence: PresenceService,
+                 channel_codec: JsonCodec | MsgpackCodec,
+                 max_size: int,
+                 ttl: int,
+                 page_size: int) -> None:
+        self.shards: ShardedRedis = shards
+        self.presence: PresenceService = presence
+        self.channel_codec: JsonCodec | MsgpackCodec = channel_codec
+        self.max_size: int = max_size
+        self.ttl: int = ttl
+        self.page_size: int = page_size
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f'inbox:{user_id}'
+
+    def _client(self, shard: str) -> Redis:
+        if self.channel_codec.binary:
+            return self.shards.binary_clients[shard]
+        return self.shards.clients[shard]
+
+    async def store(self, members: set[int], message: Message) -> None:
+        if not members:
+            return
+        statuses = await self.presence.statuses(list(members))
+        offline = [self.key(user_id) for user_id, status in statuses.items()
+                   if status == UserStatus.OFFLINE]
+        if not offline:
+            return
+        frame = self.channel_codec.encode(message)
+        await asyncio.gather(*(self._store(shard, keys, frame)
+                               for shard, keys in self.shards.group(offline).items()))
+        inbox_stored.inc(len(offline))
+
+    async def _store(self, shard: str, keys: list[str], frame: Any) -> None:
+        async with self._client(shard).pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.lpush(key, frame)
+                pipe.ltrim(key, 0, self.max_size - 1)
+                pipe.expire(key, self.ttl)
+            await pipe.execute()
+
+    async def drain(self, user_id: int, deliver: Callable[[list[Message]], Awaitable[None]]) -> int:
+        """
+        deliver queued messages oldest first in pages, the inbox is renamed to a snapshot
+        first so frames pushed or trimmed meanwhile can't shift the pages
+        """
+        key = self.key(user_id)
+        snapshot = f'inbox:drain:{uuid4().hex}:{user_id}'  # same shard as the inbox
+        client = self._client(self.shards.shard(key))
+        try:
+            await client.rename(key, snapshot)
+        except ResponseError:  # nothing queued
+            return 0
+        drained = 0
+        while True:
+            frames = await client.lrange(snapshot, -(drained + self.page_size), -(drained + 1))
+            if not frames:
+                break
+            drained += len(frames)
+            messages = [self.channel_codec.decode(frame, (Message,)) for frame in reversed(frames)]
+            await deliver([message for message in messages if message is not None])
+            if len(frames) < self.page_size:
+                break
+        await client.delete(snapshot)
+        inbox_drained.inc(drained)
+        return drained
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import signal
+import socket
+from importlib.util import find_spec
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+from multiprocessing.process import BaseProcess
+from time import monotonic, process_time, sleep
+from types import FrameType
+
+import uvicorn
+
+from metrics import registry
+from settings import settings
+
+worker_info = registry.gauge('chat_worker_info',
+                             'Index and pid of the worker serving this scrape, always 1')
+loop_lag = registry.gauge('chat_worker_loop_lag_seconds',
+                          'How late the event loop of this worker woke up in the last interval')
+cpu_ratio = registry.gauge('chat_worker_cpu_ratio',
+                           'Share of one core this worker used in the last interval')
+
+# seconds before a worker that died is started again
+RESTART_DELAY = 1
+
+
+def bind(host: str, port: int, reuse_port: bool) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # every worker binds the port on its own, the kernel spreads new connections over them
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+class LoadMonitor:
+    """
+    event loop lag and cpu share of this worker, sampled every interval
+    """
+
+    def __init__(self, worker: int, interval: float) -> None:
+        self.worker: str = str(worker)
+        self.interval: float = interval  # seconds
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        worker_info.set(1, worker=self.worker, pid=str(os.getpid()))
+        self._task = asyncio.create_task(self._run(), name='load_monitor_task')
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def sample(self, started: float, cpu_started: float, now: float, cpu_now: float) -> None:
+        loop_lag.set(max(0.0, now - started - self.interval), worker=self.worker)
+        cpu_ratio.set((cpu_now - cpu_started) / max(now - started, 1e-9), worker=self.worker)
+
+    async def _run(self) -> None:
+        started, cpu_started = monotonic(), process_time()
+        while True:
+            await asyncio.sleep(self.interval)
+            now, cpu_now = monotonic(), process_time()
+            self.sample(started, cpu_started, now, cpu_now)
+            started, cpu_started = now, cpu_now
+
+
+def run_worker(index: int, sock: socket.socket | None) -> None:
+    # signals reach the launcher only, it decides when the workers drain
+    os.setpgrp()
+    # imported here, so every worker opens its own redis pools and pub/sub hub
+    from compression import ChatWebSocketProtocol
+    from main import DrainingServer, app
+
+    sockets = [sock or bind(settings.server.host, settings.server.port, reuse_port=True)]
+    if settings.server.metrics_port:
+        # the shared port lands on any worker, this one is for scraping this worker alone
+        sockets.append(bind(settings.server.host, settings.server.metrics_port + index, reuse_port=False))
+    monitor = LoadMonitor(index, settings.server.load_interval)
+    app.add_event_handler('startup', monitor.start)
+    app.add_event_handler('shutdown', monitor.stop)
+    DrainingServer(uvicorn.Config(app,
+                                  log_level=settings.server.log_level,
+                                  loop='uvloop' if find_spec('uvloop') else 'asyncio',
+                                  http='httptools' if find_spec('httptools') else 'h11',
+                                  ws=ChatWebSocketProtocol,  # type: ignore
+                                  ws_max_size=settings.limits.max_frame_size,
+                                  ws_per_message_deflate=settings.compression.enabled)).run(sockets=sockets)
+
+
+class Launcher:
+    """
+    one shared nothing worker process per core, each with its own event loop, redis
+    pools and pub/sub hub, workers that die are started again until a signal asks
+    all of them to drain
+    """
+
+    def __init__(self, workers: int, shutdown_timeout: float) -> None:
+        self.workers: int = workers
+        self.shutdown_timeout: float = shutdown_timeout  # seconds
+        self.processes: dict[int, BaseProcess] = dict()  # worker index: process
+        self.stopping: bool = False
+        self.sock: socket.socket | None = None
+        # fresh interpreters, nothing opened by the launcher leaks into a worker
+        self._context = get_context('spawn')
+
+    def start_worker(self, index: int) -> None:
+        process = self._context.Process(target=run_worker, args=(index, self.sock), name=f'chat-worker-{index}')
+        process.start()
+        self.processes[index] = process
+
+    def handle_signal(self, sig: int, frame: FrameType | None) -> None:
+        # the first SIGTERM drains a worker, a second one stops it right away
+        self.stopping = True
+        for process in self.processes.values():
+            if process.is_alive() and process.pid:
+                os.kill(process.pid, signal.SIGTERM)
+
+    def run(self) -> None:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            # every worker accepts on one socket bound here instead
+            self.sock = bind(settings.server.host, settings.server.port, reuse_port=False)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        for index in range(self.workers):
+            self.start_worker(index)
+        while not self.stopping:
+            wait([process.sentinel for process in self.processes.values()], timeout=1)
+            dead = [index for index, process in self.processes.items() if not process.is_alive()]
+            if dead and not self.stopping:
+                sleep(RESTART_DELAY)
+                for index in dead:
+                    if not self.stopping:
+                        self.start_worker(index)
+        deadline = monotonic() + self.shutdown_timeout
+        for process in self.processes.values():
+            process.join(max(0.0, deadline - monotonic()))
+        for process in self.processes.values():
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+
+if __name__ == '__main__':
+    Launcher(settings.server.workers or os.cpu_count() or 1, settings.server.shutdown_timeout).run()
@@ -1,4 +1,6 @@
+import asyncio
 from json import JSONEncoder
+from types import FrameType
 from typing import Any
 from uuid import UUID
 
@@ -7,8 +9,13 @@ import uvicorn
 from starlette.applications import Starlette
 from starlette.middleware import Middleware
 from starlette.middleware.authentication import AuthenticationMiddleware
-from authentication import BasicAuthBackend
+from starlette.routing import Mount, Route
+from authentication import AuthenticationManager
+from compression import ChatWebSocketProtocol
+from endpoints import (drain_controller, hub, metrics, readiness, search_index,
+                       start_drain, users)
 from schemas import MessageStatus
+from settings import settings
 
 
 from router import router
@@ -29,7 +36,46 @@ JSONEncoder.default = custom_json_encoder  # type: ignore
 
 
 middleware = [
-    Middleware(AuthenticationMiddleware, backend=BasicAuthBackend())
+    Middleware(AuthenticationMiddleware, backend=AuthenticationManager(users,
+                                                                       settings.auth.token_cache_size,
+                                                                       settings.auth.token_ttl))
 ]
 
-app = Starlette(debug=True, routes=router, middleware=middleware)
+chat_app = Starlette(debug=settings.server.debug, routes=router, middleware=middleware)
+
+# metrics, readiness and drain are called without a token, so they stay outside the
+# authenticated app, mounted apps don't get lifespan events so startup hooks live here
+app = Starlette(debug=settings.server.debug,
+                routes=[Route(path='/metrics', endpoint=metrics),
+                        Route(path='/ready', endpoint=readiness),
+                        Route(path='/drain', endpoint=start_drain, methods=['POST']),
+                        Mount(path='/', app=chat_app)],
+                on_startup=[search_index.start],
+                on_shutdown=[search_index.stop])
+
+
+class DrainingServer(uvicorn.Server):
+    """
+    the first SIGTERM or SIGINT hands the sockets off before the server stops,
+    a second one stops it right away
+    """
+
+    def handle_exit(self, sig: int, frame: FrameType | None) -> None:
+        if drain_controller.draining:
+            return super().handle_exit(sig, frame)
+        self.drain_task = asyncio.get_running_loop().create_task(self.drain_and_exit(sig, frame))
+
+    async def drain_and_exit(self, sig: int, frame: FrameType | None) -> None:
+        await drain_controller.start()
+        await hub.close()
+        super().handle_exit(sig, frame)
+
+
+if __name__ == '__main__':
+    DrainingServer(uvicorn.Config(app,
+                                  host=settings.server.host,
+                                  port=settings.server.port,
+                                  log_level=settings.server.log_level,
+                                  ws=ChatWebSocketProtocol,  # type: ignore
+                                  ws_max_size=settings.limits.max_frame_size,
+                                  ws_per_message_deflate=settings.compression.enabled)).run()
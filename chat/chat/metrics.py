@@ -0,0 +1,118 @@
+from bisect import bisect_left
+from typing import Any, Iterator
+
+Labels = tuple[tuple[str, str], ...]
+
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def _labels(labels: dict[str, str]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Counter:
+    type_name = 'counter'
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name: str = name
+        self.description: str = description
+        self.values: dict[Labels, float] = dict()
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self.values.get(_labels(labels), 0)
+
+    def remove(self, **labels: str) -> None:
+        self.values.pop(_labels(labels), None)
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[_labels(labels)] = value
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram:
+    type_name = 'histogram'
+
+    def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.name: str = name
+        self.description: str = description
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets))
+        # labels: (per bucket counts, sum, count)
+        self.values: dict[Labels, tuple[list[int], float, int]] = dict()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _labels(labels)
+        counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+        index = bisect_left(self.buckets, value)
+        if index < len(counts):
+            counts[index] += 1
+        self.values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels: str) -> int:
+        return self.values.get(_labels(labels), ([], 0.0, 0))[2]
+
+    def samples(self) -> Iterator[tuple[str, Labels, float]]:
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket', labels + (('le', str(bound)),), cumulative
+            yield f'{self.name}_bucket', labels + (('le', '+Inf'),), count
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.metrics: dict[str, Counter | Histogram] = dict()
+
+    def _get_or_create(self, metric_type: type, name: str, description: str, *args: Any) -> Any:
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = metric_type(name, description, *args)
+            self.metrics[name] = metric
+        if not isinstance(metric, metric_type):
+            raise TypeError(f'Metric {name} already registered as {metric.type_name}')
+        return metric
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        return self._get_or_create(Gauge, name, description)
+
+    def histogram(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, description, buckets)
+
+    def collect(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
@@ -0,0 +1,239 @@
+import asyncio
+import json
+import signal
+from datetime import datetime, timezone
+from typing import Any
+from uuid import UUID
+
+import asyncpg
+from pydantic.json import pydantic_encoder
+from redis.asyncio.client import Redis
+from redis.exceptions import RedisError, ResponseError
+
+from connections import shards
+from metrics import registry
+from schemas import Message, MessageStatusBatch
+from search import STREAM
+from settings import settings
+from sharding import ShardedRedis
+
+persisted = registry.counter('chat_persisted_total',
+                             'Stream entries written to postgres by kind, message or status')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chat_messages (
+    chat uuid NOT NULL,
+    uuid uuid NOT NULL,
+    seq bigint NOT NULL,
+    sender bigint NOT NULL,
+    text text NOT NULL,
+    attachments jsonb NOT NULL,
+    status smallint NOT NULL,
+    sent_at timestamptz NOT NULL,
+    PRIMARY KEY (uuid, sent_at)
+) PARTITION BY RANGE (sent_at);
+CREATE INDEX IF NOT EXISTS chat_messages_chat_seq ON chat_messages (chat, seq);
+CREATE TABLE IF NOT EXISTS chat_stream_offsets (
+    stream text PRIMARY KEY,
+    ms bigint NOT NULL,
+    seq bigint NOT NULL
+);
+"""
+
+INSERT_MESSAGES = """
+INSERT INTO chat_messages (chat, uuid, seq, sender, text, attachments, status, sent_at)
+SELECT * FROM unnest($1::uuid[], $2::uuid[], $3::bigint[], $4::bigint[], $5::text[],
+                     $6::jsonb[], $7::smallint[], $8::timestamptz[])
+ON CONFLICT DO NOTHING
+"""
+
+UPDATE_STATUSES = """
+UPDATE chat_messages AS m SET status = u.status
+FROM unnest($1::uuid[], $2::smallint[]) AS u (uuid, status)
+WHERE m.uuid = u.uuid AND m.status < u.status
+"""
+
+SAVE_OFFSET = """
+INSERT INTO chat_stream_offsets (stream, ms, seq) VALUES ($1, $2, $3)
+ON CONFLICT (stream) DO UPDATE SET ms = excluded.ms, seq = excluded.seq
+WHERE (chat_stream_offsets.ms, chat_stream_offsets.seq) < (excluded.ms, excluded.seq)
+"""
+
+LOAD_OFFSET = 'SELECT ms, seq FROM chat_stream_offsets WHERE stream = $1'
+
+MessageRow = tuple[UUID, UUID, int, int, str, str, int, datetime]
+
+
+def entry_id_parts(entry_id: str) -> tuple[int, int]:
+    ms, seq = entry_id.split('-')
+    return int(ms), int(seq)
+
+
+def rows(entries: list[tuple[str, dict[str, Any]]]) -> tuple[list[MessageRow], dict[UUID, int]]:
+    """
+    message rows and the highest status rank per message uuid of a batch,
+    entries that don't parse are skipped so they can't block the stream
+    """
+    messages: dict[UUID, MessageRow] = dict()
+    statuses: dict[UUID, int] = dict()
+    for entry_id, fields in entries:
+        try:
+            if 'message' in fields:
+                message = Message.parse_raw(fields['message'])
+                # messages from before sent_at existed take the stream time
+                sent_at = message.sent_at or entry_id_parts(entry_id)[0] / 1000
+                messages[message.uuid] = (message.receiver,
+                                          message.uuid,
+                                          message.seq,
+                                          message.sender.id,
+                                          message.text,
+                                          json.dumps(message.attachments, default=pydantic_encoder),
+                                          message.status.rank,
+                                          datetime.fromtimestamp(sent_at, timezone.utc))
+            elif 'statuses' in fields:
+                batch = MessageStatusBatch.parse_raw(fields['statuses'])
+                for message_uuid, status in batch.updates.items():
+                    statuses[UUID(message_uuid)] = max(statuses.get(UUID(message_uuid), 0), status.rank)
+        except (ValueError, TypeError):
+            continue
+    return list(messages.values()), statuses
+
+
+def month(at: datetime) -> datetime:
+    return at.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(at: datetime) -> datetime:
+    return month(at).replace(year=at.year + at.month // 12, month=at.month % 12 + 1)
+
+
+class MessageArchive:
+    """
+    write behind copy of the message stream in postgres: every shard stream is read
+    by a consumer group, a batch of messages and status updates is written in one
+    transaction of multi-row statements together with the stream offset, entries
+    are acked after the commit, so a crash replays them into idempotent inserts
+    """
+
+    def __init__(self,
+                 shards: ShardedRedis,
+                 pool: asyncpg.Pool,
+                 consumer: str,
+                 group: str,
+                 batch_size: int,
+                 block: int,
+                 claim_idle: int) -> None:
+        self.shards: ShardedRedis = shards
+        self.pool: asyncpg.Pool = pool
+        self.consumer: str = consumer
+        self.group: str = group
+        self.batch_size: int = batch_size
+        self.block: int = block  # ms
+        self.claim_idle: int = claim_idle  # ms
+        self.partitions: set[datetime] = set()  # months with a partition
+        self._consumers: list[asyncio.Task] = []
+
+    @staticmethod
+    def stream_name(shard: str) -> str:
+        # shard urls may carry a password
+        return f'{shard.rsplit("@", 1)[-1]}/{STREAM}'
+
+    async def create_schema(self) -> None:
+        async with self.pool.acquire() as connection:
+            await connection.execute(SCHEMA)
+
+    def start(self) -> None:
+        self._consumers = [asyncio.create_task(self._consume(shard), name=f'archive_consumer_task_{shard}')
+                           for shard in self.shards.clients]
+
+    def stop(self) -> None:
+        for consumer in self._consumers:
+            consumer.cancel()
+        self._consumers = []
+
+    async def _consume(self, shard: str) -> None:
+        client = self.shards.clients[shard]
+        group_created = False
+        while True:
+            try:
+                if not group_created:
+                    await self._create_group(client, shard)
+                    group_created = True
+                if not await self.poll(client, shard):
+                    await asyncio.sleep(0)
+            except (RedisError, asyncpg.PostgresError, OSError):
+                await asyncio.sleep(self.block / 1000)
+
+    async def _create_group(self, client: Redis, shard: str) -> None:
+        """
+        a stream lost with its redis is read again from the checkpoint, not from the start
+        """
+        async with self.pool.acquire() as connection:
+            offset = await connection.fetchrow(LOAD_OFFSET, self.stream_name(shard))
+        try:
+            await client.xgroup_create(STREAM, self.group, id=f'{offset[0]}-{offset[1]}' if offset else '0',
+                                       mkstream=True)
+        except ResponseError:  # BUSYGROUP, created by another consumer
+            pass
+
+    async def poll(self, client: Redis, shard: str) -> int:
+        _, claimed, *_ = await client.xautoclaim(STREAM, self.group, self.consumer,
+                                                 self.claim_idle, count=self.batch_size)
+        entries = [entry for entry in claimed if entry and entry[1]]
+        if not entries:
+            response = await client.xreadgroup(self.group, self.consumer, {STREAM: '>'},
+                                               count=self.batch_size, block=self.block)
+            entries = response[0][1] if response else []
+        if entries:
+            await self.write(shard, entries)
+            await client.xack(STREAM, self.group, *(entry_id for entry_id, _ in entries))
+        return len(entries)
+
+    async def write(self, shard: str, entries: list[tuple[str, dict[str, Any]]]) -> None:
+        messages, statuses = rows(entries)
+        last = max(entry_id_parts(entry_id) for entry_id, _ in entries)
+        async with self.pool.acquire() as connection:
+            await self._create_partitions(connection, set(month(row[7]) for row in messages))
+            async with connection.transaction():
+                if messages:
+                    await connection.execute(INSERT_MESSAGES, *(list(column) for column in zip(*messages)))
+                if statuses:
+                    await connection.execute(UPDATE_STATUSES, list(statuses), list(statuses.values()))
+                await connection.execute(SAVE_OFFSET, self.stream_name(shard), *last)
+        persisted.inc(len(messages), kind='message')
+        persisted.inc(len(statuses), kind='status')
+
+    async def _create_partitions(self, connection: asyncpg.Connection, months: set[datetime]) -> None:
+        for start in months - self.partitions:
+            try:
+                await connection.execute(
+                    f'CREATE TABLE IF NOT EXISTS chat_messages_{start:%Y_%m} PARTITION OF chat_messages '
+                    f"FOR VALUES FROM ('{start.isoformat()}') TO ('{next_month(start).isoformat()}')")
+            except (asyncpg.DuplicateTableError, asyncpg.UniqueViolationError):
+                # created by another consumer at the same time
+                pass
+            self.partitions.add(start)
+
+
+async def main() -> None:
+    pool = await asyncpg.create_pool(settings.persistence.dsn, min_size=1, max_size=settings.persistence.pool_size)
+    archive = MessageArchive(shards,
+                             pool,
+                             settings.server.node_id,
+                             settings.persistence.group,
+                             settings.persistence.batch_size,
+                             settings.persistence.block,
+                             settings.persistence.claim_idle)
+    await archive.create_schema()
+    archive.start()
+    stopped = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(sig, stopped.set)
+    await stopped.wait()
+    # a batch cut off here rolls back, its entries stay pending and are claimed again
+    archive.stop()
+    await pool.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
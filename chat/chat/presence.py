@@ -0,0 +1,147 @@
+import asyncio
+from math import ceil
+from time import time
+from typing import Any
+from uuid import UUID
+
+from redis.asyncio.client import Redis
+from redis.exceptions import RedisError
+
+from codec import JsonCodec, MsgpackCodec
+from schemas import Chat, PresenceBatch, UserStatus
+from sharding import ShardedRedis
+from utils import type_key
+
+
+class PresenceService:
+    """
+    user is online while any node keeps its node id in the user presence zset
+    with a score in the future, local connections are refcounted per user and
+    refreshed with one pipeline per tick, so a crashed node expires after ttl
+    """
+
+    def __init__(self,
+                 redis: Redis,
+                 shards: ShardedRedis,
+                 node: str,
+                 ttl: float,
+                 interval: float,
+                 channel_codec: JsonCodec | MsgpackCodec) -> None:
+        self.redis: Redis = redis
+        # presence events go to chat channels on their shards
+        self.shards: ShardedRedis = shards
+        self.node: str = node
+        self.ttl: float = ttl
+        self.interval: float = interval
+        self.channel_codec: JsonCodec | MsgpackCodec = channel_codec
+        self.connections: dict[int, int] = dict()  # user id: local connections
+        self.chats: dict[int, set[UUID]] = dict()  # user id: chats to notify
+        self.joined: set[int] = set()
+        self.left: set[int] = set()
+        self._ticker: asyncio.Task | None = None
+        self._leaving: set[asyncio.Task] = set()
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f'{type_key(UserStatus)}:{user_id}'
+
+    async def connect(self, user_id: int, chats: set[UUID]) -> None:
+        self.connections[user_id] = self.connections.get(user_id, 0) + 1
+        self.chats.setdefault(user_id, set()).update(chats)
+        if self.connections[user_id] == 1:
+            self.left.discard(user_id)
+            self.joined.add(user_id)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.zadd(self.key(user_id), {self.node: time() + self.ttl})
+                pipe.expire(self.key(user_id), ceil(self.ttl))
+                await pipe.execute()
+        if self._ticker is None:
+            self._ticker = asyncio.create_task(self._run(), name='presence_ticker_task')
+
+    def disconnect(self, user_id: int) -> None:
+        count = self.connections.get(user_id, 0) - 1
+        if count > 0:
+            self.connections[user_id] = count
+            return
+        self.connections.pop(user_id, None)
+        self.joined.discard(user_id)
+        self.left.add(user_id)
+        # stop counting as live right away, the offline event still waits for the tick
+        task = asyncio.create_task(self._leave(user_id), name=f'presence_leave_task_{user_id}')
+        self._leaving.add(task)
+        task.add_done_callback(self._leaving.discard)
+
+    async def _leave(self, user_id: int) -> None:
+        if user_id not in self.connections:
+            try:
+                await self.redis.zrem(self.key(user_id), self.node)
+            except RedisError:  # the tick removes it
+                pass
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.tick()
+            except RedisError:
+                # local users are refreshed again on the next tick, before ttl runs out
+                pass
+
+    async def tick(self) -> None:
+        joined, self.joined = self.joined, set()
+        left, self.left = self.left, set()
+        local = list(self.connections)
+        now = time()
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id in local:
+                    pipe.zadd(self.key(user_id), {self.node: now + self.ttl})
+                    pipe.expire(self.key(user_id), ceil(self.ttl))
+                for user_id in left:
+                    pipe.zrem(self.key(user_id), self.node)
+                    pipe.zcount(self.key(user_id), now, '+inf')
+                results = await pipe.execute()
+        except RedisError:
+            # retried on the next tick
+            self.joined.update(user_id for user_id in joined if user_id in self.connections)
+            self.left.update(user_id for user_id in left if user_id not in self.connections)
+            raise
+        counts = results[2 * len(local) + 1::2]
+        changes = dict((user_id, UserStatus.ONLINE) for user_id in joined)
+        for user_id, count in zip(left, counts):
+            # reconnected while the tick was running
+            if not count and user_id not in self.connections:
+                changes[user_id] = UserStatus.OFFLINE
+        await self.publish(changes)
+        for user_id in left:
+            if user_id not in self.connections:
+                self.chats.pop(user_id, None)
+
+    async def publish(self, changes: dict[int, UserStatus]) -> None:
+        batches: dict[UUID, dict[int, UserStatus]] = dict()
+        for user_id, status in changes.items():
+            for chat in self.chats.get(user_id, ()):
+                batches.setdefault(chat, dict())[user_id] = status
+        frames = dict((f'{type_key(Chat)}:{chat}',
+                       self.channel_codec.encode(PresenceBatch(receiver=chat, users=users)))
+                      for chat, users in batches.items())
+        await asyncio.gather(*(self._publish(shard, dict((channel, frames[channel]) for channel in channels))
+                               for shard, channels in self.shards.group_channels(list(frames)).items()))
+
+    async def _publish(self, shard: str, frames: dict[str, Any]) -> None:
+        async with self.shards.clients[shard].pipeline(transaction=False) as pipe:
+            for channel, frame in frames.items():
+                pipe.publish(channel, frame)
+            await pipe.execute()
+
+    async def statuses(self, user_ids: list[int]) -> dict[int, UserStatus]:
+        """
+        presence of a whole member list in one round trip
+        """
+        now = time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.zcount(self.key(user_id), now, '+inf')
+            counts = await pipe.execute()
+        return dict((user_id, UserStatus.ONLINE if count else UserStatus.OFFLINE)
+                    for user_id, count in zip(user_ids, counts))
@@ -0,0 +1,35 @@
+from time import monotonic
+
+
+class TokenBucket:
+    """
+    rate tokens a second up to burst, a call is allowed while a whole token is left
+    """
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate: float = rate
+        self.burst: float = burst
+        self.tokens: float = burst
+        self.updated: float = monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float | None = None) -> bool:
+        self._refill(monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def wait_time(self, now: float | None = None) -> float:
+        """
+        seconds until the next whole token
+        """
+        self._refill(monotonic() if now is None else now)
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def full(self, now: float | None = None) -> bool:
+        self._refill(monotonic() if now is None else now)
+        return self.tokens >= self.burst
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+from uuid import UUID
+
+from schemas import Chat, MessageStatus, Permission, UpdateMessage
+
+if TYPE_CHECKING:
+    from authentication import SecurityManager
+    from endpoints import RedisChatEndpoint
+    from unread import UnreadCounters
+
+
+class ReceiptAggregator:
+    """
+    buffers DELIVERED/READ receipts of the process for one tick and applies
+    them with one read round trip and one status transition script call
+    """
+
+    def __init__(self,
+                 redis: RedisChatEndpoint,
+                 security: SecurityManager,
+                 flush_interval: float,
+                 expr_time: float,
+                 unread: UnreadCounters | None = None) -> None:
+        self.redis: RedisChatEndpoint = redis
+        self.security: SecurityManager = security
+        self.flush_interval: float = flush_interval
+        self.expr_time: float = expr_time
+        self.unread: UnreadCounters | None = unread
+        self.pending: dict[UUID, tuple[MessageStatus, UUID]] = dict()  # message: (status, reader)
+        self.reads: dict[tuple[int, UUID], UUID] = dict()  # (reader id, message): reader
+        self._flush_task: asyncio.Task | None = None
+
+    def add(self, reader: UUID, update: UpdateMessage, reader_id: int | None = None) -> None:
+        current = self.pending.get(update.uuid)
+        if current is None or update.status.rank > current[0].rank:
+            self.pending[update.uuid] = (update.status, reader)
+        # read cursors are per reader, not per message
+        if reader_id is not None and update.status == MessageStatus.READ:
+            self.reads.pop((reader_id, update.uuid), None)
+            self.reads[(reader_id, update.uuid)] = reader
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later(),
+                                                   name='receipt_flush_task')
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        pending, self.pending = self.pending, dict()
+        reads, self.reads = self.reads, dict()
+        if not pending and not reads:
+            return
+        uuids = list(dict.fromkeys([*pending, *(uuid for _, uuid in reads)]))
+        cached_messages = dict(zip(uuids, await self.redis.get_messages(uuids)))
+        candidates = [(cached, *pending[uuid])
+                      for uuid, cached in cached_messages.items()
+                      if cached and uuid in pending and pending[uuid][0].rank > cached.status.rank]
+        read_candidates = [(cached_messages[uuid], reader_id, reader)
+                           for (reader_id, uuid), reader in reads.items()
+                           if cached_messages[uuid]]
+        access = set((reader, cached.receiver) for cached, _, reader in candidates + read_candidates)
+        permitted = dict(zip(access, await asyncio.gather(
+            *(self.security.is_permitted(Permission(user_uuid=reader,
+                                                    resource_type=Chat,
+                                                    resource_uuid=receiver))
+              for reader, receiver in access))))
+        updates = dict((cached.uuid, status)
+                       for cached, status, reader in candidates
+                       if permitted[(reader, cached.receiver)])
+        # the furthest read message of a chat moves the cursor
+        cursors: dict[tuple[int, UUID], int] = dict()
+        for cached, reader_id, reader in read_candidates:
+            if permitted[(reader, cached.receiver)] and cached.seq > cursors.get((reader_id, cached.receiver), 0):
+                cursors[(reader_id, cached.receiver)] = cached.seq
+        tasks = []
+        if updates:
+            tasks.append(self.redis.transition_statuses(updates, self.expr_time))
+        if cursors and self.unread:
+            tasks.append(self.unread.mark_read(cursors))
+        await asyncio.gather(*tasks)
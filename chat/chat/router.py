@@ -1,7 +1,18 @@
-from starlette.routing import WebSocketRoute
+from starlette.routing import Route, WebSocketRoute
 
-from endpoints import ChatEndpoint
+from endpoints import (ChatEndpoint, chat_members, chat_members_check,
+                       create_attachment, download_attachment,
+                       presence_statuses, search_messages, unread_counts,
+                       upload_attachment)
 
 router = [
     WebSocketRoute(path='/', endpoint=ChatEndpoint),
+    Route(path='/presence', endpoint=presence_statuses),
+    Route(path='/unread', endpoint=unread_counts),
+    Route(path='/chats/{chat:uuid}/members', endpoint=chat_members),
+    Route(path='/chats/{chat:uuid}/members/check', endpoint=chat_members_check),
+    Route(path='/chats/{chat:uuid}/search', endpoint=search_messages),
+    Route(path='/chats/{chat:uuid}/attachments', endpoint=create_attachment, methods=['POST']),
+    Route(path='/attachments/{attachment:uuid}', endpoint=upload_attachment, methods=['PUT']),
+    Route(path='/attachments/{attachment:uuid}', endpoint=download_attachment, methods=['GET', 'HEAD']),
 ]
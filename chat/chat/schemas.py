@@ -2,13 +2,14 @@ from __future__ import annotations
 
 from datetime import datetime
 from enum import Enum, auto, StrEnum
-from typing import Protocol
+from typing import ClassVar, Literal, Protocol, runtime_checkable
 from uuid import UUID
 
 from pydantic import BaseModel, Field
 from utils import str_to_type, type_key
 
 
+@runtime_checkable
 class HasUUID(Protocol):
     """
     to create redis key as classname:uuid
@@ -83,6 +84,22 @@ class MessageStatus(Enum):
     DELIVERED = 'DELIVERED'
     READ = 'READ'
 
+    @property
+    def rank(self) -> int:
+        """
+        position in SENT -> DELIVERED -> READ, status never goes back
+        """
+        return _MESSAGE_STATUS_ORDER.index(self)
+
+    @staticmethod
+    def from_rank(rank: int) -> MessageStatus:
+        if rank < 0:
+            raise ValueError(f'Invalid message status rank {rank}')
+        return _MESSAGE_STATUS_ORDER[rank]
+
+
+_MESSAGE_STATUS_ORDER = tuple(MessageStatus)
+
 
 """
 User sends message with receiver, status=SENT, text not Null, uuid and sender are Null (set by BE app)
@@ -99,22 +116,51 @@ subscriber updates message status
 """
 
 
+class Attachment(BaseModel):
+    """
+    uploaded blob a message refers to, the bytes are downloaded over http
+    """
+    uuid: UUID
+    name: str
+    content_type: str
+    size: int  # bytes
+
+
 class Message(BaseModel):
     receiver: UUID  # Chat uuid
     status: MessageStatus
     sender: User
     text: str
     uuid: UUID
+    seq: int = 0  # position in the chat, 0 if unknown
+    sent_at: float = 0  # server unix time the message was accepted, 0 if unknown
+    attachments: list[Attachment] = []
+    type: Literal['message'] = 'message'
 
 
 class NewMessage(BaseModel):
     receiver: UUID  # Chat uuid
     text: str
+    attachments: list[UUID] = []  # uploads of the sender to the receiver chat
+    # set by the client and kept across retries, a resend within the dedup window is only acknowledged
+    client_id: UUID | None = None
+    type: Literal['new_message'] = 'new_message'
+
+
+class MessageAck(BaseModel):
+    """
+    sent to the sender of a new message with a client id, also when a retry was not published again
+    """
+    receiver: UUID  # Chat uuid
+    client_id: UUID
+    uuid: UUID  # of the published message
+    type: Literal['message_ack'] = 'message_ack'
 
 
 class UpdateMessage(BaseModel):
     status: MessageStatus
     uuid: UUID
+    type: Literal['update_message'] = 'update_message'
 
 
 class CachedMessage(BaseModel):
@@ -122,6 +168,67 @@ class CachedMessage(BaseModel):
     status: MessageStatus
     sender: User
     uuid: UUID
+    seq: int = 0
+
+
+class MessageStatusBatch(BaseModel):
+    """
+    status updates of one chat collected during one receipt tick
+    """
+    receiver: UUID  # Chat uuid
+    updates: dict[str, MessageStatus]  # message uuid: status
+    type: Literal['message_status_batch'] = 'message_status_batch'
+
+
+class PresenceBatch(BaseModel):
+    """
+    presence changes of chat members collected during one presence tick
+    """
+    receiver: UUID  # Chat uuid
+    users: dict[int, UserStatus]  # user id: status
+    type: Literal['presence_batch'] = 'presence_batch'
+
+
+class EventKind(Enum):
+    TYPING = 'TYPING'
+    ACTIVE = 'ACTIVE'
+    REACTING = 'REACTING'
+
+
+class ChatEvent(BaseModel):
+    """
+    ephemeral client event, never stored
+    """
+    receiver: UUID  # Chat uuid
+    kind: EventKind
+    type: Literal['chat_event'] = 'chat_event'
+
+
+class EventBatch(BaseModel):
+    """
+    latest ephemeral event of chat members collected during one event tick
+    """
+    receiver: UUID  # Chat uuid
+    users: dict[int, EventKind]  # user id: event
+    type: Literal['event_batch'] = 'event_batch'
+
+
+class Reconnect(BaseModel):
+    """
+    control frame of a draining node, the socket is closed next and the client
+    reconnects after delay seconds
+    """
+    delay: float
+    type: Literal['reconnect'] = 'reconnect'
+
+
+class UnreadCounts(BaseModel):
+    """
+    unread counters and read cursors of all user chats, sent on connect
+    """
+    counts: dict[str, int]  # chat uuid: unread messages
+    cursors: dict[str, int]  # chat uuid: seq of the last read message
+    type: Literal['unread_counts'] = 'unread_counts'
 
 # on login get user access permissions
 # auth service add to cache as permission:user_uuid:resource_class_name:resource_uuid = level with expiration time
@@ -145,11 +252,11 @@ class Permission(BaseModel):
     @property
     def key(self) -> str:
         return (f'{type_key(self.__class__)}:{self.user_uuid}'
-                f':{self.resource_type}:{self.resource_uuid}')
+                f':{type_key(self.resource_type)}:{self.resource_uuid}')
 
     @property
     def resource_key(self) -> str:
-        return f':{self.resource_type}:{self.resource_uuid}'
+        return f':{type_key(self.resource_type)}:{self.resource_uuid}'
 
     @staticmethod
     def from_str(permission: str) -> Permission:
@@ -163,6 +270,16 @@ class Permission(BaseModel):
         return f'{type_key(Permission)}:update:{user}'
 
 
+class PermissionDelta(BaseModel):
+    """
+    resources granted to or revoked from one user, published on Permission.update_channel
+    """
+    resource_type: str  # type_key of the resource class
+    granted: list[UUID] = []
+    revoked: list[UUID] = []
+    type: Literal['permission_delta'] = 'permission_delta'
+
+
 # class AccessLevel:
 #     resource: UUID
 #     user: UUID
@@ -186,12 +303,12 @@ class Role(BaseModel):
     resource: HasUUID
     user: int
     level: RoleLevel
-    
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    key_prefix: ClassVar[str] = 'Role'
+
     @property
     def redis_key(self):
         return f'{self.key_prefix}:{self.user}:{self.resource.uuid}'
-    
-    @property
-    @classmethod
-    def key_prefix(cls):
-        return cls.__name__
@@ -0,0 +1,114 @@
+from codec import Encoding, FrameType
+from schemas import MessageStatus
+
+_STATUS_RANKS = ', '.join(f'{status.value} = {status.rank}' for status in MessageStatus)
+
+# KEYS: cached message keys
+# ARGV: expire seconds, chat channel prefix, channel encoding, stream or '' for none,
+# stream max length, new status for every key
+# moves every message forward in SENT -> DELIVERED -> READ, ignores any step back,
+# publishes one MessageStatusBatch per chat, appends it to the stream as json
+# and returns uuids of updated messages
+STATUS_TRANSITION = f"""
+local ranks = {{{_STATUS_RANKS}}}
+local batches = {{}}
+local statuses = {{}}
+local receivers = {{}}
+local updated = {{}}
+for i, key in ipairs(KEYS) do
+    local status = ARGV[i + 5]
+    local cached = redis.call('GET', key)
+    if cached then
+        local message = cjson.decode(cached)
+        if ranks[status] > ranks[message.status] then
+            message.status = status
+            redis.call('SET', key, cjson.encode(message), 'EX', ARGV[1])
+            local batch = batches[message.receiver]
+            if not batch then
+                batch = {{}}
+                batches[message.receiver] = batch
+                statuses[message.receiver] = {{}}
+                table.insert(receivers, message.receiver)
+            end
+            statuses[message.receiver][message.uuid] = status
+            if ARGV[3] == '{Encoding.MSGPACK}' then
+                batch[message.uuid] = ranks[status]
+            else
+                batch[message.uuid] = status
+            end
+            table.insert(updated, message.uuid)
+        end
+    end
+end
+for _, receiver in ipairs(receivers) do
+    local frame
+    if ARGV[3] == '{Encoding.MSGPACK}' then
+        frame = cmsgpack.pack({{{FrameType.MESSAGE_STATUS_BATCH}, receiver, batches[receiver]}})
+    else
+        frame = cjson.encode({{type = 'message_status_batch', receiver = receiver, updates = batches[receiver]}})
+    end
+    redis.call('PUBLISH', ARGV[2] .. ':' .. receiver, frame)
+    if ARGV[4] ~= '' then
+        local entry = cjson.encode({{type = 'message_status_batch', receiver = receiver, updates = statuses[receiver]}})
+        redis.call('XADD', ARGV[4], 'MAXLEN', '~', ARGV[5], '*', 'statuses', entry)
+    end
+end
+return updated
+"""
+
+# KEYS: unread, read cursor and last seq hash of every member, three keys per member
+# ARGV: chat uuid, message seq
+# counts a chat message for every member whose cursor is behind it
+UNREAD_INCREMENT = """
+local chat, seq = ARGV[1], tonumber(ARGV[2])
+for i = 1, #KEYS, 3 do
+    local cursor = tonumber(redis.call('HGET', KEYS[i + 1], chat) or 0)
+    if seq > cursor then
+        redis.call('HINCRBY', KEYS[i], chat, 1)
+        local last = tonumber(redis.call('HGET', KEYS[i + 2], chat) or 0)
+        if seq > last then
+            redis.call('HSET', KEYS[i + 2], chat, seq)
+        end
+    end
+end
+"""
+
+# KEYS: unread, read cursor and last seq hash of every reader, three keys per reader
+# ARGV: chat uuid and read message seq for every reader, two values per reader
+# cursors only move forward, messages after the cursor stay unread, at most
+# last counted seq - cursor of them, so a send between the read and this call is kept
+UNREAD_READ = """
+for r = 0, #KEYS / 3 - 1 do
+    local k = 3 * r
+    local chat, seq = ARGV[2 * r + 1], tonumber(ARGV[2 * r + 2])
+    local cursor = tonumber(redis.call('HGET', KEYS[k + 2], chat) or 0)
+    if seq > cursor then
+        redis.call('HSET', KEYS[k + 2], chat, seq)
+        local last = tonumber(redis.call('HGET', KEYS[k + 3], chat) or 0)
+        local unread = tonumber(redis.call('HGET', KEYS[k + 1], chat) or 0)
+        unread = math.min(unread, math.max(last - seq, 0))
+        if unread > 0 then
+            redis.call('HSET', KEYS[k + 1], chat, unread)
+        else
+            redis.call('HDEL', KEYS[k + 1], chat)
+        end
+    end
+end
+"""
+
+# KEYS: sent key of the client id, seq counter of the chat, both on the chat shard
+# ARGV: new message uuid, window seconds, cached message key prefix
+# claims the client id and takes the next seq in one round trip, returns {1, seq},
+# a client id already claimed returns {0, earlier uuid} once that message is cached,
+# {0, ''} while the earlier send is still in flight
+CLAIM_SEND = """
+local original = redis.call('GET', KEYS[1])
+if original then
+    if redis.call('EXISTS', ARGV[3] .. ':' .. original) == 1 then
+        return {0, original}
+    end
+    return {0, ''}
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return {1, redis.call('INCR', KEYS[2])}
+"""
@@ -0,0 +1,174 @@
+import asyncio
+import re
+from typing import Any
+from uuid import UUID, uuid4
+
+from redis.asyncio.client import Redis
+from redis.exceptions import RedisError, ResponseError
+
+from metrics import registry
+from schemas import Message
+from sharding import ShardedRedis
+
+STREAM = 'stream:messages'
+TERM = re.compile(r'\w+')
+MAX_TERM_LENGTH = 64
+
+indexed = registry.counter('chat_search_indexed_total',
+                           'Messages added to the search index')
+
+
+def tokenize(text: str) -> list[str]:
+    return list(dict.fromkeys(term for term in TERM.findall(text.lower())
+                              if len(term) <= MAX_TERM_LENGTH))
+
+
+def stream_score(entry_id: str) -> int:
+    """
+    stream ids are <ms>-<seq>, the score keeps them unique and exact in a double
+    """
+    ms, seq = entry_id.split('-')
+    return int(ms) * 1000 + min(int(seq), 999)
+
+
+class SearchIndex:
+    """
+    messages are appended to a stream on the shard of their chat and indexed in the
+    background per chat: a zset of message uuids per term scored by stream time, a lex
+    zset of the chat terms for prefix matching and a hash of messages kept as history
+    """
+
+    def __init__(self,
+                 shards: ShardedRedis,
+                 consumer: str,
+                 group: str,
+                 stream_max_len: int,
+                 batch_size: int,
+                 block: int,
+                 claim_idle: int,
+                 max_prefix_terms: int) -> None:
+        self.shards: ShardedRedis = shards
+        self.consumer: str = consumer
+        self.group: str = group
+        self.stream_max_len: int = stream_max_len
+        self.batch_size: int = batch_size
+        self.block: int = block  # ms
+        self.claim_idle: int = claim_idle  # ms
+        self.max_prefix_terms: int = max_prefix_terms
+        self._consumers: list[asyncio.Task] = []
+
+    # chat uuid goes last, so all keys of a chat live on its shard
+    @staticmethod
+    def term_key(chat: UUID | str, term: str) -> str:
+        return f'searchterm:{term}:{chat}'
+
+    @staticmethod
+    def terms_key(chat: UUID | str) -> str:
+        return f'searchterms:{chat}'
+
+    @staticmethod
+    def history_key(chat: UUID | str) -> str:
+        return f'history:{chat}'
+
+    async def append(self, message: Message) -> None:
+        await self.shards.client(self.history_key(message.receiver)).xadd(
+            STREAM, {'message': message.json()}, maxlen=self.stream_max_len, approximate=True)
+
+    def start(self) -> None:
+        self._consumers = [asyncio.create_task(self._consume(shard), name=f'search_consumer_task_{shard}')
+                           for shard in self.shards.clients]
+
+    def stop(self) -> None:
+        for consumer in self._consumers:
+            consumer.cancel()
+        self._consumers = []
+
+    async def _consume(self, shard: str) -> None:
+        client = self.shards.clients[shard]
+        group_created = False
+        while True:
+            try:
+                if not group_created:
+                    await self._create_group(client)
+                    group_created = True
+                if not await self.poll(client):
+                    # block is a hint a server may return early on, never spin the loop
+                    await asyncio.sleep(0)
+            except RedisError:
+                await asyncio.sleep(self.block / 1000)
+
+    async def poll(self, client: Redis) -> int:
+        """
+        index entries left pending by consumers idle for claim_idle ms, restarted nodes
+        get new consumer names, then read new entries for up to block ms
+        """
+        _, claimed, *_ = await client.xautoclaim(STREAM, self.group, self.consumer,
+                                                 self.claim_idle, count=self.batch_size)
+        # trimmed entries come back empty
+        entries = [entry for entry in claimed if entry and entry[1]]
+        if not entries:
+            response = await client.xreadgroup(self.group, self.consumer, {STREAM: '>'},
+                                               count=self.batch_size, block=self.block)
+            entries = response[0][1] if response else []
+        if entries:
+            await self.index(client, entries)
+        return len(entries)
+
+    async def _create_group(self, client: Redis) -> None:
+        try:
+            await client.xgroup_create(STREAM, self.group, id='0', mkstream=True)
+        except ResponseError:  # BUSYGROUP, created by another node
+            pass
+
+    async def index(self, client: Redis, entries: list[tuple[str, dict[str, Any]]]) -> None:
+        async with client.pipeline(transaction=False) as pipe:
+            for entry_id, fields in entries:
+                if 'message' not in fields:
+                    # status batches for persistence share the stream
+                    continue
+                message = Message.parse_raw(fields['message'])
+                score = stream_score(entry_id)
+                pipe.hset(self.history_key(message.receiver), str(message.uuid), fields['message'])
+                terms = tokenize(message.text)
+                for term in terms:
+                    pipe.zadd(self.term_key(message.receiver, term), {str(message.uuid): score})
+                if terms:
+                    pipe.zadd(self.terms_key(message.receiver), dict((term, 0) for term in terms))
+            pipe.xack(STREAM, self.group, *(entry_id for entry_id, _ in entries))
+            await pipe.execute()
+        indexed.inc(len(entries))
+
+    async def search(self,
+                     chat: UUID,
+                     query: str,
+                     limit: int,
+                     before: int | None = None) -> tuple[list[Message], int | None]:
+        """
+        messages containing every query term, the last one as a prefix, newest first,
+        pass the returned cursor as before to get the next page
+        """
+        terms = tokenize(query)
+        if not terms:
+            return [], None
+        *exact, prefix = terms
+        client = self.shards.client(self.terms_key(chat))
+        expansions = await client.zrangebylex(self.terms_key(chat),
+                                              f'[{prefix}'.encode(), f'[{prefix}'.encode() + b'\xff',
+                                              start=0, num=self.max_prefix_terms)
+        if not expansions:
+            return [], None
+        result = f'searchresult:{uuid4().hex}:{chat}'
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.zunionstore(result, [self.term_key(chat, term) for term in expansions], aggregate='MAX')
+            if exact:
+                pipe.zinterstore(result, [result, *(self.term_key(chat, term) for term in exact)],
+                                 aggregate='MAX')
+            pipe.zrevrangebyscore(result, f'({before}' if before is not None else '+inf', '-inf',
+                                  start=0, num=limit, withscores=True)
+            pipe.delete(result)
+            *_, found, _ = await pipe.execute()
+        if not found:
+            return [], None
+        cached = await client.hmget(self.history_key(chat), [uuid for uuid, _ in found])
+        messages = [Message.parse_raw(data) for data in cached if data]
+        return messages, int(found[-1][1]) if len(found) == limit else None
@@ -0,0 +1,142 @@
+import asyncio
+from collections import OrderedDict
+from enum import StrEnum, auto
+from itertools import count
+from typing import Any, Awaitable, Callable, Hashable
+
+from metrics import registry
+
+queue_depth = registry.gauge('chat_send_queue_depth',
+                             'Outbound frames waiting per connection')
+queue_dropped = registry.counter('chat_send_queue_dropped_total',
+                                 'Outbound frames dropped per connection')
+queue_disconnects = registry.counter('chat_send_queue_disconnects_total',
+                                     'Connections closed on send queue overflow')
+frames_sent = registry.counter('chat_ws_frames_total',
+                               'Websocket frames written, one send per frame')
+messages_sent = registry.counter('chat_ws_messages_total',
+                                 'Chat frames delivered, several per frame when batching')
+
+
+class OverflowPolicy(StrEnum):
+    DROP_OLDEST = auto()
+    COALESCE = auto()
+    DISCONNECT = auto()
+
+
+class SendQueue:
+    """
+    bounded outbound queue of one websocket drained by its own writer task,
+    so a slow consumer never blocks the channel listener
+    """
+
+    def __init__(self,
+                 send: Callable[[Any], Awaitable[None]],
+                 close: Callable[[int], Awaitable[None]],
+                 max_size: int,
+                 policy: OverflowPolicy,
+                 close_code: int,
+                 name: str,
+                 send_batch: Callable[[list[Any]], Awaitable[None]] | None = None,
+                 batch_window: float = 0,
+                 batch_max: int = 1) -> None:
+        self._send = send
+        self._close = close
+        # batching coalesces frames queued within batch_window into one array frame
+        self._send_batch = send_batch
+        self.batch_window: float = batch_window
+        self.batch_max: int = batch_max
+        self.max_size: int = max_size
+        self.policy: OverflowPolicy = policy
+        self.close_code: int = close_code
+        self.name: str = name
+        self.closed: bool = False
+        # int keys are plain frames, other keys are coalescable frames
+        self._items: OrderedDict[Hashable, Any] = OrderedDict()
+        self._sequence = count()
+        self._ready = asyncio.Event()
+        self._writer: asyncio.Task | None = None
+        self._closer: asyncio.Task | None = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    @property
+    def dropped(self) -> int:
+        return int(queue_dropped.value(connection=self.name))
+
+    def put(self, data: Any, coalesce_key: Hashable | None = None) -> bool:
+        if self.closed:
+            return False
+        coalesce = coalesce_key is not None and self.policy == OverflowPolicy.COALESCE
+        if coalesce and coalesce_key in self._items:
+            self._items[coalesce_key] = data
+            return True
+        if len(self._items) >= self.max_size:
+            if self.policy == OverflowPolicy.DISCONNECT:
+                self._disconnect()
+                return False
+            self._drop()
+        self._items[coalesce_key if coalesce else next(self._sequence)] = data
+        queue_depth.set(len(self._items), connection=self.name)
+        self._ready.set()
+        return True
+
+    def _drop(self) -> None:
+        if self.policy == OverflowPolicy.COALESCE:
+            for key in self._items:
+                if not isinstance(key, int):
+                    del self._items[key]
+                    break
+            else:
+                self._items.popitem(last=False)
+        else:
+            self._items.popitem(last=False)
+        queue_dropped.inc(connection=self.name)
+
+    def _disconnect(self) -> None:
+        self.closed = True
+        self._items.clear()
+        queue_depth.set(0, connection=self.name)
+        queue_disconnects.inc()
+        self._closer = asyncio.create_task(self._close(self.close_code),
+                                           name=f'send_queue_close_{self.name}')
+
+    def _pop(self, size: int) -> list[Any]:
+        items = [self._items.popitem(last=False)[1] for _ in range(min(size, len(self._items)))]
+        queue_depth.set(len(self._items), connection=self.name)
+        return items
+
+    async def drain(self) -> None:
+        batching = self._send_batch is not None and self.batch_max > 1
+        while not self.closed:
+            await self._ready.wait()
+            if batching and self.batch_window:
+                await asyncio.sleep(self.batch_window)
+            while self._items:
+                items = self._pop(self.batch_max if batching else 1)
+                try:
+                    # connections that opted into batching always get arrays
+                    if batching:
+                        await self._send_batch(items)  # type: ignore
+                    else:
+                        await self._send(items[0])
+                except Exception:
+                    # socket is gone, on_disconnect will stop the queue
+                    self.closed = True
+                    return
+                frames_sent.inc()
+                messages_sent.inc(len(items))
+            self._ready.clear()
+
+    def start(self) -> None:
+        self._writer = asyncio.create_task(self.drain(),
+                                           name=f'send_queue_writer_{self.name}')
+
+    def stop(self) -> None:
+        self.closed = True
+        if self._writer:
+            self._writer.cancel()
+        queue_depth.remove(connection=self.name)
+        queue_dropped.remove(connection=self.name)
@@ -0,0 +1,212 @@
+from os import getpid
+from socket import gethostname
+
+from pydantic import BaseSettings
+
+from codec import Encoding
+from send_queue import OverflowPolicy
+
+
+class _SettingsSendQueue(BaseSettings):
+    max_size: int = 256
+    overflow_policy: OverflowPolicy = OverflowPolicy.COALESCE
+    # 1013 try again later
+    close_code: int = 1013
+
+
+class _SettingsReceipts(BaseSettings):
+    # seconds
+    flush_interval: float = 0.005
+
+
+class _SettingsProtocol(BaseSettings):
+    # encoding of chat:<uuid> channel payloads, same for every chat node
+    channel_encoding: Encoding = Encoding.JSON
+
+
+class _SettingsServer(BaseSettings):
+    host: str = '0.0.0.0'
+    port: int = 8001
+    log_level: str = 'debug'
+    debug: bool = False
+    # unique per chat process
+    node_id: str = f'{gethostname()}-{getpid()}'
+    # worker processes of launcher.py, 0 is one per core
+    workers: int = 0
+    # worker i also listens on metrics_port + i so each one can be scraped, 0 is off
+    metrics_port: int = 0
+    # seconds between load samples of a worker
+    load_interval: float = 1
+    # seconds workers get to drain before they are killed, longer than a full drain
+    shutdown_timeout: float = 60
+
+
+class _SettingsCompression(BaseSettings):
+    # permessage-deflate negotiation
+    enabled: bool = True
+    # bytes, smaller messages are sent uncompressed
+    min_size: int = 256
+    level: int = 6
+    mem_level: int = 8
+    max_window_bits: int = 15
+
+
+class _SettingsBatching(BaseSettings):
+    # clients opt in with ?batch=1
+    enabled: bool = True
+    # seconds
+    window: float = 0.01
+    max_frames: int = 64
+
+
+class _SettingsPresence(BaseSettings):
+    # seconds
+    ttl: float = 30
+    interval: float = 10
+
+
+class _SettingsEvents(BaseSettings):
+    # seconds, typing and activity events are published once per tick and chat
+    interval: float = 0.5
+    # events a second per user and chat
+    rate: float = 2
+    burst: float = 5
+
+
+class _SettingsAuth(BaseSettings):
+    user_cache_size: int = 100_000
+    # seconds a cached profile is trusted
+    user_ttl: float = 300
+    # seconds profile misses wait to be looked up together
+    user_lookup_window: float = 0.005
+    token_cache_size: int = 100_000
+    # seconds, tokens never outlive their exp
+    token_ttl: float = 300
+
+
+class _SettingsDrain(BaseSettings):
+    # sockets are handed off in this many waves
+    waves: int = 10
+    # seconds between waves
+    wave_interval: float = 1
+    # seconds, each client waits a random delay up to this before reconnecting
+    max_delay: float = 10
+    # seconds the reconnect frame gets before the socket is closed
+    close_grace: float = 1
+    # seconds to wait for the last sockets
+    timeout: float = 30
+
+
+class _SettingsAdmission(BaseSettings):
+    # connects a second per node
+    rate: float = 200
+    burst: float = 400
+    # handshakes running at once
+    max_handshakes: int = 100
+    # sockets waiting in line before new ones are refused
+    max_waiting: int = 10_000
+    # seconds a socket waits before it is refused with 1013
+    timeout: float = 10
+
+
+class _SettingsInbox(BaseSettings):
+    # frames kept per offline user
+    max_size: int = 1000
+    # seconds
+    ttl: int = 7 * 24 * 3600
+    page_size: int = 100
+
+
+class _SettingsSearch(BaseSettings):
+    group: str = 'search'
+    stream_max_len: int = 1_000_000
+    batch_size: int = 100
+    # ms
+    block: int = 1000
+    # ms a pending entry waits before another consumer takes it over
+    claim_idle: int = 60000
+    # terms a query prefix expands to
+    max_prefix_terms: int = 50
+    page_size: int = 50
+
+
+class _SettingsPersistence(BaseSettings):
+    # status batches join the message stream for persistence.py, which writes both to postgres
+    enabled: bool = False
+    dsn: str = 'postgresql://chat@postgres/chat'
+    pool_size: int = 4
+    group: str = 'persistence'
+    # stream entries written in one transaction
+    batch_size: int = 500
+    # ms
+    block: int = 1000
+    # ms a pending entry waits before another consumer takes it over
+    claim_idle: int = 60000
+
+
+class _SettingsRedis(BaseSettings):
+    # chat channels and messages are spread over all nodes, the first one also keeps shared keys
+    urls: list[str] = ['redis://redis:6379']
+    virtual_nodes: int = 160
+    # channel messages buffered per local subscriber before the oldest is dropped
+    max_pending: int = 1024
+    # connections per node and client, commands wait pool_timeout seconds for a free one
+    max_connections: int = 64
+    pool_timeout: float = 5
+    # commands of one event loop tick sent in one pipeline
+    auto_pipeline_max: int = 512
+
+
+class _SettingsLimits(BaseSettings):
+    # characters of message text
+    max_text_length: int = 4000
+    max_attachments: int = 10
+    # bytes of one websocket frame, larger ones close the socket with 1009
+    max_frame_size: int = 64 * 1024
+
+
+class _SettingsDedup(BaseSettings):
+    # seconds a client id is remembered per user, longer than clients keep retrying
+    window: int = 600
+
+
+class _SettingsAttachments(BaseSettings):
+    root: str = '/var/lib/chat/attachments'
+    # bytes
+    max_size: int = 100 * 1024 * 1024
+
+
+class _SettingsFanout(BaseSettings):
+    # local sockets of a chat from which its channel messages are decoded and checked once per process
+    threshold: int = 16
+
+
+class _SettingsTracing(BaseSettings):
+    # share of on_receive and on_channel_message calls timed span by span
+    sample_rate: float = 0.01
+
+
+class _Settings(BaseSettings):
+    send_queue: _SettingsSendQueue = _SettingsSendQueue()
+    receipts: _SettingsReceipts = _SettingsReceipts()
+    protocol: _SettingsProtocol = _SettingsProtocol()
+    server: _SettingsServer = _SettingsServer()
+    compression: _SettingsCompression = _SettingsCompression()
+    batching: _SettingsBatching = _SettingsBatching()
+    presence: _SettingsPresence = _SettingsPresence()
+    events: _SettingsEvents = _SettingsEvents()
+    auth: _SettingsAuth = _SettingsAuth()
+    drain: _SettingsDrain = _SettingsDrain()
+    admission: _SettingsAdmission = _SettingsAdmission()
+    redis: _SettingsRedis = _SettingsRedis()
+    inbox: _SettingsInbox = _SettingsInbox()
+    search: _SettingsSearch = _SettingsSearch()
+    persistence: _SettingsPersistence = _SettingsPersistence()
+    limits: _SettingsLimits = _SettingsLimits()
+    dedup: _SettingsDedup = _SettingsDedup()
+    attachments: _SettingsAttachments = _SettingsAttachments()
+    fanout: _SettingsFanout = _SettingsFanout()
+    tracing: _SettingsTracing = _SettingsTracing()
+
+
+settings = _Settings()
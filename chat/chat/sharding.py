@@ -0,0 +1,151 @@
+from bisect import bisect
+from hashlib import md5
+from time import perf_counter
+from typing import Any
+from uuid import UUID, uuid4
+
+from redis.asyncio.client import Pipeline, Redis
+from redis.asyncio.connection import BlockingConnectionPool
+
+from autopipeline import AutoPipeline
+from metrics import registry
+
+# channels of other kinds, permission updates among them, are published on the primary node
+SHARDED_CHANNEL_PREFIX = 'chat:'
+
+
+redis_latency = registry.histogram('chat_redis_command_seconds',
+                                   'Redis command latency by command, pipelines as a whole')
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(md5(value.encode()).digest()[:8], 'big')
+
+
+def routing_key(key: str) -> str:
+    """
+    chat:<uuid>, cachedmessage:<uuid>, inbox:<user id> and the like are routed by the last segment
+    """
+    return key.rsplit(':', 1)[-1]
+
+
+class InstrumentedPipeline(Pipeline):
+
+    async def execute(self, raise_on_error: bool = True) -> list[Any]:
+        started = perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            redis_latency.observe(perf_counter() - started, command='PIPELINE')
+
+
+class InstrumentedRedis(Redis):
+    """
+    client timing each round trip into the redis latency histogram
+    """
+
+    async def execute_command(self, *args: Any, **options: Any) -> Any:
+        started = perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            redis_latency.observe(perf_counter() - started, command=str(args[0]).upper())
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class HashRing:
+
+    def __init__(self, nodes: list[str], virtual_nodes: int) -> None:
+        if not nodes:
+            raise ValueError('Hash ring needs at least one node')
+        points = sorted((_hash(f'{node}#{i}'), node)
+                        for node in nodes
+                        for i in range(virtual_nodes))
+        self.nodes: list[str] = list(nodes)
+        self._hashes: list[int] = [point for point, _ in points]
+        self._owners: list[str] = [node for _, node in points]
+
+    def node(self, key: str) -> str:
+        return self._owners[bisect(self._hashes, _hash(key)) % len(self._owners)]
+
+
+class ShardedRedis:
+    """
+    chat channels and message keys spread over redis nodes by consistent hashing
+    """
+
+    def __init__(self,
+                 urls: list[str],
+                 virtual_nodes: int,
+                 max_connections: int = 64,
+                 pool_timeout: float = 5,
+                 auto_pipeline_max: int = 512,
+                 **options: Any) -> None:
+        self.ring = HashRing(urls, virtual_nodes)
+
+        # commands wait up to pool_timeout seconds for one of max_connections instead of opening more
+        def client(url: str, **client_options: Any) -> Redis:
+            return InstrumentedRedis(connection_pool=BlockingConnectionPool.from_url(
+                url, max_connections=max_connections, timeout=pool_timeout, **client_options, **options))
+
+        self.clients: dict[str, Redis] = dict(
+            (url, client(url, encoding='utf-8', decode_responses=True))
+            for url in urls)
+        # pub/sub clients for binary channel encodings
+        self.binary_clients: dict[str, Redis] = dict(
+            (url, client(url, decode_responses=False))
+            for url in urls)
+        self.auto_pipeline_max: int = auto_pipeline_max
+        self._auto_pipelines: dict[str, AutoPipeline] = dict()
+
+    @property
+    def primary(self) -> str:
+        return self.ring.nodes[0]
+
+    def shard(self, key: str) -> str:
+        return self.ring.node(routing_key(key))
+
+    def client(self, key: str) -> Redis:
+        return self.clients[self.shard(key)]
+
+    def group(self, keys: list[str]) -> dict[str, list[str]]:
+        groups: dict[str, list[str]] = dict()
+        for key in keys:
+            groups.setdefault(self.shard(key), []).append(key)
+        return groups
+
+    def channel_shard(self, channel: str) -> str:
+        if channel.startswith(SHARDED_CHANNEL_PREFIX):
+            return self.shard(channel)
+        return self.primary
+
+    def channel_client(self, channel: str) -> Redis:
+        return self.clients[self.channel_shard(channel)]
+
+    def group_channels(self, channels: list[str]) -> dict[str, list[str]]:
+        groups: dict[str, list[str]] = dict()
+        for channel in channels:
+            groups.setdefault(self.channel_shard(channel), []).append(channel)
+        return groups
+
+    def pipelined(self, shard: str) -> AutoPipeline:
+        """
+        auto pipeline of the shard text client, concurrent single commands share round trips
+        """
+        auto_pipeline = self._auto_pipelines.get(shard)
+        if auto_pipeline is None or auto_pipeline.client is not self.clients[shard]:
+            auto_pipeline = self._auto_pipelines[shard] = AutoPipeline(self.clients[shard], self.auto_pipeline_max)
+        return auto_pipeline
+
+    def mint_uuid(self, routing: UUID) -> UUID:
+        """
+        new uuid living on the same shard as routing, so a message found
+        by its own uuid sits next to its chat channel
+        """
+        shard = self.shard(str(routing))
+        while True:
+            uuid = uuid4()
+            if len(self.clients) == 1 or self.shard(str(uuid)) == shard:
+                return uuid
@@ -0,0 +1,62 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from random import random
+from time import perf_counter
+from typing import Callable, Iterator
+from uuid import uuid4
+
+from metrics import registry
+
+# span name, seconds, trace id
+SpanHook = Callable[[str, float, str], None]
+
+span_seconds = registry.histogram('chat_span_seconds',
+                                  'Durations of sampled hot path spans')
+
+# trace id of the running span, empty inside a root that was not sampled
+_trace: ContextVar[str | None] = ContextVar('trace', default=None)
+
+
+class Tracer:
+    """
+    samples a share of root spans, spans opened inside a sampled root are recorded
+    under its trace id, finished spans are handed to every hook
+    """
+
+    def __init__(self, sample_rate: float) -> None:
+        self.sample_rate: float = sample_rate
+        self.hooks: list[SpanHook] = [self.observe]
+
+    @staticmethod
+    def observe(name: str, seconds: float, trace_id: str) -> None:
+        span_seconds.observe(seconds, span=name)
+
+    def add_hook(self, hook: SpanHook) -> None:
+        self.hooks.append(hook)
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        trace_id = _trace.get()
+        if trace_id == '':
+            yield
+            return
+        token = None
+        if trace_id is None:
+            sampled = random() < self.sample_rate
+            trace_id = uuid4().hex if sampled else ''
+            token = _trace.set(trace_id)
+            if not sampled:
+                try:
+                    yield
+                finally:
+                    _trace.reset(token)
+                return
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            seconds = perf_counter() - started
+            if token is not None:
+                _trace.reset(token)
+            for hook in self.hooks:
+                hook(name, seconds, trace_id)
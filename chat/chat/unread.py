@@ -0,0 +1,76 @@
+import asyncio
+from uuid import UUID
+
+from scripts import UNREAD_INCREMENT, UNREAD_READ
+from sharding import ShardedRedis
+
+
+class UnreadCounters:
+    """
+    unread counter, read cursor and last counted seq hashes per user keyed by chat uuid,
+    messages are ordered by their per chat seq, counters grow on send and shrink when
+    the cursor moves forward, both in scripts on the shard of the user
+    """
+
+    def __init__(self, shards: ShardedRedis) -> None:
+        self.shards: ShardedRedis = shards
+        self.increments = dict((shard, client.register_script(UNREAD_INCREMENT))
+                               for shard, client in self.shards.clients.items())
+        self.reads = dict((shard, client.register_script(UNREAD_READ))
+                          for shard, client in self.shards.clients.items())
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f'unread:{user_id}'
+
+    @staticmethod
+    def cursor_key(user_id: int) -> str:
+        return f'readcursor:{user_id}'
+
+    @staticmethod
+    def last_key(user_id: int) -> str:
+        return f'lastseq:{user_id}'
+
+    def _keys(self, user_id: int) -> list[str]:
+        return [self.key(user_id), self.cursor_key(user_id), self.last_key(user_id)]
+
+    def _group(self, user_ids: list[int]) -> dict[str, list[int]]:
+        groups: dict[str, list[int]] = dict()
+        for user_id in user_ids:
+            groups.setdefault(self.shards.shard(self.key(user_id)), []).append(user_id)
+        return groups
+
+    async def increment(self, members: set[int], chat: UUID, seq: int) -> None:
+        await asyncio.gather(*(self.increments[shard](keys=[key for user_id in user_ids
+                                                            for key in self._keys(user_id)],
+                                                      args=[str(chat), seq])
+                               for shard, user_ids in self._group(list(members)).items()))
+
+    async def mark_read(self, cursors: dict[tuple[int, UUID], int]) -> None:
+        """
+        reading a message moves the user cursor of its chat up to the message seq
+        """
+        reads: dict[int, list[tuple[UUID, int]]] = dict()
+        for (user_id, chat), seq in cursors.items():
+            reads.setdefault(user_id, []).append((chat, seq))
+        # one script call per shard, a user with several chats repeats its keys
+        calls: dict[str, tuple[list[str], list]] = dict()
+        for shard, user_ids in self._group(list(reads)).items():
+            keys, args = calls.setdefault(shard, ([], []))
+            for user_id in user_ids:
+                for chat, seq in reads[user_id]:
+                    keys.extend(self._keys(user_id))
+                    args.extend((str(chat), seq))
+        await asyncio.gather(*(self.reads[shard](keys=keys, args=args)
+                               for shard, (keys, args) in calls.items()))
+
+    async def counts(self, user_id: int) -> tuple[dict[str, int], dict[str, int]]:
+        """
+        all unread counters and cursors of the user in one round trip
+        """
+        async with self.shards.client(self.key(user_id)).pipeline(transaction=False) as pipe:
+            pipe.hgetall(self.key(user_id))
+            pipe.hgetall(self.cursor_key(user_id))
+            counts, cursors = await pipe.execute()
+        return (dict((chat, int(count)) for chat, count in counts.items()),
+                dict((chat, int(seq)) for chat, seq in cursors.items()))
@@ -0,0 +1,121 @@
+import asyncio
+import json
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Hashable
+
+from redis.asyncio.client import Redis
+from redis.exceptions import RedisError
+
+from metrics import registry
+from schemas import User
+from utils import type_key
+
+user_cache = registry.counter('chat_user_cache_total',
+                              'User profile cache lookups by result')
+user_lookups = registry.counter('chat_user_lookups_total',
+                                'Batched profile lookups against the redis mirror')
+
+
+class TTLCache:
+    """
+    least recently used entries up to max_size, each one expires ttl seconds after it was set
+    """
+
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size: int = max_size
+        self.ttl: float = ttl
+        self._items: OrderedDict[Hashable, tuple[Any, float]] = OrderedDict()  # key: (value, expires)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Any | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires <= monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self._items[key] = (value, monotonic() + ttl)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+
+class UserDirectory:
+    """
+    user profiles from a local cache, misses collected during one window are filled
+    by one MGET of the profile mirror auth keeps in redis, so a reconnect storm costs
+    a few batched lookups instead of one per socket
+    """
+
+    def __init__(self, redis: Redis, cache_size: int, ttl: float, window: float) -> None:
+        self.redis: Redis = redis
+        self.cache = TTLCache(cache_size, ttl)
+        self.window: float = window
+        self.waiting: dict[int, asyncio.Future] = dict()  # user id: profile
+        self._fill_task: asyncio.Task | None = None
+
+    @staticmethod
+    def key(user_id: int) -> str:
+        return f'{type_key(User)}:{user_id}'
+
+    async def get(self, user_id: int) -> User:
+        user = self.cache.get(user_id)
+        if user is not None:
+            user_cache.inc(result='hit')
+            return user
+        user_cache.inc(result='miss')
+        future = self.waiting.get(user_id)
+        if future is None:
+            future = self.waiting[user_id] = asyncio.get_running_loop().create_future()
+            if self._fill_task is None:
+                self._fill_task = asyncio.create_task(self._fill_later(), name='user_fill_task')
+        # a cancelled handshake must not cancel the lookup of the others
+        return await asyncio.shield(future)
+
+    @staticmethod
+    def _user(user_id: int, profile: str | None) -> User:
+        if not profile:
+            return User(id=user_id, name='')
+        try:
+            return User(id=user_id, name=json.loads(profile)['name'])
+        except (ValueError, TypeError, KeyError):
+            return User(id=user_id, name='')
+
+    async def get_many(self, user_ids: list[int]) -> dict[int, User]:
+        return dict(zip(user_ids, await asyncio.gather(*(self.get(user_id) for user_id in user_ids))))
+
+    async def _fill_later(self) -> None:
+        await asyncio.sleep(self.window)
+        self._fill_task = None
+        await self.fill()
+
+    async def fill(self) -> None:
+        waiting, self.waiting = self.waiting, dict()
+        if not waiting:
+            return
+        user_ids = list(waiting)
+        try:
+            profiles = await self.redis.mget([self.key(user_id) for user_id in user_ids])
+            user_lookups.inc()
+        except RedisError:
+            # tokens are verified already, connect with a nameless user and look up again next time
+            for user_id, future in waiting.items():
+                if not future.done():
+                    future.set_result(User(id=user_id, name=''))
+            return
+        for user_id, profile in zip(user_ids, profiles):
+            user = self._user(user_id, profile)
+            self.cache.set(user_id, user)
+            if not waiting[user_id].done():
+                waiting[user_id].set_result(user)
@@ -1,6 +1,6 @@
 import json
 from pydoc import locate
-from typing import Any, Iterable
+from typing import Any
 
 
 def convert_json(data: str) -> dict[str, Any]:
@@ -15,15 +15,6 @@ def convert_json(data: str) -> dict[str, Any]:
         return json_data
 
 
-def to_type_object(data: dict[str, Any], classes: Iterable[type]) -> Any:
-    try:
-        for t in classes:
-            return t(**data)
-    except TypeError:
-        pass
-    return None
-
-
 def type_key(t: type) -> str:
     return t.__name__.lower()
 
@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+# service modules are imported flat, the same way the container runs them
+sys.path.insert(0, str(Path(__file__).parent.parent / 'chat'))
+
+import fakeredis.aioredis
+import pytest
+
+from sharding import ShardedRedis
+
+
+def fake_shards(*urls: str) -> ShardedRedis:
+    """
+    sharded redis over one fake server per url
+    """
+    shards = ShardedRedis(list(urls), 16)
+    for url in urls:
+        shard_server = fakeredis.FakeServer()
+        shards.clients[url] = fakeredis.aioredis.FakeRedis(server=shard_server, decode_responses=True)
+        shards.binary_clients[url] = fakeredis.aioredis.FakeRedis(server=shard_server)
+    return shards
+
+
+@pytest.fixture
+def shards() -> ShardedRedis:
+    return fake_shards('redis://node1', 'redis://node2')
@@ -0,0 +1,49 @@
+import asyncio
+from time import monotonic
+
+import pytest
+
+from admission import AdmissionController
+
+
+@pytest.mark.asyncio
+async def test_connects_paced_by_token_bucket():
+    admission = AdmissionController(rate=100, burst=5, max_handshakes=100, max_waiting=100, timeout=1)
+    started = monotonic()
+    assert all(await asyncio.gather(*(admission.acquire() for _ in range(15))))
+    # 5 from the burst, 10 more at 100 a second
+    assert 0.08 <= monotonic() - started < 0.5
+    assert admission.handshakes == 15
+
+
+@pytest.mark.asyncio
+async def test_handshakes_bounded():
+    admission = AdmissionController(rate=1000, burst=1000, max_handshakes=2, max_waiting=100, timeout=1)
+    running = 0
+    peak = 0
+
+    async def connect() -> None:
+        nonlocal running, peak
+        assert await admission.acquire()
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        admission.release()
+
+    await asyncio.gather(*(connect() for _ in range(10)))
+    assert peak == 2
+    assert admission.handshakes == 0
+
+
+@pytest.mark.asyncio
+async def test_refused_after_timeout_or_when_line_is_full():
+    admission = AdmissionController(rate=1000, burst=1000, max_handshakes=1, max_waiting=1, timeout=0.05)
+    assert await admission.acquire()
+    waiting = asyncio.create_task(admission.acquire())
+    await asyncio.sleep(0)
+    assert not await admission.acquire()  # line full
+    assert not await waiting  # timed out
+    assert admission.waiting == 0
+    admission.release()
+    assert await admission.acquire()
@@ -0,0 +1,47 @@
+import asyncio
+
+import fakeredis.aioredis
+import pytest
+from redis.exceptions import ResponseError
+
+from autopipeline import AutoPipeline
+
+
+@pytest.mark.asyncio
+async def test_one_round_trip_per_tick(mocker):
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    await redis.set('a', '1')
+    auto_pipeline = AutoPipeline(redis, 100)
+    pipeline = mocker.spy(redis, 'pipeline')
+    results = await asyncio.gather(auto_pipeline.get('a'), auto_pipeline.exists('a', 'b'),
+                                   auto_pipeline.set('c', '3', 10), auto_pipeline.get('c'))
+    assert results == ['1', 1, True, '3']
+    assert pipeline.call_count == 1
+    assert 0 < await redis.ttl('c') <= 10
+
+
+@pytest.mark.asyncio
+async def test_batches_capped():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    auto_pipeline = AutoPipeline(redis, 3)
+    flushes = []
+    send = auto_pipeline._send
+
+    async def counted(commands):
+        flushes.append(len(commands))
+        await send(commands)
+
+    auto_pipeline._send = counted
+    assert await asyncio.gather(*(auto_pipeline.exists(str(i)) for i in range(7))) == [0] * 7
+    assert flushes == [3, 3, 1]
+
+
+@pytest.mark.asyncio
+async def test_errors_stay_with_their_command():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    await redis.lpush('list', 'x')
+    auto_pipeline = AutoPipeline(redis, 100)
+    results = await asyncio.gather(auto_pipeline.get('list'), auto_pipeline.exists('list'),
+                                   return_exceptions=True)
+    assert isinstance(results[0], ResponseError)
+    assert results[1] == 1
@@ -0,0 +1,98 @@
+from uuid import uuid4
+
+import pytest
+
+from blobs import (BlobError, BlobResponse, FileBlobStore, byte_range,
+                   content_range_start)
+from codec import JsonCodec, MsgpackCodec
+from schemas import Attachment, Message, MessageStatus, NewMessage, User
+
+
+async def chunks(*parts: bytes):
+    for part in parts:
+        yield part
+
+
+async def respond(response: BlobResponse, scope: dict) -> tuple[dict, bytes]:
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await response(dict(type='http', method='GET', **scope), None, send)
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+    return sent[0], body
+
+
+@pytest.mark.asyncio
+async def test_upload_resumes_at_received_offset(tmp_path):
+    store = FileBlobStore(str(tmp_path), max_size=10)
+    chat = uuid4()
+    blob = await store.create(chat, 1, 'a.txt', 'text/plain', 10)
+    blob = await store.write(blob, 0, chunks(b'0123', b'45'))
+    assert blob.received == 6 and not blob.complete
+    with pytest.raises(BlobError):
+        await store.write(blob, 4, chunks(b'4567'))
+    with pytest.raises(BlobError):
+        await store.write(blob, 6, chunks(b'6789', b'X'))
+    # the chunk before the oversized one was kept
+    blob = await store.get(blob.uuid)
+    assert blob.received == 10 and blob.complete
+    assert store.path(blob.uuid).read_bytes() == b'0123456789'
+    assert await store.attachments([blob.uuid], chat, 1) == [blob.attachment()]
+    assert await store.attachments([blob.uuid], chat, 2) is None
+    assert await store.attachments([blob.uuid, uuid4()], chat, 1) is None
+    with pytest.raises(BlobError):
+        await store.create(chat, 1, 'big', 'text/plain', 11)
+
+
+def test_ranges():
+    assert content_range_start(None) == 0
+    assert content_range_start('bytes 100-199/1000') == 100
+    with pytest.raises(BlobError):
+        content_range_start('bytes 5-1/10')
+    assert byte_range(None, 10) is None
+    assert byte_range('bytes=2-4', 10) == (2, 3)
+    assert byte_range('bytes=7-', 10) == (7, 3)
+    assert byte_range('bytes=-3', 10) == (7, 3)
+    assert byte_range('bytes=5-100', 10) == (5, 5)
+    assert byte_range('bytes=0-1,4-5', 10) is None
+    with pytest.raises(BlobError):
+        byte_range('bytes=10-', 10)
+
+
+@pytest.mark.asyncio
+async def test_download_ranges(tmp_path):
+    store = FileBlobStore(str(tmp_path), max_size=100)
+    blob = await store.create(uuid4(), 1, 'a b.txt', 'text/plain', 10)
+    blob = await store.write(blob, 0, chunks(b'0123456789'))
+    path = store.path(blob.uuid)
+    start, body = await respond(BlobResponse(path, blob), dict())
+    assert start['status'] == 200 and body == b'0123456789'
+    assert (b'content-disposition', b"attachment; filename*=utf-8''a%20b.txt") in start['headers']
+    start, body = await respond(BlobResponse(path, blob, 'bytes=3-5'), dict())
+    assert start['status'] == 206 and body == b'345'
+    assert (b'content-range', b'bytes 3-5/10') in start['headers']
+    assert (b'content-length', b'3') in start['headers']
+    start, body = await respond(BlobResponse(path, blob, 'bytes=20-'), dict())
+    assert start['status'] == 416 and body == b''
+    # servers with the zerocopysend extension get the file itself
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    await BlobResponse(path, blob, 'bytes=8-')(dict(type='http', method='GET',
+                                                    extensions={'http.response.zerocopysend': {}}), None, send)
+    assert sent[1]['type'] == 'http.response.zerocopysend'
+    assert (sent[1]['offset'], sent[1]['count']) == (8, 2)
+
+
+def test_attachments_round_trip():
+    attachment = Attachment(uuid=uuid4(), name='a.png', content_type='image/png', size=123)
+    message = Message(receiver=uuid4(), status=MessageStatus.SENT, sender=User(id=1, name=''),
+                      text='', uuid=uuid4(), attachments=[attachment])
+    new_message = NewMessage(receiver=uuid4(), text='', attachments=[attachment.uuid])
+    for codec in (JsonCodec(), MsgpackCodec()):
+        assert codec.decode(codec.encode(message), (Message,)).attachments == [attachment]
+        assert codec.decode(codec.encode(new_message), (NewMessage,)).attachments == [attachment.uuid]
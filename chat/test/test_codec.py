@@ -0,0 +1,85 @@
+from uuid import uuid4
+
+import msgpack
+import pytest
+
+from codec import MSGPACK_SUBPROTOCOL, JsonCodec, MsgpackCodec, negotiate
+from schemas import (Message, MessageAck, MessageStatus, MessageStatusBatch, NewMessage,
+                     PresenceBatch, Reconnect, UnreadCounts, UpdateMessage,
+                     User, UserStatus)
+
+FRAMES = (
+    Message(receiver=uuid4(), status=MessageStatus.SENT,
+            sender=User(id=7, name=''), text='text', uuid=uuid4(), seq=5, sent_at=1700000000.25),
+    NewMessage(receiver=uuid4(), text='text'),
+    NewMessage(receiver=uuid4(), text='text', client_id=uuid4()),
+    UpdateMessage(status=MessageStatus.READ, uuid=uuid4()),
+    MessageStatusBatch(receiver=uuid4(), updates={str(uuid4()): MessageStatus.DELIVERED}),
+    UnreadCounts(counts={str(uuid4()): 3}, cursors={str(uuid4()): 42}),
+    Reconnect(delay=2.5),
+    MessageAck(receiver=uuid4(), client_id=uuid4(), uuid=uuid4()),
+)
+CLASSES = (Message, NewMessage, UpdateMessage, MessageStatusBatch, UnreadCounts, Reconnect, MessageAck)
+
+
+@pytest.mark.parametrize('frame', FRAMES)
+def test_msgpack_round_trip(frame):
+    codec = MsgpackCodec()
+    assert codec.decode(codec.encode(frame), CLASSES) == frame
+
+
+def test_msgpack_smaller_than_json():
+    message = FRAMES[0]
+    assert len(MsgpackCodec().encode(message)) < len(JsonCodec().encode(message)) / 2
+
+
+def test_msgpack_sender_id_only():
+    message = FRAMES[0].copy(update={'sender': User(id=7, name='user')})
+    decoded = MsgpackCodec().decode(MsgpackCodec().encode(message), CLASSES)
+    assert decoded.sender == User(id=7, name='')
+
+
+def test_msgpack_unexpected_frame():
+    codec = MsgpackCodec()
+    assert codec.decode(codec.encode(FRAMES[1]), (Message, UpdateMessage)) is None
+    assert codec.decode(b'\xc1', CLASSES) is None
+    assert codec.decode(b'\x93\x03\x09\x00', CLASSES) is None
+    # hot frames skip validation, malformed fields are still rejected
+    receiver = uuid4().bytes
+    assert codec.decode(msgpack.packb([2, receiver, 1]), CLASSES) is None
+    assert codec.decode(msgpack.packb([2, receiver, 'text', [b'short']]), CLASSES) is None
+    assert codec.decode(msgpack.packb([2, receiver, 'text', [], 5]), CLASSES) is None
+    assert codec.decode(msgpack.packb([1, receiver, 0, 'id', 'text', uuid4().bytes, 1]), CLASSES) is None
+    assert codec.decode(msgpack.packb([3, -1, uuid4().bytes]), CLASSES) is None
+
+
+def test_negotiate():
+    assert isinstance(negotiate(['other', MSGPACK_SUBPROTOCOL]), MsgpackCodec)
+    assert isinstance(negotiate([]), JsonCodec)
+
+
+def test_msgpack_presence_batch():
+    codec = MsgpackCodec()
+    batch = PresenceBatch(receiver=uuid4(), users={1: UserStatus.ONLINE, 2: UserStatus.OFFLINE})
+    assert codec.decode(codec.encode(batch), (PresenceBatch,)) == batch
+
+
+@pytest.mark.parametrize('frame', FRAMES)
+def test_json_round_trip(frame):
+    codec = JsonCodec()
+    assert codec.decode(codec.encode(frame), CLASSES) == frame
+
+
+def test_json_dispatch_by_type():
+    codec = JsonCodec()
+    uuid = uuid4()
+    update = f'{{"type": "update_message", "status": "READ", "uuid": "{uuid}"}}'
+    assert codec.decode(update, CLASSES) == UpdateMessage(status=MessageStatus.READ, uuid=uuid)
+    # a frame of a class the caller doesn't expect
+    assert codec.decode(update, (NewMessage,)) is None
+    # untyped and malformed frames are rejected, not guessed
+    assert codec.decode(f'{{"status": "READ", "uuid": "{uuid}"}}', CLASSES) is None
+    assert codec.decode('{"type": "new_message", "receiver": "x", "text": "text"}', CLASSES) is None
+    assert codec.decode('{"type": "new_message", "receiver": "' + str(uuid) + '", "text": 1}', CLASSES) is None
+    assert codec.decode('[1]', CLASSES) is None
+    assert codec.decode('{', CLASSES) is None
@@ -0,0 +1,67 @@
+from types import SimpleNamespace
+from uuid import uuid4
+
+from websockets.frames import OP_CONT, OP_PING, OP_TEXT, Frame
+
+from codec import JsonCodec, MsgpackCodec
+import compression
+from compression import ChatWebSocketProtocol, ThresholdPerMessageDeflate
+from schemas import MessageStatus, MessageStatusBatch
+
+
+def test_small_messages_uncompressed():
+    extension = ThresholdPerMessageDeflate(False, False, 15, 15, min_size=100)
+    small = Frame(OP_TEXT, b'x' * 10)
+    assert extension.encode(small) == small
+    ping = Frame(OP_PING, b'x' * 200)
+    assert extension.encode(ping) == ping
+
+
+def test_large_messages_compressed():
+    extension = ThresholdPerMessageDeflate(False, False, 15, 15, min_size=100)
+    encoded = extension.encode(Frame(OP_TEXT, b'x' * 1000, fin=False))
+    assert encoded.rsv1 is True
+    assert len(encoded.data) < 100
+    continuation = extension.encode(Frame(OP_CONT, b'x' * 10))
+    assert continuation.data != b'x' * 10
+
+
+def wire_bytes(payloads: list, extension: ThresholdPerMessageDeflate | None) -> int:
+    """
+    payload bytes after permessage-deflate plus a 2 byte frame header per send
+    """
+    total = 0
+    for payload in payloads:
+        data = payload.encode() if isinstance(payload, str) else payload
+        frame = Frame(OP_TEXT, data)
+        if extension:
+            frame = extension.encode(frame)
+        total += len(frame.data) + 2
+    return total
+
+
+def test_batched_compressed_msgpack_reduces_wire_bytes_and_sends():
+    chat = uuid4()
+    frames = [MessageStatusBatch(receiver=chat, updates={str(uuid4()): MessageStatus.DELIVERED})
+              for _ in range(64)]
+    json_codec, msgpack_codec = JsonCodec(), MsgpackCodec()
+    plain = [json_codec.encode(frame) for frame in frames]
+    batched = [msgpack_codec.encode_batch(frames[i:i + 16]) for i in range(0, len(frames), 16)]
+    extension = ThresholdPerMessageDeflate(False, False, 15, 15, min_size=256)
+    plain_bytes = wire_bytes(plain, None)
+    batched_bytes = wire_bytes(batched, extension)
+    # one send syscall per websocket frame
+    assert len(batched) * 16 == len(plain)
+    assert batched_bytes < plain_bytes / 2
+
+
+def test_wire_bytes_counted_after_deflate():
+    written = []
+    protocol = SimpleNamespace(is_client=False,
+                               extensions=[ThresholdPerMessageDeflate(False, False, 15, 15, min_size=100)],
+                               transport=SimpleNamespace(write=written.append))
+    counted = compression.wire_bytes.value()
+    ChatWebSocketProtocol.write_frame_sync(protocol, True, OP_TEXT, b'x' * 1000)
+    ChatWebSocketProtocol.write_frame_sync(protocol, True, OP_PING, b'')
+    assert len(written) == 2
+    assert compression.wire_bytes.value() - counted == len(written[0]) < 100
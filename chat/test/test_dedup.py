@@ -0,0 +1,70 @@
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pytest
+
+import endpoints
+from codec import JsonCodec
+from conftest import fake_shards
+from endpoints import ChatEndpoint, RedisChatEndpoint
+from schemas import MessageAck, NewMessage, User
+
+
+@pytest.fixture
+def endpoint(mocker):
+    shards = fake_shards('redis://node1', 'redis://node2')
+    mocker.patch.object(endpoints, 'shards', shards)
+    mocker.patch.object(endpoints.search_index, 'append')
+    endpoint = ChatEndpoint({'type': 'websocket'}, None, None, shards.clients[shards.primary])
+    endpoint.redis = RedisChatEndpoint(shards.clients[shards.primary], shards, JsonCodec())
+    endpoint.outbox = mocker.Mock()
+    mocker.patch.object(endpoint.security, 'is_permitted', return_value=True)
+    mocker.patch.object(endpoint, 'track_members')
+    return endpoint
+
+
+def socket(user_id: int) -> SimpleNamespace:
+    return SimpleNamespace(user=SimpleNamespace(user=User(id=user_id, name='user'), uuid=uuid4()))
+
+
+@pytest.mark.asyncio
+async def test_retried_send_acknowledged_once_published(endpoint, mocker):
+    publish = mocker.spy(endpoint.redis, 'cache_message')
+    new_message = NewMessage(receiver=uuid4(), text='text', client_id=uuid4())
+    for _ in range(3):
+        await endpoint.on_receive(socket(1), new_message.json())
+    assert publish.call_count == 1
+    acks = [call.args[0] for call in endpoint.outbox.put.call_args_list]
+    assert all(isinstance(ack, MessageAck) for ack in acks) and len(acks) == 3
+    assert set(ack.uuid for ack in acks) == {publish.call_args.args[0].uuid}
+    # the same client id of another user or without one is a new message
+    await endpoint.on_receive(socket(2), new_message.json())
+    await endpoint.on_receive(socket(1), NewMessage(receiver=new_message.receiver, text='text').json())
+    await endpoint.on_receive(socket(1), NewMessage(receiver=new_message.receiver, text='text').json())
+    assert publish.call_count == 4
+
+
+@pytest.mark.asyncio
+async def test_failed_send_can_be_retried(endpoint, mocker):
+    publish = mocker.patch.object(endpoint.redis, 'cache_message', side_effect=[ConnectionError, None])
+    new_message = NewMessage(receiver=uuid4(), text='text', client_id=uuid4())
+    with pytest.raises(ConnectionError):
+        await endpoint.on_receive(socket(1), new_message.json())
+    await endpoint.on_receive(socket(1), new_message.json())
+    assert publish.call_count == 2
+    assert endpoint.outbox.put.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_of_running_send_not_acknowledged(endpoint, mocker):
+    new_message = NewMessage(receiver=uuid4(), text='text', client_id=uuid4())
+    sent_key = endpoint.redis.sent_key(1, new_message.client_id, new_message.receiver)
+    # claimed by a send whose message is not cached yet
+    seq, original = await endpoint.redis.claim_send(sent_key, new_message.receiver, uuid4(), 600)
+    assert seq == 1 and original is None
+    publish = mocker.spy(endpoint.redis, 'cache_message')
+    await endpoint.on_receive(socket(1), new_message.json())
+    assert publish.call_count == 0
+    assert endpoint.outbox.put.call_count == 0
+    # the seq was not taken by the retry
+    assert await endpoint.redis.next_seq(new_message.receiver) == 2
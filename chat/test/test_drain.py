@@ -0,0 +1,41 @@
+from time import monotonic
+
+import pytest
+
+from drain import DrainController
+
+
+@pytest.mark.asyncio
+async def test_sockets_handed_off_in_waves():
+    controller = DrainController(waves=4, wave_interval=0.05, max_delay=3, timeout=1)
+    handed_off: dict[str, tuple[float, float]] = dict()
+
+    def register(connection_id: str) -> None:
+        async def hand_off(delay: float) -> None:
+            handed_off[connection_id] = (monotonic(), delay)
+            controller.unregister(connection_id)
+        controller.register(connection_id, hand_off)
+
+    for i in range(20):
+        register(str(i))
+    started = monotonic()
+    await controller.start()
+    assert controller.draining
+    assert len(handed_off) == 20 and not controller.connections
+    assert all(0 <= delay <= 3 for _, delay in handed_off.values())
+    waves = sorted(round((at - started) / 0.05) for at, _ in handed_off.values())
+    assert [waves.count(wave) for wave in range(4)] == [5, 5, 5, 5]
+
+
+@pytest.mark.asyncio
+async def test_drain_waits_for_last_sockets_until_timeout():
+    controller = DrainController(waves=1, wave_interval=0, max_delay=0, timeout=0.2)
+
+    async def ignore(delay: float) -> None:
+        pass
+
+    controller.register('stuck', ignore)
+    started = monotonic()
+    await controller.drain()
+    assert 0.2 <= monotonic() - started < 1
+    assert 'stuck' in controller.connections
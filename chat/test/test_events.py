@@ -0,0 +1,72 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+
+from codec import JsonCodec, MsgpackCodec
+from events import EphemeralEvents
+from ratelimit import TokenBucket
+from schemas import ChatEvent, EventBatch, EventKind
+
+
+def test_token_bucket():
+    bucket = TokenBucket(2, 3)
+    now = bucket.updated
+    assert [bucket.take(now) for _ in range(4)] == [True, True, True, False]
+    assert bucket.take(now + 0.5)
+    assert not bucket.take(now + 0.5)
+    assert bucket.full(now + 10)
+
+
+@pytest.mark.asyncio
+async def test_events_limited_per_user_and_chat(shards):
+    events = EphemeralEvents(shards, 10, 1, 2, JsonCodec())
+    chat, other = uuid4(), uuid4()
+    results = [events.add(1, ChatEvent(receiver=chat, kind=EventKind.TYPING)) for _ in range(3)]
+    assert results == [True, True, False]
+    assert events.add(2, ChatEvent(receiver=chat, kind=EventKind.TYPING))
+    assert events.add(1, ChatEvent(receiver=other, kind=EventKind.TYPING))
+    events.stop()
+
+
+@pytest.mark.asyncio
+async def test_events_outside_channels_dropped(shards):
+    events = EphemeralEvents(shards, 10, 1, 1, JsonCodec())
+    chat, other = uuid4(), uuid4()
+    channels = {f'chat:{chat}': None}
+    assert events.add(1, ChatEvent(receiver=chat, kind=EventKind.TYPING), channels)
+    assert not events.add(1, ChatEvent(receiver=other, kind=EventKind.TYPING), channels)
+    assert list(events.pending) == [chat]
+    events.stop()
+
+
+@pytest.mark.asyncio
+async def test_one_publish_per_chat_and_tick(shards):
+    codec = JsonCodec()
+    events = EphemeralEvents(shards, 10, 100, 100, codec)
+    chat = uuid4()
+    channel = f'chat:{chat}'
+    pubsub = shards.channel_client(channel).pubsub()
+    await pubsub.subscribe(channel)
+    await pubsub.get_message(timeout=1)
+    for user_id in range(1, 21):
+        events.add(user_id, ChatEvent(receiver=chat, kind=EventKind.TYPING))
+    events.add(1, ChatEvent(receiver=chat, kind=EventKind.REACTING))
+    await events.tick()
+    await events.tick()
+    message = await pubsub.get_message(timeout=1)
+    batch = codec.decode(message['data'], (EventBatch,))
+    assert len(batch.users) == 20
+    assert batch.users[1] == EventKind.REACTING
+    await asyncio.sleep(0)
+    assert await pubsub.get_message(timeout=0.1) is None
+    await pubsub.close()
+    events.stop()
+
+
+def test_msgpack_event_round_trip():
+    codec = MsgpackCodec()
+    batch = EventBatch(receiver=uuid4(), users={3: EventKind.TYPING, 4: EventKind.ACTIVE})
+    event = ChatEvent(receiver=uuid4(), kind=EventKind.REACTING)
+    assert codec.decode(codec.encode(batch), (EventBatch,)) == batch
+    assert codec.decode(codec.encode(event), (ChatEvent,)) == event
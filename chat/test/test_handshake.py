@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import pytest
+
+import endpoints
+from endpoints import ChatEndpoint
+from schemas import User
+
+
+def socket(mocker, user_id: int = 7) -> SimpleNamespace:
+    return SimpleNamespace(user=SimpleNamespace(user=User(id=user_id, name='user')),
+                           scope=dict(),
+                           accept=mocker.AsyncMock(),
+                           close=mocker.AsyncMock())
+
+
+@pytest.mark.asyncio
+async def test_refused_socket_keeps_presence_of_live_one(mocker):
+    disconnect = mocker.patch.object(endpoints.presence, 'disconnect')
+    mocker.patch.object(endpoints.admission, 'acquire', return_value=False)
+    endpoint = ChatEndpoint({'type': 'websocket'}, None, None)
+    websocket = socket(mocker)
+    # past the authentication check, the socket is a stand in
+    await ChatEndpoint.on_connect.__wrapped__(endpoint, websocket)
+    await endpoint.on_disconnect(websocket, 1013)
+    assert disconnect.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_refused_socket_sees_close_code(mocker):
+    mocker.patch.object(endpoints.admission, 'acquire', return_value=False)
+    endpoint = ChatEndpoint({'type': 'websocket'}, None, None)
+    websocket = socket(mocker)
+    await ChatEndpoint.on_connect.__wrapped__(endpoint, websocket)
+    websocket.accept.assert_awaited_once()
+    websocket.close.assert_awaited_once_with(endpoints.CLOSE_TRY_AGAIN_LATER)
+    mocker.patch.object(endpoints.drain_controller, 'draining', True)
+    websocket = socket(mocker)
+    await ChatEndpoint.on_connect.__wrapped__(endpoint, websocket)
+    websocket.accept.assert_awaited_once()
+    websocket.close.assert_awaited_once_with(endpoints.CLOSE_SERVICE_RESTART)
+
+
+@pytest.mark.asyncio
+async def test_failed_handshake_left_behind_nothing(mocker):
+    disconnect = mocker.patch.object(endpoints.presence, 'disconnect')
+    mocker.patch.object(endpoints.admission, 'acquire', return_value=True)
+    release = mocker.patch.object(endpoints.admission, 'release')
+    endpoint = ChatEndpoint({'type': 'websocket'}, None, None)
+    close = mocker.patch.object(endpoint.redis, 'close')
+    outbox = mocker.Mock()
+
+    async def handshake(websocket):
+        # failed after subscribing and presence, before catch up finished
+        endpoint.outbox, endpoint.present = outbox, True
+        raise ConnectionError
+
+    mocker.patch.object(endpoint, 'handshake', side_effect=handshake)
+    websocket = socket(mocker)
+    with pytest.raises(ConnectionError):
+        await ChatEndpoint.on_connect.__wrapped__(endpoint, websocket)
+    close.assert_awaited_once()
+    disconnect.assert_called_once_with(7)
+    outbox.stop.assert_called_once()
+    release.assert_called_once()
@@ -0,0 +1,57 @@
+from uuid import uuid4
+
+import pytest
+
+from codec import JsonCodec
+from inbox import OfflineInbox
+from presence import PresenceService
+from schemas import Message, MessageStatus, User
+
+
+def new_message(chat) -> Message:
+    return Message(receiver=chat, status=MessageStatus.SENT, sender=User(id=1, name='user'),
+                   text='text', uuid=uuid4())
+
+
+def new_inbox(shards, max_size: int = 10, page_size: int = 3) -> OfflineInbox:
+    presence = PresenceService(shards.clients[shards.primary], shards, 'node1', 30, 10, JsonCodec())
+    return OfflineInbox(shards, presence, JsonCodec(), max_size, 60, page_size)
+
+
+@pytest.mark.asyncio
+async def test_stored_for_offline_members_only(shards):
+    inbox = new_inbox(shards)
+    await inbox.presence.connect(2, set())
+    message = new_message(uuid4())
+    await inbox.store({2, 3}, message)
+    pages = []
+
+    async def deliver(messages):
+        pages.append(messages)
+
+    assert await inbox.drain(2, deliver) == 0
+    assert await inbox.drain(3, deliver) == 1
+    assert pages == [[message]]
+    assert await inbox.drain(3, deliver) == 0
+    inbox.presence._ticker.cancel()
+
+
+@pytest.mark.asyncio
+async def test_drained_oldest_first_in_pages(shards):
+    inbox = new_inbox(shards, max_size=5)
+    messages = [new_message(uuid4()) for _ in range(7)]
+    for message in messages:
+        await inbox.store({3}, message)
+    late = new_message(uuid4())
+    pages = []
+
+    async def deliver(page):
+        # pushed while draining, kept for the next drain
+        if not pages:
+            await inbox.store({3}, late)
+        pages.append(page)
+
+    assert await inbox.drain(3, deliver) == 5
+    assert pages == [messages[2:5], messages[5:]]
+    assert await inbox.drain(3, deliver) == 1
+    assert pages[-1] == [late]
@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+
+from launcher import LoadMonitor, bind, cpu_ratio, loop_lag, worker_info
+
+
+def test_workers_bind_the_same_port():
+    first = bind('127.0.0.1', 0, reuse_port=True)
+    port = first.getsockname()[1]
+    second = bind('127.0.0.1', port, reuse_port=True)
+    try:
+        assert second.getsockname()[1] == port
+        assert first.get_inheritable() and second.get_inheritable()
+    finally:
+        first.close()
+        second.close()
+
+
+def test_load_sample():
+    monitor = LoadMonitor(3, interval=1)
+    monitor.sample(started=10, cpu_started=5, now=11.25, cpu_now=5.5)
+    assert loop_lag.value(worker='3') == 0.25
+    assert cpu_ratio.value(worker='3') == 0.4
+    # a loop that woke up early never reports negative lag
+    monitor.sample(started=10, cpu_started=5, now=10.5, cpu_now=5)
+    assert loop_lag.value(worker='3') == 0
+
+
+@pytest.mark.asyncio
+async def test_load_monitor_runs_until_stopped():
+    monitor = LoadMonitor(7, interval=0.01)
+    monitor.start()
+    await asyncio.sleep(0.05)
+    monitor.stop()
+    assert worker_info.values
+    assert loop_lag.value(worker='7') >= 0
+    assert 0 <= cpu_ratio.value(worker='7')
+    assert monitor._task is None
@@ -0,0 +1,64 @@
+from uuid import uuid4
+
+import fakeredis.aioredis
+import pytest
+
+from authentication import RoleManager, SecurityManager
+from schemas import Chat, Permission, RoleLevel, User
+
+
+def chat() -> Chat:
+    return Chat(uuid=uuid4(), name='chat', owner=1)
+
+
+@pytest.mark.asyncio
+async def test_index_follows_role_changes():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    chat1, chat2 = chat(), chat()
+    await RoleManager(redis, User(id=1, name='user1')).update(chat1, RoleLevel.WRITER)
+    await RoleManager(redis, User(id=2, name='user2')).update(chat1, RoleLevel.READER)
+    await RoleManager(redis, User(id=2, name='user2')).update(chat2, RoleLevel.READER)
+    assert await RoleManager.members(redis, chat1.uuid) == {1, 2}
+    await RoleManager(redis, User(id=2, name='user2')).update(chat1, RoleLevel.BANNED)
+    assert await RoleManager.members(redis, chat1.uuid) == {1}
+    assert await RoleManager.are_members(redis, chat1.uuid, [1, 2, 3]) == {1: True, 2: False, 3: False}
+    assert await redis.smembers(RoleManager.chats_key(2)) == {str(chat2.uuid)}
+
+
+@pytest.mark.asyncio
+async def test_members_pages():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    chat1 = chat()
+    for user_id in range(25):
+        await RoleManager(redis, User(id=user_id, name='user')).update(chat1, RoleLevel.READER)
+    members, cursor = [], 0
+    while True:
+        cursor, page = await RoleManager.members_page(redis, chat1.uuid, cursor, 10)
+        members.extend(page)
+        if not cursor:
+            break
+    assert sorted(members) == list(range(25))
+
+
+@pytest.mark.asyncio
+async def test_channels_from_membership():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    user = User(id=1, name='user')
+    chat1, chat2 = chat(), chat()
+    await RoleManager(redis, user).update(chat1, RoleLevel.READER)
+    await RoleManager(redis, user).update(chat2, RoleLevel.READER)
+    security = SecurityManager(redis)
+    current = {f'chat:{chat1.uuid}', f'chat:{uuid4()}', 'permission:update:1'}
+    add, revoke = await security.load_channels_from_permissions(user, Chat, current)
+    assert add == {f'chat:{chat2.uuid}'}
+    assert revoke == current - {f'chat:{chat1.uuid}', 'permission:update:1'}
+
+
+@pytest.mark.asyncio
+async def test_permission_key():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    permission = Permission(user_uuid=uuid4(), resource_type=Chat, resource_uuid=uuid4())
+    security = SecurityManager(redis)
+    assert not await security.is_permitted(permission)
+    await redis.set(f'permission:{permission.user_uuid}:chat:{permission.resource_uuid}', 'reader')
+    assert await security.is_permitted(permission)
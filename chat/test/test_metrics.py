@@ -0,0 +1,60 @@
+import fakeredis.aioredis
+import pytest
+
+from metrics import Registry
+from sharding import InstrumentedRedis, redis_latency
+from tracing import Tracer
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Registry().histogram('latency_seconds', 'latency', (0.1, 1))
+    for value in (0.05, 0.5, 0.7, 3):
+        histogram.observe(value, route='a')
+    samples = dict(((name, labels), value) for name, labels, value in histogram.samples())
+    assert samples[('latency_seconds_bucket', (('route', 'a'), ('le', '0.1')))] == 1
+    assert samples[('latency_seconds_bucket', (('route', 'a'), ('le', '1')))] == 3
+    assert samples[('latency_seconds_bucket', (('route', 'a'), ('le', '+Inf')))] == 4
+    assert samples[('latency_seconds_count', (('route', 'a'),))] == 4
+    assert samples[('latency_seconds_sum', (('route', 'a'),))] == pytest.approx(4.25)
+
+
+def test_histogram_collect():
+    registry = Registry()
+    registry.histogram('latency_seconds', 'latency', (1,)).observe(0.5)
+    assert 'latency_seconds_bucket{le="1"} 1' in registry.collect()
+    assert '# TYPE latency_seconds histogram' in registry.collect()
+
+
+def test_sampled_root_records_nested_spans():
+    tracer = Tracer(1)
+    spans = []
+    tracer.add_hook(lambda name, seconds, trace_id: spans.append((name, trace_id)))
+    with tracer.span('root'):
+        with tracer.span('child'):
+            pass
+    assert [name for name, _ in spans] == ['child', 'root']
+    assert spans[0][1] == spans[1][1]
+
+
+def test_unsampled_root_skips_nested_spans():
+    tracer = Tracer(0)
+    spans = []
+    tracer.add_hook(lambda name, seconds, trace_id: spans.append(name))
+    with tracer.span('root'):
+        with tracer.span('child'):
+            pass
+    assert spans == []
+
+
+@pytest.mark.asyncio
+async def test_redis_latency_per_command():
+    fake = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    client = InstrumentedRedis(connection_pool=fake.connection_pool)
+    before = redis_latency.count(command='SET'), redis_latency.count(command='PIPELINE')
+    await client.set('key', 'value')
+    async with client.pipeline(transaction=False) as pipe:
+        pipe.get('key')
+        pipe.get('key')
+        assert await pipe.execute() == ['value', 'value']
+    assert redis_latency.count(command='SET') == before[0] + 1
+    assert redis_latency.count(command='PIPELINE') == before[1] + 1
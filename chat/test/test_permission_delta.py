@@ -0,0 +1,89 @@
+import json
+from types import SimpleNamespace
+from uuid import uuid4
+
+import fakeredis.aioredis
+import pytest
+
+from authentication import RoleManager, SecurityManager, user_uuid
+from codec import JsonCodec
+from conftest import fake_shards
+from endpoints import ChatEndpoint, RedisChatEndpoint
+from hub import PubSubHub
+from schemas import (Chat, EventBatch, EventKind, Message, MessageStatus,
+                     Permission, PermissionDelta, RoleLevel, User)
+
+
+def chat() -> Chat:
+    return Chat(uuid=uuid4(), name='chat', owner=1)
+
+
+def delta(**fields) -> dict:
+    return dict(type='message', data=PermissionDelta(resource_type='chat', **fields).json())
+
+
+@pytest.mark.asyncio
+async def test_role_change_publishes_delta():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    pubsub = redis.pubsub()
+    await pubsub.subscribe(Permission.update_channel(user_uuid(1)))
+    await pubsub.get_message(timeout=1)
+    chat1 = chat()
+    manager = RoleManager(redis, User(id=1, name='user'))
+    await manager.update(chat1, RoleLevel.WRITER)
+    await manager.update(chat1, RoleLevel.BANNED)
+    granted = json.loads((await pubsub.get_message(timeout=1))['data'])
+    revoked = json.loads((await pubsub.get_message(timeout=1))['data'])
+    assert granted['granted'] == [str(chat1.uuid)] and granted['revoked'] == []
+    assert revoked['revoked'] == [str(chat1.uuid)] and revoked['granted'] == []
+    await pubsub.close()
+
+
+@pytest.mark.asyncio
+async def test_delta_changes_only_its_chats(mocker):
+    shards = fake_shards('redis://node1', 'redis://node2')
+    redis = shards.clients[shards.primary]
+    hub = PubSubHub(shards, False, 16)
+    user = User(id=1, name='user')
+    chats = [chat() for _ in range(50)]
+    for resource in chats:
+        await RoleManager(redis, user).update(resource, RoleLevel.WRITER)
+    endpoint = ChatEndpoint({'type': 'websocket'}, None, None, redis)
+    endpoint.redis = RedisChatEndpoint(redis, shards, JsonCodec(), hub)
+    endpoint.security = SecurityManager(redis)
+    websocket = SimpleNamespace(user=SimpleNamespace(user=user, uuid=user_uuid(user.id)))
+    # anything but a delta reloads the whole set
+    await endpoint.on_permission_update(dict(type='message', data='reload'), websocket)
+    assert len(endpoint.redis.channels) == 50
+    subscribe, unsubscribe = mocker.spy(hub, 'subscribe'), mocker.spy(hub, 'unsubscribe')
+    load = mocker.spy(endpoint.security, 'load_channels_from_permissions')
+    new_chat = uuid4()
+    await endpoint.on_permission_update(delta(granted=[new_chat]), websocket)
+    await endpoint.on_permission_update(delta(revoked=[chats[0].uuid]), websocket)
+    await endpoint.on_permission_update(delta(granted=[chats[1].uuid]), websocket)
+    assert load.call_count == 0
+    assert [set(call.args[0]) for call in subscribe.call_args_list] == [{f'chat:{new_chat}'}]
+    assert [set(call.args[0]) for call in unsubscribe.call_args_list] == [{f'chat:{chats[0].uuid}'}]
+    assert len(endpoint.redis.channels) == 50
+    await hub.close()
+
+
+@pytest.mark.asyncio
+async def test_prepared_room_message_skips_socket_checks(mocker):
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    endpoint = ChatEndpoint({'type': 'websocket'}, None, None, redis)
+    endpoint.outbox = mocker.Mock()
+    check = mocker.spy(endpoint.security, 'is_permitted')
+    user = User(id=1, name='user')
+    websocket = SimpleNamespace(user=SimpleNamespace(user=user, uuid=user_uuid(user.id)))
+    message = Message(receiver=uuid4(), status=MessageStatus.SENT, sender=User(id=2, name='sender'),
+                      text='text', uuid=uuid4())
+    await endpoint.on_channel_message(dict(data=b'-', decoded=message, permitted=True), websocket)
+    await endpoint.on_channel_message(dict(data=b'-', decoded=message, permitted=False), websocket)
+    assert check.call_count == 0
+    assert [call.args[0] for call in endpoint.outbox.put.call_args_list] == [message]
+    # the shared batch keeps the users other sockets still need
+    batch = EventBatch(receiver=message.receiver, users={1: EventKind.TYPING, 2: EventKind.TYPING})
+    await endpoint.on_channel_message(dict(data=b'-', decoded=batch), websocket)
+    assert endpoint.outbox.put.call_args.args[0].users == {2: EventKind.TYPING}
+    assert batch.users == {1: EventKind.TYPING, 2: EventKind.TYPING}
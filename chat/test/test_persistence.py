@@ -0,0 +1,127 @@
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from uuid import uuid4
+
+import pytest
+
+from persistence import (INSERT_MESSAGES, SAVE_OFFSET, UPDATE_STATUSES,
+                         MessageArchive, month, next_month, rows)
+from schemas import (Attachment, Message, MessageStatus, MessageStatusBatch,
+                     User)
+from search import STREAM
+
+
+class FakeConnection:
+    """
+    records statements instead of running them
+    """
+
+    def __init__(self, offset: tuple[int, int] | None = None, fail: bool = False) -> None:
+        self.offset = offset
+        self.fail = fail
+        self.executed: list[tuple[str, tuple]] = []
+
+    async def execute(self, query: str, *args) -> None:
+        if self.fail and query is INSERT_MESSAGES:
+            raise OSError('connection lost')
+        self.executed.append((query, args))
+
+    async def fetchrow(self, query: str, *args):
+        return self.offset
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class FakePool:
+
+    def __init__(self, connection: FakeConnection) -> None:
+        self.connection = connection
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.connection
+
+
+def new_message(chat, **fields) -> Message:
+    return Message(receiver=chat, status=MessageStatus.SENT, sender=User(id=7, name='user'),
+                   text='text', uuid=uuid4(), seq=3, sent_at=1760000000.5, **fields)
+
+
+def test_rows():
+    chat = uuid4()
+    attachment = Attachment(uuid=uuid4(), name='a.png', content_type='image/png', size=1)
+    first, second = new_message(chat, attachments=[attachment]), new_message(chat)
+    read = MessageStatusBatch(receiver=chat, updates={str(first.uuid): MessageStatus.READ})
+    delivered = MessageStatusBatch(receiver=chat, updates={str(first.uuid): MessageStatus.DELIVERED})
+    messages, statuses = rows([('1-0', {'message': first.json()}),
+                               ('2-0', {'message': second.json()}),
+                               ('3-0', {'message': second.json()}),
+                               ('4-0', {'statuses': read.json()}),
+                               ('5-0', {'statuses': delivered.json()}),
+                               ('6-0', {'message': 'not json'})])
+    assert [row[1] for row in messages] == [first.uuid, second.uuid]
+    chat_uuid, message_uuid, seq, sender, text, attachments, status, sent_at = messages[0]
+    assert (chat_uuid, message_uuid, seq, sender, text) == (chat, first.uuid, 3, 7, 'text')
+    assert attachments == f'[{attachment.json()}]'
+    assert status == MessageStatus.SENT.rank
+    assert sent_at == datetime.fromtimestamp(1760000000.5, timezone.utc)
+    assert statuses == {first.uuid: MessageStatus.READ.rank}
+
+
+def test_months():
+    at = datetime(2026, 12, 31, 23, 59, tzinfo=timezone.utc)
+    assert month(at) == datetime(2026, 12, 1, tzinfo=timezone.utc)
+    assert next_month(at) == datetime(2027, 1, 1, tzinfo=timezone.utc)
+    assert next_month(datetime(2026, 10, 19, tzinfo=timezone.utc)) == datetime(2026, 11, 1, tzinfo=timezone.utc)
+
+
+@pytest.mark.asyncio
+async def test_batch_written_then_acked(shards):
+    connection = FakeConnection()
+    archive = MessageArchive(shards, FakePool(connection), 'node1', 'persistence', 100, 10, 60000)
+    chat = uuid4()
+    message = new_message(chat)
+    shard = shards.shard(f'history:{chat}')
+    client = shards.clients[shard]
+    await archive._create_group(client, shard)
+    await client.xadd(STREAM, {'message': message.json()})
+    last = await client.xadd(STREAM, {'statuses': MessageStatusBatch(
+        receiver=chat, updates={str(message.uuid): MessageStatus.DELIVERED}).json()})
+    assert await archive.poll(client, shard) == 2
+    queries = [query for query, _ in connection.executed]
+    assert queries[0].startswith('CREATE TABLE IF NOT EXISTS chat_messages_2025_10 PARTITION OF')
+    assert queries[1:] == [INSERT_MESSAGES, UPDATE_STATUSES, SAVE_OFFSET]
+    insert, update, offset = (args for _, args in connection.executed[1:])
+    assert insert[1] == [message.uuid] and insert[0] == [chat]
+    assert update == ([message.uuid], [MessageStatus.DELIVERED.rank])
+    assert offset[1:] == tuple(int(part) for part in last.split('-'))
+    assert (await client.xpending(STREAM, 'persistence'))['pending'] == 0
+    # partitions are created once per month
+    await client.xadd(STREAM, {'message': new_message(chat).json()})
+    assert await archive.poll(client, shard) == 1
+    assert [query for query, _ in connection.executed[4:]] == [INSERT_MESSAGES, SAVE_OFFSET]
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_stays_pending(shards):
+    archive = MessageArchive(shards, FakePool(FakeConnection(fail=True)), 'node1', 'persistence', 100, 10, 60000)
+    client = shards.clients[shards.primary]
+    await archive._create_group(client, shards.primary)
+    await client.xadd(STREAM, {'message': new_message(uuid4()).json()})
+    with pytest.raises(OSError):
+        await archive.poll(client, shards.primary)
+    assert (await client.xpending(STREAM, 'persistence'))['pending'] == 1
+
+
+@pytest.mark.asyncio
+async def test_group_starts_at_checkpoint(shards):
+    archive = MessageArchive(shards, FakePool(FakeConnection(offset=(1000, 1))), 'node1', 'persistence',
+                             100, 10, 60000)
+    client = shards.clients[shards.primary]
+    await client.xadd(STREAM, {'message': new_message(uuid4()).json()}, id='1000-1')
+    await client.xadd(STREAM, {'message': new_message(uuid4()).json()}, id='1000-2')
+    await archive._create_group(client, shards.primary)
+    [(_, entries)] = await client.xreadgroup('persistence', 'node1', {STREAM: '>'})
+    assert [entry_id for entry_id, _ in entries] == ['1000-2']
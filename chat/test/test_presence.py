@@ -0,0 +1,115 @@
+import asyncio
+import json
+from time import time
+from types import SimpleNamespace
+from uuid import uuid4
+
+import fakeredis.aioredis
+import pytest
+from redis.exceptions import RedisError
+
+import endpoints
+from codec import JsonCodec
+from presence import PresenceService
+from schemas import PresenceBatch, UserStatus
+from conftest import fake_shards
+
+
+def new_presence(redis, node: str = 'node1') -> PresenceService:
+    shards = fake_shards('redis://node1')
+    shards.clients['redis://node1'] = redis
+    return PresenceService(redis, shards, node, 30, 10, JsonCodec())
+
+
+@pytest.mark.asyncio
+async def test_multiple_connections():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    presence = new_presence(redis)
+    await presence.connect(1, set())
+    await presence.connect(1, set())
+    presence.disconnect(1)
+    await presence.tick()
+    assert await presence.statuses([1, 2]) == {1: UserStatus.ONLINE, 2: UserStatus.OFFLINE}
+    presence.disconnect(1)
+    await presence.tick()
+    assert await presence.statuses([1]) == {1: UserStatus.OFFLINE}
+    presence._ticker.cancel()
+
+
+@pytest.mark.asyncio
+async def test_other_node_keeps_user_online():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    presence1, presence2 = new_presence(redis, 'node1'), new_presence(redis, 'node2')
+    await presence1.connect(1, set())
+    await presence2.connect(1, set())
+    presence1.disconnect(1)
+    await presence1.tick()
+    assert await presence1.statuses([1]) == {1: UserStatus.ONLINE}
+    presence1._ticker.cancel()
+    presence2._ticker.cancel()
+
+
+@pytest.mark.asyncio
+async def test_crashed_node_expires():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    presence = new_presence(redis)
+    await redis.zadd(presence.key(1), {'crashed': time() - 1})
+    assert await presence.statuses([1]) == {1: UserStatus.OFFLINE}
+
+
+@pytest.mark.asyncio
+async def test_changes_published_per_chat():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    presence = new_presence(redis)
+    chat1, chat2 = uuid4(), uuid4()
+    pubsub = redis.pubsub()
+    await pubsub.subscribe(f'chat:{chat1}', f'chat:{chat2}')
+    for _ in range(2):
+        await pubsub.get_message(timeout=1)
+    await presence.connect(1, {chat1, chat2})
+    await presence.connect(2, {chat1})
+    await presence.tick()
+    published = [PresenceBatch(**json.loads((await pubsub.get_message(timeout=1))['data']))
+                 for _ in range(2)]
+    assert sorted(published, key=lambda batch: len(batch.users)) == [
+        PresenceBatch(receiver=chat2, users={1: UserStatus.ONLINE}),
+        PresenceBatch(receiver=chat1, users={1: UserStatus.ONLINE, 2: UserStatus.ONLINE})]
+    presence.disconnect(2)
+    await presence.tick()
+    published = PresenceBatch(**json.loads((await pubsub.get_message(timeout=1))['data']))
+    assert published == PresenceBatch(receiver=chat1, users={2: UserStatus.OFFLINE})
+    presence._ticker.cancel()
+
+
+@pytest.mark.asyncio
+async def test_ticker_survives_redis_errors(mocker):
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    presence = PresenceService(redis, fake_shards('redis://node1'), 'node1', 30, 0.01, JsonCodec())
+    tick = mocker.patch.object(presence, 'tick', side_effect=[RedisError('down')] + [None] * 100)
+    await presence.connect(1, set())
+    await asyncio.sleep(0.05)
+    assert tick.call_count >= 2
+    assert not presence._ticker.done()
+    presence._ticker.cancel()
+
+
+@pytest.mark.asyncio
+async def test_failed_tick_keeps_changes():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    presence = new_presence(redis)
+    await presence.connect(1, set())
+    presence.redis = fakeredis.aioredis.FakeRedis(server=fakeredis.FakeServer(), decode_responses=True)
+    presence.redis.connection_pool.connection_kwargs['server'].connected = False
+    with pytest.raises(RedisError):
+        await presence.tick()
+    assert presence.joined == {1}
+    presence._ticker.cancel()
+
+
+@pytest.mark.asyncio
+async def test_statuses_request_capped(mocker):
+    statuses = mocker.patch.object(endpoints.presence, 'statuses', return_value=dict())
+    users = ','.join(str(user_id) for user_id in range(endpoints.MEMBERS_PAGE_SIZE + 1))
+    response = await endpoints.presence_statuses.__wrapped__(SimpleNamespace(query_params={'users': users}))
+    assert response.status_code == 400
+    assert statuses.call_count == 0
@@ -0,0 +1,102 @@
+from uuid import uuid4
+
+import pytest
+
+from receipts import ReceiptAggregator
+from schemas import CachedMessage, MessageStatus, UpdateMessage, User
+
+
+class Redis:
+
+    def __init__(self, messages: list[CachedMessage]) -> None:
+        self.messages = dict((m.uuid, m) for m in messages)
+        self.updates: dict = dict()
+        self.reads = 0
+
+    async def get_messages(self, uuids):
+        self.reads += 1
+        return [self.messages.get(uuid) for uuid in uuids]
+
+    async def transition_statuses(self, updates, expr_time):
+        self.updates = updates
+        return list(updates)
+
+
+class Security:
+
+    def __init__(self, allowed: set) -> None:
+        self.allowed = allowed
+        self.checks = 0
+
+    async def is_permitted(self, permission) -> bool:
+        self.checks += 1
+        return permission.user_uuid in self.allowed
+
+
+def cached(chat, status=MessageStatus.SENT, seq: int = 0) -> CachedMessage:
+    return CachedMessage(receiver=chat, status=status,
+                         sender=User(id=1, name='user'), uuid=uuid4(), seq=seq)
+
+
+@pytest.mark.asyncio
+async def test_flush_one_read():
+    chat1, chat2, reader = uuid4(), uuid4(), uuid4()
+    messages = [cached(chat1), cached(chat1), cached(chat2)]
+    redis, security = Redis(messages), Security({reader})
+    aggregator = ReceiptAggregator(redis, security, 0, 10)  # type: ignore
+    for message in messages:
+        aggregator.add(reader, UpdateMessage(status=MessageStatus.DELIVERED, uuid=message.uuid))
+    await aggregator.flush()
+    assert redis.reads == 1
+    assert security.checks == 2
+    assert redis.updates == dict((m.uuid, MessageStatus.DELIVERED) for m in messages)
+
+
+@pytest.mark.asyncio
+async def test_status_never_goes_back():
+    chat, reader = uuid4(), uuid4()
+    read, sent = cached(chat, MessageStatus.READ), cached(chat)
+    redis = Redis([read, sent])
+    aggregator = ReceiptAggregator(redis, Security({reader}), 0, 10)  # type: ignore
+    aggregator.add(reader, UpdateMessage(status=MessageStatus.DELIVERED, uuid=read.uuid))
+    aggregator.add(reader, UpdateMessage(status=MessageStatus.READ, uuid=sent.uuid))
+    aggregator.add(reader, UpdateMessage(status=MessageStatus.DELIVERED, uuid=sent.uuid))
+    await aggregator.flush()
+    assert redis.updates == {sent.uuid: MessageStatus.READ}
+
+
+@pytest.mark.asyncio
+async def test_not_permitted():
+    chat = uuid4()
+    message = cached(chat)
+    redis = Redis([message])
+    aggregator = ReceiptAggregator(redis, Security(set()), 0, 10)  # type: ignore
+    aggregator.add(uuid4(), UpdateMessage(status=MessageStatus.READ, uuid=message.uuid))
+    await aggregator.flush()
+    assert redis.updates == dict()
+
+
+class Unread:
+
+    def __init__(self) -> None:
+        self.cursors: dict = dict()
+
+    async def mark_read(self, cursors) -> None:
+        self.cursors.update(cursors)
+
+
+@pytest.mark.asyncio
+async def test_read_cursor_per_reader():
+    chat, reader1, reader2 = uuid4(), uuid4(), uuid4()
+    older, newer = cached(chat, seq=1), cached(chat, MessageStatus.READ, seq=2)
+    redis, unread = Redis([older, newer]), Unread()
+    aggregator = ReceiptAggregator(redis, Security({reader1, reader2}), 0, 10, unread)  # type: ignore
+    aggregator.add(reader1, UpdateMessage(status=MessageStatus.READ, uuid=newer.uuid), 1)
+    # scrolled back, read out of order
+    aggregator.add(reader1, UpdateMessage(status=MessageStatus.READ, uuid=older.uuid), 1)
+    aggregator.add(reader2, UpdateMessage(status=MessageStatus.READ, uuid=older.uuid), 2)
+    aggregator.add(reader2, UpdateMessage(status=MessageStatus.DELIVERED, uuid=newer.uuid), 2)
+    await aggregator.flush()
+    assert redis.reads == 1
+    assert redis.updates == {older.uuid: MessageStatus.READ}
+    assert unread.cursors == {(1, chat): 2, (2, chat): 1}
@@ -0,0 +1,55 @@
+import json
+from uuid import uuid4
+
+import fakeredis.aioredis
+import pytest
+from pydantic.json import pydantic_encoder
+
+from schemas import CachedMessage, MessageStatus, MessageStatusBatch, User
+from scripts import STATUS_TRANSITION
+
+
+async def cache(redis, status: MessageStatus, chat) -> CachedMessage:
+    message = CachedMessage(receiver=chat, status=status,
+                            sender=User(id=1, name='user'), uuid=uuid4())
+    await redis.set(f'cachedmessage:{message.uuid}',
+                    json.dumps(message, default=pydantic_encoder))
+    return message
+
+
+@pytest.mark.asyncio
+async def test_status_transition():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    transition = redis.register_script(STATUS_TRANSITION)
+    chat = uuid4()
+    read = await cache(redis, MessageStatus.READ, chat)
+    sent = await cache(redis, MessageStatus.SENT, chat)
+    pubsub = redis.pubsub()
+    await pubsub.subscribe(f'chat:{chat}')
+    await pubsub.get_message(timeout=1)
+    updated = await transition(keys=[f'cachedmessage:{read.uuid}', f'cachedmessage:{sent.uuid}'],
+                               args=[100, 'chat', 'json', 'stream:messages', 1000, 'DELIVERED', 'DELIVERED'])
+    assert updated == [str(sent.uuid)]
+    cached_read = CachedMessage(**json.loads(await redis.get(f'cachedmessage:{read.uuid}')))
+    cached_sent = CachedMessage(**json.loads(await redis.get(f'cachedmessage:{sent.uuid}')))
+    assert cached_read.status == MessageStatus.READ
+    assert cached_sent == sent.copy(update={'status': MessageStatus.DELIVERED})
+    assert await redis.ttl(f'cachedmessage:{sent.uuid}') == 100
+    published = await pubsub.get_message(timeout=1)
+    assert MessageStatusBatch(**json.loads(published['data'])) == MessageStatusBatch(
+        receiver=chat, updates={str(sent.uuid): MessageStatus.DELIVERED})
+
+    # the batch is kept for persistence with status names whatever the channel encoding
+    [(_, fields)] = await redis.xrange('stream:messages')
+    assert MessageStatusBatch.parse_raw(fields['statuses']) == MessageStatusBatch(
+        receiver=chat, updates={str(sent.uuid): MessageStatus.DELIVERED})
+
+
+@pytest.mark.asyncio
+async def test_status_transition_without_stream():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    transition = redis.register_script(STATUS_TRANSITION)
+    sent = await cache(redis, MessageStatus.SENT, uuid4())
+    assert await transition(keys=[f'cachedmessage:{sent.uuid}'],
+                            args=[100, 'chat', 'json', '', 1000, 'READ']) == [str(sent.uuid)]
+    assert not await redis.exists('stream:messages')
@@ -0,0 +1,67 @@
+from uuid import uuid4
+
+import pytest
+
+from schemas import Message, MessageStatus, User
+from search import STREAM, SearchIndex, tokenize
+
+
+def new_message(chat, text: str) -> Message:
+    return Message(receiver=chat, status=MessageStatus.SENT, sender=User(id=1, name='user'),
+                   text=text, uuid=uuid4())
+
+
+def test_tokenize():
+    assert tokenize('Hello, hello WORLD x_1') == ['hello', 'world', 'x_1']
+
+
+def new_index(shards, claim_idle: int = 60000) -> SearchIndex:
+    return SearchIndex(shards, 'node1', 'search', 1000, 10, 10, claim_idle, 50)
+
+
+@pytest.mark.asyncio
+async def test_consumer_indexes_stream(shards):
+    index = new_index(shards)
+    chat = uuid4()
+    message = new_message(chat, 'deploy finished')
+    client = shards.client(index.history_key(chat))
+    await index._create_group(client)
+    await index.append(message)
+    assert await index.poll(client) == 1
+    assert await index.poll(client) == 0
+    assert await index.search(chat, 'deploy', 10) == ([message], None)
+    assert (await client.xpending(STREAM, 'search'))['pending'] == 0
+
+
+@pytest.mark.asyncio
+async def test_pending_entries_of_dead_consumer_claimed(shards):
+    index = new_index(shards, claim_idle=0)
+    chat = uuid4()
+    message = new_message(chat, 'lost')
+    client = shards.client(index.history_key(chat))
+    await index._create_group(client)
+    await index.append(message)
+    # read by a consumer that died before the ack
+    await client.xreadgroup('search', 'node0', {STREAM: '>'})
+    assert await index.poll(client) == 1
+    assert await index.search(chat, 'lost', 10) == ([message], None)
+    assert (await client.xpending(STREAM, 'search'))['pending'] == 0
+
+
+@pytest.mark.asyncio
+async def test_prefix_and_pages(shards):
+    index = new_index(shards)
+    chat, other = uuid4(), uuid4()
+    messages = [new_message(chat, f'release {i} deployed') for i in range(5)]
+    messages.append(new_message(chat, 'release notes'))
+    messages.append(new_message(other, 'release deployed'))
+    client = shards.client(index.history_key(chat))
+    entries = [(f'{1000 + i}-0', {'message': message.json()}) for i, message in enumerate(messages)]
+    await index.index(client, entries[:-1])
+    await index.index(shards.client(index.history_key(other)), entries[-1:])
+    found, cursor = await index.search(chat, 'release dep', 3)
+    assert found == messages[4:1:-1]
+    found, cursor = await index.search(chat, 'release dep', 3, cursor)
+    assert found == messages[1::-1] and cursor is None
+    assert await index.search(chat, 'notes', 3) == ([messages[5]], None)
+    assert await index.search(chat, 'missing', 3) == ([], None)
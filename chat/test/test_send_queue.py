@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+
+from send_queue import OverflowPolicy, SendQueue
+
+
+class Socket:
+
+    def __init__(self) -> None:
+        self.sent: list = []
+        self.close_code: int | None = None
+
+    async def send(self, data) -> None:
+        self.sent.append(data)
+
+    async def close(self, code: int) -> None:
+        self.close_code = code
+
+
+def new_queue(socket: Socket, policy: OverflowPolicy, max_size: int = 3) -> SendQueue:
+    return SendQueue(socket.send, socket.close, max_size, policy, 4000, 'test')
+
+
+@pytest.mark.asyncio
+async def test_drain_in_order():
+    socket = Socket()
+    queue = new_queue(socket, OverflowPolicy.DROP_OLDEST)
+    queue.start()
+    for i in range(3):
+        queue.put(i)
+    await asyncio.sleep(0)
+    assert socket.sent == [0, 1, 2]
+    assert queue.depth == 0
+    queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_drop_oldest():
+    socket = Socket()
+    queue = new_queue(socket, OverflowPolicy.DROP_OLDEST)
+    for i in range(5):
+        assert queue.put(i) is True
+    assert queue.depth == 3
+    assert queue.dropped == 2
+    queue.start()
+    await asyncio.sleep(0)
+    assert socket.sent == [2, 3, 4]
+    queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_coalesce_status_updates():
+    socket = Socket()
+    queue = new_queue(socket, OverflowPolicy.COALESCE)
+    queue.put('message')
+    queue.put('delivered', coalesce_key='uuid')
+    queue.put('read', coalesce_key='uuid')
+    assert queue.depth == 2
+    queue.put('other', coalesce_key='uuid2')
+    queue.put('message2')
+    assert queue.dropped == 1
+    queue.start()
+    await asyncio.sleep(0)
+    assert socket.sent == ['message', 'other', 'message2']
+    queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_disconnect():
+    socket = Socket()
+    queue = new_queue(socket, OverflowPolicy.DISCONNECT, max_size=1)
+    assert queue.put(1) is True
+    assert queue.put(2) is False
+    await asyncio.sleep(0)
+    assert socket.close_code == 4000
+    assert queue.closed is True
+    assert queue.put(3) is False
+    queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_batching_window():
+    socket = Socket()
+    batches: list = []
+
+    async def send_batch(items) -> None:
+        batches.append(items)
+
+    queue = SendQueue(socket.send, socket.close, 10, OverflowPolicy.DROP_OLDEST, 4000, 'test',
+                      send_batch, batch_window=0.01, batch_max=3)
+    queue.start()
+    for i in range(4):
+        queue.put(i)
+    await asyncio.sleep(0.02)
+    assert batches == [[0, 1, 2], [3]]
+    assert socket.sent == []
+    queue.stop()
@@ -0,0 +1,154 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+
+from conftest import fake_shards
+from hub import PubSubHub
+from sharding import HashRing, routing_key
+
+
+def test_routing_key():
+    uuid = uuid4()
+    assert routing_key(f'chat:{uuid}') == str(uuid)
+    assert routing_key(f'cachedmessage:{uuid}') == str(uuid)
+
+
+def test_only_chat_channels_sharded():
+    shards = fake_shards(*(f'redis://node{i}' for i in range(4)))
+    chats = [f'chat:{uuid4()}' for _ in range(20)]
+    assert set(shards.channel_shard(channel) for channel in chats) != {shards.primary}
+    assert all(shards.channel_shard(channel) == shards.shard(channel) for channel in chats)
+    assert all(shards.channel_shard(f'permission:update:{uuid4()}') == shards.primary
+               for _ in range(20))
+
+
+def test_ring_moves_few_keys_on_new_node():
+    keys = [str(uuid4()) for _ in range(1000)]
+    before = HashRing(['a', 'b', 'c'], 160)
+    after = HashRing(['a', 'b', 'c', 'd'], 160)
+    moved = [key for key in keys if before.node(key) != after.node(key)]
+    assert all(after.node(key) == 'd' for key in moved)
+    assert len(moved) < 400
+
+
+def test_mint_uuid_on_chat_shard(shards):
+    chat = uuid4()
+    for _ in range(20):
+        assert shards.shard(str(shards.mint_uuid(chat))) == shards.shard(f'chat:{chat}')
+
+
+@pytest.mark.asyncio
+async def test_hub_shares_channel_subscriptions(shards):
+    hub = PubSubHub(shards, False, 10)
+    received1, received2 = asyncio.Queue(), asyncio.Queue()
+    channel = f'chat:{uuid4()}'
+
+    async def subscriber1(message):
+        await received1.put(message['data'])
+
+    async def subscriber2(message):
+        await received2.put(message['data'])
+
+    await hub.subscribe({channel: subscriber1})
+    await hub.subscribe({channel: subscriber2})
+    shard = shards.shard(channel)
+    assert list(hub.pubsubs) == [shard]
+    await asyncio.sleep(0.05)
+    await shards.client(channel).publish(channel, 'data')
+    assert await asyncio.wait_for(received1.get(), 1) == 'data'
+    assert await asyncio.wait_for(received2.get(), 1) == 'data'
+    await hub.unsubscribe({channel: subscriber1})
+    assert hub.subscribers[channel] == {subscriber2}
+    await hub.unsubscribe({channel: subscriber2})
+    assert channel not in hub.subscribers
+    await hub.close()
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_does_not_block_others(shards):
+    hub = PubSubHub(shards, False, 2)
+    release, received = asyncio.Event(), asyncio.Queue()
+    channel = f'chat:{uuid4()}'
+
+    async def slow(message):
+        await release.wait()
+
+    async def fast(message):
+        await received.put(message['data'])
+
+    await hub.subscribe({channel: slow})
+    await hub.subscribe({channel: fast})
+    for i in range(2):
+        hub.dispatch({'type': 'message', 'channel': channel, 'data': str(i)})
+    assert [await asyncio.wait_for(received.get(), 1) for _ in range(2)] == ['0', '1']
+    release.set()
+    await hub.close()
+
+
+@pytest.mark.asyncio
+async def test_large_room_prepared_once(shards):
+    prepared = []
+
+    async def prepare(message):
+        prepared.append(message['data'])
+        message['decoded'] = message['data'].upper()
+
+    hub = PubSubHub(shards, False, 10, fan_out_threshold=3, prepare=prepare)
+    small, large = f'chat:{uuid4()}', f'chat:{uuid4()}'
+    received = asyncio.Queue()
+
+    def subscriber(name):
+        async def receive(message):
+            await received.put((name, message['channel'], message.get('decoded')))
+        return receive
+
+    subscribers = [subscriber(i) for i in range(3)]
+    await hub.subscribe({small: subscribers[0], large: subscribers[0]})
+    await hub.subscribe({large: subscribers[1]})
+    await hub.subscribe({large: subscribers[2]})
+    hub.dispatch({'type': 'message', 'channel': small, 'data': 'a'})
+    hub.dispatch({'type': 'message', 'channel': large, 'data': 'b'})
+    hub.dispatch({'type': 'message', 'channel': large, 'data': 'c'})
+    got = [await asyncio.wait_for(received.get(), 1) for _ in range(7)]
+    assert prepared == ['b', 'c']
+    assert (0, small, None) in got
+    assert [item for item in got if item[0] == 2] == [(2, large, 'B'), (2, large, 'C')]
+    assert list(hub.rooms) == [large]
+    await hub.unsubscribe({large: subscribers[1]})
+    assert list(hub.rooms) == [large]
+    await hub.unsubscribe({large: subscribers[0]})
+    await hub.unsubscribe({large: subscribers[2]})
+    assert not hub.rooms
+    await hub.close()
+
+
+@pytest.mark.asyncio
+async def test_listener_survives_lost_connection(shards, mocker):
+    hub = PubSubHub(shards, False, 10)
+    received = asyncio.Queue()
+    channel = f'chat:{uuid4()}'
+
+    async def subscriber(message):
+        await received.put(message['data'])
+
+    await hub.subscribe({channel: subscriber})
+    shard = shards.shard(channel)
+    pubsub = hub.pubsubs[shard]
+    read = pubsub.parse_response
+    errors = [ConnectionError('reset'), OSError()]
+
+    async def parse_response(*args, **kwargs):
+        if errors:
+            raise errors.pop(0)
+        return await read(*args, **kwargs)
+
+    mocker.patch.object(pubsub, 'parse_response', side_effect=parse_response)
+    mocker.patch('hub.LISTEN_BACKOFF', 0.01)
+    hub.listeners[shard].cancel()
+    hub.listeners[shard] = asyncio.create_task(hub.listen(shard))
+    await asyncio.sleep(0.05)
+    assert not hub.listeners[shard].done()
+    await shards.client(channel).publish(channel, 'data')
+    assert await asyncio.wait_for(received.get(), 1) == 'data'
+    await hub.close()
@@ -0,0 +1,57 @@
+from uuid import uuid4
+
+import pytest
+
+from unread import UnreadCounters
+
+
+@pytest.mark.asyncio
+async def test_counts_and_cursors(shards):
+    unread = UnreadCounters(shards)
+    chat1, chat2 = uuid4(), uuid4()
+    await unread.increment({1, 2}, chat1, 1)
+    await unread.increment({1}, chat1, 2)
+    await unread.increment({1}, chat2, 1)
+    assert await unread.counts(1) == ({str(chat1): 2, str(chat2): 1}, dict())
+    await unread.mark_read({(1, chat1): 2})
+    assert await unread.counts(1) == ({str(chat2): 1}, {str(chat1): 2})
+    assert await unread.counts(2) == ({str(chat1): 1}, dict())
+
+
+@pytest.mark.asyncio
+async def test_read_out_of_order(shards):
+    unread = UnreadCounters(shards)
+    chat = uuid4()
+    for seq in range(1, 6):
+        await unread.increment({1}, chat, seq)
+    await unread.mark_read({(1, chat): 3})
+    assert await unread.counts(1) == ({str(chat): 2}, {str(chat): 3})
+    # scrolling back neither moves the cursor back nor clears newer messages
+    await unread.mark_read({(1, chat): 1})
+    assert await unread.counts(1) == ({str(chat): 2}, {str(chat): 3})
+    await unread.mark_read({(1, chat): 5})
+    assert await unread.counts(1) == (dict(), {str(chat): 5})
+
+
+@pytest.mark.asyncio
+async def test_send_between_read_and_flush_kept(shards):
+    unread = UnreadCounters(shards)
+    chat = uuid4()
+    await unread.increment({1}, chat, 1)
+    # client reads seq 1, seq 2 is counted before the receipt is flushed
+    await unread.increment({1}, chat, 2)
+    await unread.mark_read({(1, chat): 1})
+    assert await unread.counts(1) == ({str(chat): 1}, {str(chat): 1})
+    # messages the cursor is past are not counted again
+    await unread.increment({1}, chat, 1)
+    assert await unread.counts(1) == ({str(chat): 1}, {str(chat): 1})
+
+
+@pytest.mark.asyncio
+async def test_member_joined_late(shards):
+    unread = UnreadCounters(shards)
+    chat = uuid4()
+    await unread.increment({1}, chat, 10)
+    await unread.increment({1}, chat, 11)
+    await unread.mark_read({(1, chat): 10})
+    assert await unread.counts(1) == ({str(chat): 1}, {str(chat): 10})
@@ -0,0 +1,92 @@
+from datetime import datetime, timedelta, timezone
+
+import fakeredis.aioredis
+import pytest
+from jose import jwt
+from redis.exceptions import ConnectionError
+from starlette.authentication import AuthenticationError
+from starlette.requests import HTTPConnection
+
+import authentication
+from authentication import ALGORITHM, KEY, AuthenticationManager
+from schemas import User
+from users import TTLCache, UserDirectory
+
+
+def connection(token: str) -> HTTPConnection:
+    return HTTPConnection({'type': 'http', 'headers': [(b'authorization', f'Bearer {token}'.encode())]})
+
+
+def token(user_id: int, expires: timedelta = timedelta(hours=1)) -> str:
+    return jwt.encode({'sub': user_id, 'pms': ['chat_access'], 'exp': datetime.now(timezone.utc) + expires},
+                      KEY, ALGORITHM)
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+
+
+def test_ttl_cache_expires(mocker):
+    cache = TTLCache(2, 60)
+    cache.set('a', 1, ttl=0)
+    assert len(cache) == 0
+    mocker.patch('users.monotonic', return_value=1000)
+    cache.set('b', 2, ttl=10)
+    mocker.patch('users.monotonic', return_value=1010)
+    assert cache.get('b') is None
+
+
+@pytest.mark.asyncio
+async def test_misses_filled_by_one_lookup(mocker):
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    await redis.set(UserDirectory.key(1), User(id=1, name='alice').json())
+    await redis.set(UserDirectory.key(2), 'not json')
+    users = UserDirectory(redis, 100, 60, 0.001)
+    mget = mocker.spy(redis, 'mget')
+    found = await users.get_many(list(range(1, 101)))
+    assert mget.call_count == 1
+    assert found[1] == User(id=1, name='alice')
+    assert found[2].name == ''
+    assert found[3].name == ''
+    await users.get(1)
+    assert mget.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_lookup_error_falls_back_to_nameless_user(mocker):
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    users = UserDirectory(redis, 100, 60, 0)
+    mocker.patch.object(redis, 'mget', side_effect=ConnectionError())
+    user = await users.get(5)
+    assert (user.id, user.name) == (5, '')
+    assert users.cache.get(5) is None
+
+
+@pytest.mark.asyncio
+async def test_verified_tokens_cached(mocker):
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    await redis.set(UserDirectory.key(7), User(id=7, name='bob').json())
+    manager = AuthenticationManager(UserDirectory(redis, 100, 60, 0), 100, 60)
+    verify = mocker.spy(authentication, 'verify_token')
+    access = token(7)
+    for _ in range(3):
+        credentials, user = await manager.authenticate(connection(access))
+    assert verify.call_count == 1
+    assert user.user.name == 'bob'
+    assert 'chat_access' in credentials.scopes
+
+
+@pytest.mark.asyncio
+async def test_expired_token_rejected():
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    manager = AuthenticationManager(UserDirectory(redis, 100, 60, 0), 100, 60)
+    with pytest.raises(AuthenticationError):
+        await manager.authenticate(connection(token(7, timedelta(hours=-1))))
+    with pytest.raises(AuthenticationError):
+        await manager.authenticate(connection('garbage'))